@@ -0,0 +1,144 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Token-budgeted compaction of the conversation context of macros.
+
+The frontend sends the persona, the last utterances and the whole
+conversation history with every keystroke. With MACRO_CONTEXT_TOKENS set, the
+context is cut down to the token budget of the macro before a prompt is
+rendered: the persona is truncated to a third of the budget, the most recent
+turns are kept verbatim, older ones are truncated to 60 characters, and the
+oldest are dropped. Compaction changes the prompts, so it is off by default.
+The history only changes once per turn, so its compacted form is cached and
+reused for every keystroke of the turn.
+"""
+
+import functools
+import os
+
+# Token budget of the context of each macro when compaction is enabled. Other
+# macros get `DEFAULT_TOKEN_BUDGET`, set with MACRO_CONTEXT_TOKENS, e.g. 1500.
+# The default 0 disables compaction of every macro.
+TOKEN_BUDGETS = {
+    'WordGeneric20240628': 500,
+}
+DEFAULT_TOKEN_BUDGET = int(os.environ.get('MACRO_CONTEXT_TOKENS', '0'))
+
+# Number of the most recent turns kept verbatim when they fit the budget.
+_VERBATIM_TURNS = 4
+# Length older turns are truncated to.
+_TRUNCATED_TURN_CHARS = 60
+# Largest fraction of the budget used by the persona.
+_PERSONA_SHARE = 1 / 3
+_ELLIPSIS = '…'
+_OMITTED_NOTE = '({} earlier turns omitted)'
+
+
+def EstimateTokens(text):
+  """Returns a rough token count of a text, whatever its language."""
+  # About a token per character for Japanese (3 bytes in UTF-8) and per 4
+  # characters for English.
+  return (len(text.encode('utf-8')) + 2) // 3
+
+
+def Truncate(text, max_tokens):
+  """Returns a prefix of `text` ending with an ellipsis within `max_tokens`."""
+  if EstimateTokens(text) <= max_tokens:
+    return text
+  if max_tokens <= 1:
+    return ''
+  # The ellipsis takes 3 bytes. A character cut in the middle is dropped.
+  head = text.encode('utf-8')[:3 * (max_tokens - 1)]
+  return head.decode('utf-8', 'ignore') + _ELLIPSIS
+
+
+def _TruncateTurn(turn):
+  if len(turn) <= _TRUNCATED_TURN_CHARS:
+    return turn
+  return turn[:_TRUNCATED_TURN_CHARS] + _ELLIPSIS
+
+
+@functools.lru_cache(maxsize=1024)
+def CompactHistory(history, max_tokens):
+  """Fits a newline-separated conversation history in `max_tokens`.
+
+  Turns are taken from the most recent one. The latest `_VERBATIM_TURNS` are
+  kept verbatim if they fit, older ones are truncated to
+  `_TRUNCATED_TURN_CHARS`, and the rest are replaced with a note of how many
+  turns were omitted.
+
+  Args:
+    history: Conversation history, one turn per line.
+    max_tokens: Token budget of the compacted history.
+
+  Returns:
+    The compacted history.
+  """
+  turns = history.split('\n')
+  # Leaves room for the note of omitted turns.
+  available = max_tokens - EstimateTokens(_OMITTED_NOTE.format(len(turns)))
+  kept = []
+  used = 0
+  for age, turn in enumerate(reversed(turns)):
+    if age >= _VERBATIM_TURNS or used + EstimateTokens(turn) >= available:
+      turn = _TruncateTurn(turn)
+    # Counts the newline too.
+    cost = EstimateTokens(turn) + 1
+    if used + cost > available:
+      break
+    kept.append(turn)
+    used += cost
+  omitted = len(turns) - len(kept)
+  if omitted:
+    kept.append(_OMITTED_NOTE.format(omitted))
+  return '\n'.join(reversed(kept))
+
+
+def CompactContext(macro_id, user_inputs):
+  """Returns user inputs whose context fits the token budget of the macro.
+
+  The last input and output speeches are kept as they are. The persona is
+  truncated to a share of the budget, and the conversation history gets the
+  rest.
+
+  Args:
+    macro_id: Macro ID.
+    user_inputs: Dictionary of user inputs.
+
+  Returns:
+    `user_inputs` itself if it fits the budget or compaction is disabled, or
+    a compacted copy.
+  """
+  if DEFAULT_TOKEN_BUDGET <= 0:
+    return user_inputs
+  budget = TOKEN_BUDGETS.get(macro_id, DEFAULT_TOKEN_BUDGET)
+  persona = user_inputs.get('persona') or ''
+  history = user_inputs.get('conversationHistory') or ''
+  if budget <= 0 or not (persona or history):
+    return user_inputs
+  speeches = sum(
+      EstimateTokens(user_inputs.get(key) or '')
+      for key in ('lastInputSpeech', 'lastOutputSpeech'))
+  persona_tokens = EstimateTokens(persona)
+  history_tokens = EstimateTokens(history)
+  if speeches + persona_tokens + history_tokens <= budget:
+    return user_inputs
+
+  compacted = dict(user_inputs)
+  if persona:
+    compacted['persona'] = Truncate(persona, int(budget * _PERSONA_SHARE))
+    persona_tokens = EstimateTokens(compacted['persona'])
+  if history:
+    compacted['conversationHistory'] = CompactHistory(
+        history, max(0, budget - speeches - persona_tokens))
+  return compacted
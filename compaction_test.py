@@ -0,0 +1,84 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of context compaction."""
+
+import unittest
+from unittest import mock
+
+import compaction
+
+
+class TruncateTest(unittest.TestCase):
+
+  def testKeepsTextWithinBudget(self):
+    self.assertEqual(compaction.Truncate('hello', 2), 'hello')
+
+  def testCutsTextToBudgetWithEllipsis(self):
+    self.assertEqual(compaction.Truncate('hello world', 3), 'hello …')
+
+  def testDropsCharacterCutInTheMiddle(self):
+    # Japanese characters take 3 bytes, and 6 bytes fit 2 tokens.
+    self.assertEqual(compaction.Truncate('こんにちは', 3), 'こん…')
+    self.assertEqual(compaction.Truncate('aこんにちは', 3), 'aこ…')
+
+  def testReturnsEmptyTextForTinyBudget(self):
+    self.assertEqual(compaction.Truncate('hello world', 1), '')
+
+
+class CompactHistoryTest(unittest.TestCase):
+
+  def testKeepsHistoryWithinBudget(self):
+    history = 'A: hi\nB: hello'
+    self.assertEqual(compaction.CompactHistory(history, 100), history)
+
+  def testTruncatesOlderTurns(self):
+    turns = [f'{i}: ' + 'x' * 100 for i in range(6)]
+    compacted = compaction.CompactHistory('\n'.join(turns), 1000).split('\n')
+    self.assertEqual(compacted[:2], [turn[:60] + '…' for turn in turns[:2]])
+    self.assertEqual(compacted[2:], turns[2:])
+
+  def testReplacesOldestTurnsWithNote(self):
+    turns = [f'turn {i}' for i in range(100)]
+    compacted = compaction.CompactHistory('\n'.join(turns), 30).split('\n')
+    omitted = 100 - (len(compacted) - 1)
+    self.assertEqual(compacted[0], f'({omitted} earlier turns omitted)')
+    self.assertEqual(compacted[-1], 'turn 99')
+    self.assertLessEqual(compaction.EstimateTokens('\n'.join(compacted)), 30)
+
+
+class CompactContextTest(unittest.TestCase):
+
+  user_inputs = {
+      'persona': 'p' * 3000,
+      'conversationHistory': '\n'.join(f'turn {i}' for i in range(1000)),
+  }
+
+  def testDisabledByDefault(self):
+    with mock.patch.object(compaction, 'DEFAULT_TOKEN_BUDGET', 0):
+      self.assertIs(
+          compaction.CompactContext('SentenceGeneric20250311',
+                                    self.user_inputs), self.user_inputs)
+
+  def testFitsBudget(self):
+    with mock.patch.object(compaction, 'DEFAULT_TOKEN_BUDGET', 300):
+      compacted = compaction.CompactContext('SentenceGeneric20250311',
+                                            self.user_inputs)
+    self.assertLessEqual(compaction.EstimateTokens(compacted['persona']), 100)
+    self.assertLessEqual(
+        compaction.EstimateTokens(compacted['persona']) +
+        compaction.EstimateTokens(compacted['conversationHistory']), 300)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,13 +14,25 @@
 """Library to call generative AI.
 """
 
+import asyncio
+import functools
+import itertools
 import json
 import os
 import re
 import textwrap
+import threading
+import time
 
 from google import genai
 from google.genai import types
+import httpx
+
+import compaction
+import macro_cache
+import metrics
+import stub_model
+import tracing
 
 TEMPLATES = {
     'SentenceJapaneseLong20241002':
@@ -200,107 +212,1047 @@ TEMPLATES = {
         sentence: "[[text]]"
         answers:
         '''),
+    'WordSentenceGeneric20261017':
+        textwrap.dedent('''\
+        #ifdef lastInputSpeech
+        You are talking with your partner. The conversation is as follows:
+        #ifdef lastOutputSpeech
+        You:
+        [[lastOutputSpeech]]
+        #endif
+        Partner:
+        [[lastInputSpeech]]
+
+        #ifdef conversationHistory
+        Here is the conversation history:
+        [[conversationHistory]]
+        #endif
+
+        Considering this context, please guess how the user continues the text "[[text]]" and generate two lists. \\
+        #else
+        Please guess how the user continues the text "[[text]]" and generate two lists. \\
+        #endif
+        Please note the text may not be complete, so use your best guess.
+
+        Under the heading "Words:", list [[num]] different single words that come right after the text. If the last word in the text looks incomplete, suggest the succeeding characters without replacing them. Make sure to start with a hyphen in that case.
+
+        Under the heading "Sentences:", list [[num]] different sentences that start with the text. Each sentence should start with a different word to cover wider topics.
+        #ifdef sentenceEmotion
+        Note that the user has indicated their intention to input a [[sentenceEmotion]] sentence.
+        #endif
+
+        Each answer must start with an index number. Do not highlight answers with asterisk. Since your output will be used as the user's input, do not include any extra notes, labels or explanations other than the two headings. The answers should be in [[language]]. You should follow the format shown in the example below.
+
+        Example for the text "He":
+        Words:
+        1. -llo
+        2. was
+        3. -lsinki
+        Sentences:
+        1. Hello, how are you?
+        2. He was at home yesterday.
+        3. Helsinki is a beautiful city.
+        #ifdef persona
+
+        FYI: The user's profile is as follows:
+        [[persona]]
+        #endif
+
+        Answer:
+        '''),
 }
 
+# Macros generating several lists in one response, with the headings of the
+# lists. Their results have a message per list in this order, so the first
+# one holds the sentences like the result of a sentence macro.
+COMBINED_MACROS = {
+    'WordSentenceGeneric20261017': ('Sentences', 'Words'),
+}
+_SECTION_HEADING_RE = re.compile(r'^#*\s*(\w+)\s*:$')
 
-def RunGeminiMacro(model_id, prompt, temperature, language):
-  """Runs a Gemini macro.
+# Connection pool limits shared by every request made through a pooled client.
+_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.environ.get('GENAI_MAX_CONNECTIONS', '32')),
+    max_keepalive_connections=int(
+        os.environ.get('GENAI_MAX_KEEPALIVE_CONNECTIONS', '16')),
+    keepalive_expiry=float(os.environ.get('GENAI_KEEPALIVE_EXPIRY', '300')),
+)
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+# Backends serving model calls, selected with the MODEL_BACKEND environment
+# variable or `SetModelBackend`: 'gemini' calls the Gemini API, and 'stub'
+# generates responses locally with `stub_model` for offline benchmarks and
+# simulations.
+MODEL_BACKENDS = ('gemini', 'stub')
+_model_backend = os.environ.get('MODEL_BACKEND', 'gemini')
 
-  This function calls a Gemini macro with the specified parameters.
+
+def SetModelBackend(backend):
+  """Selects the backend of subsequent model calls.
 
   Args:
-    model_id: The ID of the Gemini model to use.
-    prompt: The input text or prompt for the macro.
-    temperature: Controls the randomness of the output.
-      Higher values (e.g., 0.8) make the output more random and creative,
-      while lower values (e.g., 0.2) make it more focused and deterministic.
-    language: The language to use for the macro.
+    backend: One of `MODEL_BACKENDS`.
+
+  Raises:
+    ValueError: If the backend is unknown.
+  """
+  global _model_backend
+  if backend not in MODEL_BACKENDS:
+    raise ValueError(f'Unknown model backend: {backend}')
+  _model_backend = backend
+
+
+def GetClient(api_key=None, **http_options):
+  """Returns a process-wide `genai.Client` for the given key and options.
+
+  Clients are created once per (API key, HTTP options) pair and shared across
+  threads, so TLS and keep-alive connections to the upstream are reused
+  between requests. Their connection pools are bounded by `_POOL_LIMITS`.
+  With the 'stub' model backend, a shared `stub_model.StubClient` is returned
+  instead.
+
+  Args:
+    api_key: API key for the Gemini API. Defaults to the `API_KEY` environment
+      variable.
+    **http_options: Extra `types.HttpOptions` fields, e.g. `timeout`. Values
+      must be hashable.
 
   Returns:
-    The result generated by the macro.
+    A shared `genai.Client`, or `stub_model.StubClient`.
+  """
+  if api_key is None:
+    api_key = os.environ.get('API_KEY')
+  key = (_model_backend, api_key, tuple(sorted(http_options.items())))
+  client = _clients.get(key)
+  if client:
+    return client
+  with _clients_lock:
+    client = _clients.get(key)
+    if not client:
+      if _model_backend == 'stub':
+        client = stub_model.StubClient()
+      else:
+        client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(
+                client_args={'limits': _POOL_LIMITS},
+                async_client_args={'limits': _POOL_LIMITS},
+                **http_options,
+            ),
+        )
+      _clients[key] = client
+  return client
+
+
+def _ResetClientsAfterFork():
+  """Drops clients inherited from the parent process.
+
+  Pooled connections must not be shared between processes, so a forked child
+  (e.g. a gunicorn worker) starts with an empty registry and a fresh lock.
   """
+  global _clients_lock
+  _clients.clear()
+  _clients_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_ResetClientsAfterFork)
+
+# Cache of deterministic (temperature 0) responses. Set MACRO_CACHE_PATH to
+# share entries between worker processes through a SQLite file.
+response_cache = macro_cache.ResponseCache(
+    max_entries=int(os.environ.get('MACRO_CACHE_SIZE', '4096')),
+    ttl_seconds=float(os.environ.get('MACRO_CACHE_TTL', '3600')),
+    disk_path=os.environ.get('MACRO_CACHE_PATH'),
+)
+
+# Coalesces identical in-flight temperature 0 calls. With
+# MACRO_COALESCE_ACROSS_WORKERS set, workers sharing MACRO_CACHE_PATH also wait
+# for each other's results instead of calling the model again.
+single_flight = macro_cache.SingleFlight()
+_COALESCE_ACROSS_WORKERS = bool(os.environ.get('MACRO_COALESCE_ACROSS_WORKERS'))
+_COALESCE_TIMEOUT_SECONDS = float(
+    os.environ.get('MACRO_COALESCE_TIMEOUT', '10'))
+
+# Client-side quota of `RunGeminiMacro` calls, for batch tools calling the
+# model from many threads. See `SetRateLimiter`.
+rate_limiter = None
+
+
+def SetRateLimiter(limiter):
+  """Sets a `rate_limit.RateLimiter` for `RunGeminiMacro` calls, or None."""
+  global rate_limiter
+  rate_limiter = limiter
+
+
+def _EstimateTokens(prompt):
+  """Returns a rough upper bound of the tokens used by a call."""
+  # About a token per character for Japanese and per 4 characters for English,
+  # plus a short response.
+  return len(prompt.encode('utf-8')) // 3 + 100
 
-  client = genai.Client(api_key=os.environ.get('API_KEY'))
+
+def _TotalTokens(response):
+  usage = response.usage_metadata
+  return usage.total_token_count if usage else None
+
+
+# Record/replay log of responses for reproducible simulator runs. Set
+# MACRO_RECORD_PATH to record responses, or MACRO_REPLAY_PATH to serve recorded
+# ones only. See `SetResponseLog`.
+response_log = None
+
+
+def SetResponseLog(path, replay_only=False):
+  """Records responses of `RunMacro` calls to a log, or replays them.
+
+  Recorded calls are served from the log in both modes, whatever their
+  temperature. Other calls call the model and are appended to the log, or
+  raise `macro_cache.ReplayMissError` with `replay_only`.
+
+  Args:
+    path: Path of the JSONL log, or None to stop recording.
+    replay_only: Whether to fail instead of calling the model.
+  """
+  global response_log
+  response_log = macro_cache.ResponseLog(path, replay_only) if path else None
+
+
+if os.environ.get('MACRO_REPLAY_PATH'):
+  SetResponseLog(os.environ['MACRO_REPLAY_PATH'], replay_only=True)
+elif os.environ.get('MACRO_RECORD_PATH'):
+  SetResponseLog(os.environ['MACRO_RECORD_PATH'])
+
+
+def _ResponseCacheCounters():
+  stats = response_cache.Stats()
+  del stats['entries']
+  return stats
+
+
+metrics.RegisterCollector('voice_response_cache_total',
+                          'Response cache lookups, evictions and errors.',
+                          'counter', _ResponseCacheCounters)
+metrics.RegisterCollector('voice_response_cache_entries',
+                          'Entries in the memory tier of the response cache.',
+                          'gauge',
+                          lambda: {'memory': response_cache.Stats()['entries']})
+metrics.RegisterCollector('voice_coalesced_calls_total',
+                          'Upstream calls saved by coalescing.', 'counter',
+                          single_flight.Stats)
+
+_MACRO_REQUESTS = metrics.Counter(
+    'voice_macro_requests_total', 'Macro runs by result status.',
+    ['macro_id', 'model_id', 'language', 'status'])
+_MACRO_SECONDS = metrics.Histogram('voice_macro_duration_seconds',
+                                   'End-to-end latency of macro runs.',
+                                   ['macro_id', 'model_id', 'language'])
+_RENDER_SECONDS = metrics.Histogram('voice_render_duration_seconds',
+                                    'Template render latency.', ['macro_id'])
+_UPSTREAM_SECONDS = metrics.Histogram('voice_upstream_duration_seconds',
+                                      'Gemini call latency.',
+                                      ['model_id', 'language'])
+_POSTPROCESS_SECONDS = metrics.Histogram('voice_postprocess_duration_seconds',
+                                         'Response post-processing latency.',
+                                         ['language'])
+_UPSTREAM_RESPONSES = metrics.Counter(
+    'voice_upstream_responses_total',
+    'Gemini calls by outcome (ok, empty or error).',
+    ['model_id', 'language', 'status'])
+_UPSTREAM_TOKENS = metrics.Counter('voice_upstream_tokens_total',
+                                   'Tokens reported in usage_metadata.',
+                                   ['model_id', 'kind'])
+_WORD_DERIVATIONS = metrics.Counter(
+    'voice_word_derivations_total',
+    'Word macro runs derived from sentence suggestions, by outcome.',
+    ['macro_id', 'outcome'])
+_USAGE_FIELDS = (
+    ('prompt', 'prompt_token_count'),
+    ('candidates', 'candidates_token_count'),
+    ('thoughts', 'thoughts_token_count'),
+    ('total', 'total_token_count'),
+)
+
+_EMPTY_RESPONSE = json.dumps({'messages': []})
+
+
+class _MacroRun:
+  """Context manager recording request metrics of a macro run."""
+
+  def __init__(self, macro_id, model_id, language):
+    self._labels = (macro_id, model_id, language)
+    self._start = 0.0
+    self._status = 'error'
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, unused_exc_value, unused_traceback):
+    # GeneratorExit is raised when a stream is closed before its end.
+    if exc_type in (asyncio.CancelledError, GeneratorExit):
+      self._status = 'cancelled'
+    _MACRO_REQUESTS.Inc(*self._labels, self._status)
+    _MACRO_SECONDS.Observe(time.perf_counter() - self._start, *self._labels)
+
+  def Finish(self, result, cached=False):
+    """Records the status of `result` and returns it."""
+    if cached:
+      self._status = 'cached'
+    else:
+      self._status = 'empty' if result == _EMPTY_RESPONSE else 'ok'
+    return result
+
+
+def _GenerateContentConfig(model_id, temperature):
+  """Returns the generation config shared by all Gemini macro calls."""
   thiking_config = None
   if model_id.startswith('gemini-2.5-'):
     thiking_config = types.ThinkingConfig(thinking_budget=0)
-  response = client.models.generate_content(
-      model=model_id,
-      contents=prompt,
-      config=types.GenerateContentConfig(
-          temperature=temperature,
-          top_p=0.5,
-          safety_settings=[
-              types.SafetySetting(
-                  category='HARM_CATEGORY_HATE_SPEECH', threshold='BLOCK_NONE'),
-              types.SafetySetting(
-                  category='HARM_CATEGORY_SEXUALLY_EXPLICIT',
-                  threshold='BLOCK_NONE'),
-          ],
-          thinking_config=thiking_config,
-      ),
+  return types.GenerateContentConfig(
+      temperature=temperature,
+      top_p=0.5,
+      safety_settings=[
+          types.SafetySetting(
+              category='HARM_CATEGORY_HATE_SPEECH', threshold='BLOCK_NONE'),
+          types.SafetySetting(
+              category='HARM_CATEGORY_SEXUALLY_EXPLICIT',
+              threshold='BLOCK_NONE'),
+      ],
+      thinking_config=thiking_config,
   )
-  if not response.text:
-    return json.dumps({'messages': []})
-  text = response.text
+
+
+def _PostProcess(text, language):
+  """Cleans up a response text from Gemini."""
   # Quick hack to remove highlights from response. All '*' are removed even
   # if they are not highlights.
   text = text.replace('*', '')
   if language == 'Japanese':
     # Also remove hankaku spaces in Japanese texts.
     text = re.sub(r'([^\w;:,.?]) +(\W)', r'\1\2', text, flags=re.ASCII)
-  text = text.replace('§', ' ')
-  return json.dumps({'messages': [{'text': text}]}, ensure_ascii=False)
+  return text.replace('§', ' ')
 
 
-def RunMacro(macro_id, user_inputs, temperature, model_id):
-  """Runs a LLM macro with user inputs.
+def RunGeminiMacro(model_id, prompt, temperature, language, sections=None):
+  """Runs a Gemini macro.
 
-  Replaces placeholders in a template with user inputs and calls the macro.
+  This function calls a Gemini macro with the specified parameters.
 
   Args:
-    macro_id: Macro ID.
-    user_inputs: Dictionary of user inputs.
+    model_id: The ID of the Gemini model to use.
+    prompt: The input text or prompt for the macro.
     temperature: Controls the randomness of the output.
       Higher values (e.g., 0.8) make the output more random and creative,
       while lower values (e.g., 0.2) make it more focused and deterministic.
-    model_id: The ID of the generative AI model to use.
+    language: The language to use for the macro.
+    sections: Headings of the lists of a combined macro, see
+      `COMBINED_MACROS`, or None for a single list.
 
   Returns:
-    The result of the macro call.
+    The result generated by the macro.
   """
 
-  lines = []
-  include_block = []
-  for line in TEMPLATES[macro_id].split('\n'):
-    matched_defined_keyword = re.match(r'^#ifdef (\w+)$', line)
+  client = GetClient()
+
+  def Generate():
+    return client.models.generate_content(
+        model=model_id,
+        contents=prompt,
+        config=_GenerateContentConfig(model_id, temperature),
+    )
+
+  try:
+    with _UPSTREAM_SECONDS.Time(model_id, language), tracing.Span('upstream'):
+      if rate_limiter is None:
+        response = Generate()
+      else:
+        response = rate_limiter.Call(
+            Generate, _EstimateTokens(prompt), count_tokens=_TotalTokens)
+  except Exception:
+    _UPSTREAM_RESPONSES.Inc(model_id, language, 'error')
+    raise
+  return _FormatResponse(response, model_id, language, sections)
+
+
+async def RunGeminiMacroAsync(model_id,
+                              prompt,
+                              temperature,
+                              language,
+                              sections=None):
+  """Runs a Gemini macro with the async client.
+
+  See `RunGeminiMacro` for the arguments and the return value.
+  """
+  client = GetClient()
+  try:
+    with _UPSTREAM_SECONDS.Time(model_id, language), tracing.Span('upstream'):
+      response = await client.aio.models.generate_content(
+          model=model_id,
+          contents=prompt,
+          config=_GenerateContentConfig(model_id, temperature),
+      )
+  except Exception:
+    _UPSTREAM_RESPONSES.Inc(model_id, language, 'error')
+    raise
+  return _FormatResponse(response, model_id, language, sections)
+
+
+def _FormatResponse(response, model_id, language, sections=None):
+  """Converts a Gemini response into the JSON returned by macros."""
+  _CountTokens(model_id, response.usage_metadata)
+  return _FormatText(response.text, model_id, language, sections)
+
+
+def _CountTokens(model_id, usage):
+  if usage:
+    for kind, field in _USAGE_FIELDS:
+      count = getattr(usage, field, None)
+      if count:
+        _UPSTREAM_TOKENS.Inc(model_id, kind, amount=count)
+
+
+def _FormatText(text, model_id, language, sections=None):
+  if not text:
+    _UPSTREAM_RESPONSES.Inc(model_id, language, 'empty')
+    return _EMPTY_RESPONSE
+  _UPSTREAM_RESPONSES.Inc(model_id, language, 'ok')
+  with _POSTPROCESS_SECONDS.Time(language), tracing.Span('postprocess'):
+    text = _PostProcess(text, language)
+    texts = _SplitSections(text, sections) if sections else [text]
+    messages = [{'text': text} for text in texts]
+    return json.dumps({'messages': messages}, ensure_ascii=False)
+
+
+def _SplitSections(text, headings):
+  """Splits a response into the lists under `headings`, in their order.
+
+  Headings are matched case-insensitively, optionally as Markdown headings.
+  Lines before the first heading are dropped, and a missing list is empty.
+  """
+  sections = {heading.lower(): [] for heading in headings}
+  current = None
+  for line in text.split('\n'):
+    matched = _SECTION_HEADING_RE.match(line.strip())
+    if matched and matched.group(1).lower() in sections:
+      current = sections[matched.group(1).lower()]
+    elif current is not None:
+      current.append(line)
+  return ['\n'.join(sections[heading.lower()]).strip() for heading in headings]
+
+
+_NUMBERED_LINE_RE = re.compile(r'^\d+\.\s?(.*)$')
+
+
+def _NumberedLines(chunks):
+  """Yields numbered list items from text chunks as soon as they complete.
+
+  Mirrors `parseResponse` in the frontend: escaped line breaks are joined,
+  lines without a leading index number are skipped, and the number is
+  stripped.
+  """
+  buffer = ''
+  for chunk in chunks:
+    *lines, buffer = (buffer + chunk).replace('\\\n', '').split('\n')
+    for line in lines:
+      matched = _NUMBERED_LINE_RE.match(line.strip())
+      if matched:
+        yield matched.group(1)
+  matched = _NUMBERED_LINE_RE.match(buffer.strip())
+  if matched:
+    yield matched.group(1)
+
+
+def ParseSuggestions(result):
+  """Returns the suggestions of a macro result, without index numbers."""
+  messages = json.loads(result).get('messages')
+  if not messages:
+    return []
+  return list(_NumberedLines([messages[0].get('text', '')]))
+
+
+def FormatSuggestions(suggestions):
+  """Returns a macro result listing `suggestions`, like a model response."""
+  text = '\n'.join(
+      f'{i}. {suggestion}' for i, suggestion in enumerate(suggestions, 1))
+  return json.dumps({'messages': [{'text': text}]}, ensure_ascii=False)
+
+
+# Word macros that can be answered from the sentence suggestions for the same
+# text, when at least DERIVED_WORDS_MIN_CANDIDATES distinct words come out.
+DERIVABLE_WORD_MACROS = ('WordGeneric20240628',)
+DERIVED_WORDS_MIN_CANDIDATES = int(
+    os.environ.get('DERIVED_WORDS_MIN_CANDIDATES', '3'))
+_WORD_TRAILING_PUNCTUATION = '.,!?'
+# Languages written without spaces between words, whose words cannot be split
+# off sentences.
+_UNSEGMENTED_LANGUAGES = ('Japanese',)
+
+
+def DeriveWordSuggestions(text, sentences, num):
+  """Returns up to `num` distinct words following `text` in sentences.
+
+  Words have the format of the word macro: the completion of a partial last
+  word starts with a hyphen, e.g. "-llo" for "He" and "Hello there", while
+  the next word is as it is, e.g. "was" for "He" and "He was there".
+
+  Args:
+    text: Text typed by the user.
+    sentences: Sentence suggestions for `text`.
+    num: Maximum number of words.
+
+  Returns:
+    The list of words, in the order of the sentences.
+  """
+  words = []
+  for sentence in sentences:
+    if not sentence.lower().startswith(text.lower()):
+      continue
+    rest = sentence[len(text):]
+    partial = text[-1:] and not text[-1].isspace() and rest[:1].strip()
+    tokens = rest.split(maxsplit=1)
+    word = tokens[0].rstrip(_WORD_TRAILING_PUNCTUATION) if tokens else ''
+    if word and partial:
+      word = '-' + word
+    if word and word not in words:
+      words.append(word)
+      if len(words) == num:
+        break
+  return words
+
+
+def DerivableWordSources(macro_ids, language):
+  """Returns {index of a derivable word macro: index of its sentence macro}.
+
+  Word macros in `macro_ids` are paired with the first sentence macro, if any.
+  None are derivable in languages without spaces between words, so that their
+  word macros run in parallel with the sentence macro without waiting for it.
+  """
+  sentence_index = next((i for i, macro_id in enumerate(macro_ids)
+                         if macro_id.startswith('Sentence')), None)
+  if sentence_index is None:
+    return {}
+  derivable = [
+      i for i, macro_id in enumerate(macro_ids)
+      if macro_id in DERIVABLE_WORD_MACROS
+  ]
+  if language in _UNSEGMENTED_LANGUAGES:
+    for i in derivable:
+      _WORD_DERIVATIONS.Inc(macro_ids[i], 'unsupported_language')
+    return {}
+  return {i: sentence_index for i in derivable}
+
+
+def DeriveWordResult(macro_id, user_inputs, sentence_result):
+  """Derives the result of a word macro from a sentence macro result.
+
+  Args:
+    macro_id: ID of the word macro, one of `DERIVABLE_WORD_MACROS`.
+    user_inputs: User inputs of both macros.
+    sentence_result: Result of the sentence macro.
+
+  Returns:
+    A result like the word macro's, or None if too few words come out and the
+    word macro has to be called. Languages written without spaces between
+    words always get None.
+  """
+  if user_inputs.get('language') in _UNSEGMENTED_LANGUAGES:
+    _WORD_DERIVATIONS.Inc(macro_id, 'unsupported_language')
+    return None
+  words = DeriveWordSuggestions(
+      user_inputs.get('text', ''), ParseSuggestions(sentence_result),
+      int(user_inputs.get('num', 5)))
+  if len(words) < DERIVED_WORDS_MIN_CANDIDATES:
+    _WORD_DERIVATIONS.Inc(macro_id, 'too_few')
+    return None
+  _WORD_DERIVATIONS.Inc(macro_id, 'derived')
+  return FormatSuggestions(words)
+
+
+def StreamGeminiMacro(model_id, prompt, temperature, language, num):
+  """Runs a Gemini macro and yields suggestions as they are generated.
+
+  The text generated so far is post-processed like the results of
+  `RunGeminiMacro`, and each numbered line is yielded once it is complete.
+  The upstream stream is closed as soon as `num` suggestions are delivered.
+
+  Args:
+    model_id: The ID of the Gemini model to use.
+    prompt: The input text or prompt for the macro.
+    temperature: Controls the randomness of the output.
+    language: The language to use for the macro.
+    num: The maximum number of suggestions to yield.
+
+  Yields:
+    Post-processed suggestion texts without index numbers.
+
+  Returns:
+    A tuple of the result like `RunGeminiMacro` and whether the whole
+    response was read. The result of a response cut off after `num`
+    suggestions only lists those.
+  """
+  client = GetClient()
+
+  def Open():
+    stream = client.models.generate_content_stream(
+        model=model_id,
+        contents=prompt,
+        config=_GenerateContentConfig(model_id, temperature),
+    )
+    # The request is only sent when the first chunk is read, so read it here
+    # for failures to be retried by the rate limiter.
+    try:
+      return stream, next(stream, None)
+    except BaseException:
+      stream.close()
+      raise
+
+  estimated_tokens = _EstimateTokens(prompt)
+  text = ''
+  usage = None
+  delivered = 0
+  with _UPSTREAM_SECONDS.Time(model_id, language), tracing.Span('upstream'):
+    try:
+      if rate_limiter is None:
+        stream, chunk = Open()
+      else:
+        stream, chunk = rate_limiter.Call(Open, estimated_tokens)
+    except Exception:
+      _UPSTREAM_RESPONSES.Inc(model_id, language, 'error')
+      raise
+    try:
+      while chunk is not None:
+        usage = chunk.usage_metadata or usage
+        text += chunk.text or ''
+        complete = text[:text.rfind('\n') + 1]
+        # A trailing escaped line break joins the line with the next chunk.
+        if not complete.endswith('\\\n'):
+          lines = list(_NumberedLines([_PostProcess(complete, language)]))
+          for line in lines[delivered:num]:
+            yield line
+            delivered += 1
+          if delivered >= num:
+            break
+        chunk = next(stream, None)
+    except Exception:
+      _UPSTREAM_RESPONSES.Inc(model_id, language, 'error')
+      raise
+    finally:
+      stream.close()
+      _CountTokens(model_id, usage)
+      if rate_limiter is not None and usage and usage.total_token_count:
+        rate_limiter.Adjust(usage.total_token_count - estimated_tokens)
+  if chunk is not None:
+    _UPSTREAM_RESPONSES.Inc(model_id, language, 'ok')
+    return FormatSuggestions(lines[:num]), False
+  result = _FormatText(text, model_id, language)
+  yield from itertools.islice(ParseSuggestions(result), delivered, num)
+  return result, True
+
+
+_IFDEF_RE = re.compile(r'^#ifdef (\w+)$')
+_ELSE_RE = re.compile(r'^#else$')
+_ENDIF_RE = re.compile(r'^#endif$')
+_COPYBARA_RE = re.compile(r'^#copybara:')
+_PLACEHOLDER_RE = re.compile(r'\[\[(\w+)\]\]')
+
+
+class _Line:
+  """A template line split into static chunks and placeholder slots.
+
+  `chunks` alternates between static text (even indices) and placeholder keys
+  (odd indices). A line ending with a backslash is joined with the next
+  rendered line.
+  """
+
+  __slots__ = ('chunks', 'continued')
+
+  def __init__(self, line):
+    self.continued = line.endswith('\\')
+    self.chunks = _PLACEHOLDER_RE.split(line[:-1] if self.continued else line)
+
+
+class _Conditional:
+  """An `#ifdef key` block with an optional `#else` branch."""
+
+  __slots__ = ('key', 'body', 'orelse')
+
+  def __init__(self, key):
+    self.key = key
+    self.body = []
+    self.orelse = []
+
+
+@functools.lru_cache(maxsize=None)
+def _CompileTemplate(template):
+  """Parses a template into a tree of `_Line` and `_Conditional` nodes.
+
+  Args:
+    template: Template string in the `TEMPLATES` format.
+
+  Returns:
+    A list of nodes to be rendered by `_RenderNodes`.
+
+  Raises:
+    ValueError: If `#else` or `#endif` appears outside of an `#ifdef` block.
+  """
+  root = []
+  # Stack of (conditional, list currently appended to).
+  stack = []
+  nodes = root
+  for line in template.split('\n'):
+    matched_defined_keyword = _IFDEF_RE.match(line)
     if matched_defined_keyword:
-      is_defined = bool(user_inputs.get(matched_defined_keyword.group(1)))
-      include_block.append(is_defined)
+      conditional = _Conditional(matched_defined_keyword.group(1))
+      nodes.append(conditional)
+      stack.append((conditional, nodes))
+      nodes = conditional.body
+      continue
+    if _ELSE_RE.match(line):
+      if not stack:
+        raise ValueError('#else without #ifdef')
+      conditional = stack[-1][0]
+      nodes = conditional.orelse if nodes is conditional.body else conditional.body
       continue
-    if re.match(r'^#else$', line):
-      top = include_block.pop()
-      include_block.append(not top)
+    if _ENDIF_RE.match(line):
+      if not stack:
+        raise ValueError('#endif without #ifdef')
+      nodes = stack.pop()[1]
       continue
-    if re.match(r'^#endif$', line):
-      include_block.pop()
+    if _COPYBARA_RE.match(line):
       continue
-    if re.match(r'^#copybara:', line):
+    nodes.append(_Line(line))
+  return root
+
+
+def _RenderNodes(nodes, user_inputs, out, separator):
+  """Appends rendered nodes to `out` and returns the pending line separator."""
+  for node in nodes:
+    if isinstance(node, _Conditional):
+      branch = node.body if user_inputs.get(node.key) else node.orelse
+      separator = _RenderNodes(branch, user_inputs, out, separator)
       continue
-    if all(include_block):
-      lines.append(line)
-  prompt = '\n'.join(lines)
-  prompt = re.sub(r'\\\n', '', prompt, flags=re.MULTILINE | re.DOTALL)
+    if separator is not None:
+      out.append(separator)
+    chunks = node.chunks
+    out.append(chunks[0])
+    for i in range(1, len(chunks), 2):
+      key = chunks[i]
+      value = user_inputs.get(key)
+      out.append(f'[[{key}]]' if value is None else value)
+      out.append(chunks[i + 1])
+    separator = '' if node.continued else '\n'
+  return separator
+
+
+def RenderPrompt(macro_id, user_inputs):
+  """Renders the prompt of a macro with user inputs.
+
+  The conversation context is first compacted to the token budget of the
+  macro, see `compaction.CompactContext`. Conditional blocks are evaluated and
+  placeholders are substituted in a single pass over the compiled template, so
+  user inputs are never scanned for placeholders themselves.
+
+  Args:
+    macro_id: Macro ID.
+    user_inputs: Dictionary of user inputs.
+
+  Returns:
+    The rendered prompt.
+  """
+  user_inputs = compaction.CompactContext(macro_id, user_inputs)
   language = user_inputs.get('language', '')
-  for key in user_inputs:
-    user_input = user_inputs[key]
-    if key == 'text' and language == 'Japanese':
-      user_input = user_input.replace(' ', '§')
+  text = user_inputs.get('text')
+  if text is not None:
+    if language == 'Japanese':
+      text = text.replace(' ', '§')
     # Replace ' ' in between with '§' for word macro as it produces better
     # results.
     # TODO: Improve the word macro and remove this hack.
-    if key == 'text' and macro_id == 'WordGeneric20240628':
-      user_input = re.sub(r'§$', ' ', user_input.replace(' ', '§'))
-    prompt = prompt.replace(f'[[{key}]]', user_input)
+    if macro_id == 'WordGeneric20240628':
+      text = re.sub(r'§$', ' ', text.replace(' ', '§'))
+    user_inputs = {**user_inputs, 'text': text}
+
+  out = []
+  separator = _RenderNodes(
+      _CompileTemplate(TEMPLATES[macro_id]), user_inputs, out, None)
+  if separator == '':
+    # The last line ends with a backslash which has nothing to join with.
+    out.append('\\')
+  return ''.join(out)
+
+
+def RunMacro(macro_id, user_inputs, temperature, model_id):
+  """Runs a LLM macro with user inputs.
+
+  Replaces placeholders in a template with user inputs and calls the macro.
+
+  Args:
+    macro_id: Macro ID.
+    user_inputs: Dictionary of user inputs.
+    temperature: Controls the randomness of the output.
+      Higher values (e.g., 0.8) make the output more random and creative,
+      while lower values (e.g., 0.2) make it more focused and deterministic.
+    model_id: The ID of the generative AI model to use.
+
+  Returns:
+    The result of the macro call.
+  """
+
+  language = user_inputs.get('language', '')
+  with _MacroRun(macro_id, model_id, language) as run:
+    with _RENDER_SECONDS.Time(macro_id), tracing.Span('render'):
+      prompt = RenderPrompt(macro_id, user_inputs)
+    tracing.Annotate(
+        macro_id=macro_id,
+        model_id=model_id,
+        language=language,
+        prompt_chars=len(prompt))
+    if response_log is not None:
+      return _RunLogged(run, macro_id, model_id, prompt, temperature, language)
+    if temperature > 0:
+      return run.Finish(
+          RunGeminiMacro(model_id, prompt, temperature, language,
+                         COMBINED_MACROS.get(macro_id)))
+
+    cache_key = macro_cache.MakeKey(model_id, prompt, temperature, language)
+    result = response_cache.Get(cache_key) if response_cache.enabled else None
+    tracing.Annotate(cache='miss' if result is None else 'hit')
+    if result is not None:
+      return run.Finish(result, cached=True)
+    return run.Finish(
+        single_flight.Do(
+            cache_key,
+            lambda: _RunAndCache(cache_key, model_id, prompt, temperature,
+                                 language, COMBINED_MACROS.get(macro_id))))
+
+
+def _RunLogged(run, macro_id, model_id, prompt, temperature, language):
+  """Serves a call from `response_log`, recording it if needed."""
+  log = response_log
+  key = macro_cache.MakeKey(macro_id, model_id, prompt, temperature, language)
+  result = log.Get(key)
+  if result is not None:
+    return run.Finish(result, cached=True)
+  if log.replay_only:
+    raise macro_cache.ReplayMissError(
+        f'{macro_id} call not recorded in {log.path}')
+
+  def RunAndRecord():
+    result = RunGeminiMacro(model_id, prompt, temperature, language,
+                            COMBINED_MACROS.get(macro_id))
+    log.Append(
+        key,
+        result,
+        macro_id=macro_id,
+        model_id=model_id,
+        temperature=temperature,
+        language=language,
+        prompt=prompt)
+    return result
+
+  return run.Finish(single_flight.Do(key, RunAndRecord))
+
+
+def _RunAndCache(cache_key, model_id, prompt, temperature, language, sections):
+  """Calls the model unless another worker is already doing so.
+
+  A worker waiting for another one takes over as soon as its lease is
+  released without a cached result, and calls the model itself once the
+  timeout passes.
+  """
+  leased = False
+  if _COALESCE_ACROSS_WORKERS:
+    deadline = time.monotonic() + _COALESCE_TIMEOUT_SECONDS
+    while True:
+      leased = response_cache.AcquireLease(cache_key, _COALESCE_TIMEOUT_SECONDS)
+      remaining = deadline - time.monotonic()
+      if leased or remaining <= 0:
+        break
+      result = response_cache.WaitForDisk(cache_key, remaining)
+      if result is not None:
+        single_flight.Count('coalesced_across_workers')
+        return result
+  try:
+    result = RunGeminiMacro(model_id, prompt, temperature, language, sections)
+    # Empty responses may be transient, so they are not cached.
+    if result != _EMPTY_RESPONSE:
+      response_cache.Put(cache_key, result)
+    return result
+  finally:
+    if leased:
+      response_cache.ReleaseLease(cache_key)
+
+
+async def RunMacroAsync(macro_id, user_inputs, temperature, model_id):
+  """Runs a LLM macro with user inputs using the async client.
+
+  Like `RunMacro`, it serves calls from `response_log` and `response_cache`.
+  Their file and SQLite I/O runs in threads to keep the event loop free.
+  See `RunMacro` for the arguments and the return value.
+  """
+
+  language = user_inputs.get('language', '')
+  with _MacroRun(macro_id, model_id, language) as run:
+    with _RENDER_SECONDS.Time(macro_id), tracing.Span('render'):
+      prompt = RenderPrompt(macro_id, user_inputs)
+    tracing.Annotate(
+        macro_id=macro_id,
+        model_id=model_id,
+        language=language,
+        prompt_chars=len(prompt))
+    if response_log is not None:
+      return await _RunLoggedAsync(run, macro_id, model_id, prompt, temperature,
+                                   language)
+    sections = COMBINED_MACROS.get(macro_id)
+    if temperature > 0:
+      return run.Finish(await RunGeminiMacroAsync(model_id, prompt, temperature,
+                                                  language, sections))
+
+    cache_key = macro_cache.MakeKey(model_id, prompt, temperature, language)
+    result = None
+    if response_cache.enabled:
+      result = await _CacheCallAsync(response_cache.Get, cache_key)
+    tracing.Annotate(cache='miss' if result is None else 'hit')
+    if result is not None:
+      return run.Finish(result, cached=True)
+
+    return run.Finish(await single_flight.DoAsync(
+        cache_key, lambda: _RunAndCacheAsync(cache_key, model_id, prompt,
+                                             temperature, language, sections)))
+
+
+async def _RunAndCacheAsync(cache_key, model_id, prompt, temperature, language,
+                            sections):
+  """Like `_RunAndCache`, waiting for other workers in threads."""
+  leased = False
+  if _COALESCE_ACROSS_WORKERS:
+    deadline = time.monotonic() + _COALESCE_TIMEOUT_SECONDS
+    while True:
+      leased = await asyncio.to_thread(response_cache.AcquireLease, cache_key,
+                                       _COALESCE_TIMEOUT_SECONDS)
+      remaining = deadline - time.monotonic()
+      if leased or remaining <= 0:
+        break
+      result = await asyncio.to_thread(response_cache.WaitForDisk, cache_key,
+                                       remaining)
+      if result is not None:
+        single_flight.Count('coalesced_across_workers')
+        return result
+  try:
+    result = await RunGeminiMacroAsync(model_id, prompt, temperature, language,
+                                       sections)
+    # Empty responses may be transient, so they are not cached.
+    if result != _EMPTY_RESPONSE:
+      await _CacheCallAsync(response_cache.Put, cache_key, result)
+    return result
+  finally:
+    if leased:
+      await asyncio.to_thread(response_cache.ReleaseLease, cache_key)
+
+
+async def _CacheCallAsync(method, *args):
+  """Calls a `response_cache` method, in a thread if it may use the disk."""
+  if response_cache.disk_path:
+    return await asyncio.to_thread(method, *args)
+  return method(*args)
+
+
+async def _RunLoggedAsync(run, macro_id, model_id, prompt, temperature,
+                          language):
+  """Serves a call from `response_log` like `_RunLogged`, with async I/O."""
+  log = response_log
+  key = macro_cache.MakeKey(macro_id, model_id, prompt, temperature, language)
+  result = log.Get(key)
+  if result is not None:
+    return run.Finish(result, cached=True)
+  if log.replay_only:
+    raise macro_cache.ReplayMissError(
+        f'{macro_id} call not recorded in {log.path}')
+
+  async def RunAndRecord():
+    result = await RunGeminiMacroAsync(model_id, prompt, temperature, language,
+                                       COMBINED_MACROS.get(macro_id))
+    await asyncio.to_thread(
+        log.Append,
+        key,
+        result,
+        macro_id=macro_id,
+        model_id=model_id,
+        temperature=temperature,
+        language=language,
+        prompt=prompt)
+    return result
+
+  return run.Finish(await single_flight.DoAsync(key, RunAndRecord))
+
+
+def StreamMacro(macro_id, user_inputs, temperature, model_id):
+  """Runs a LLM macro with user inputs and yields suggestions one by one.
+
+  Runs like `RunMacro`, with its metrics, tracing and response cache, but
+  streams the model response. At temperature 0, a call of the same prompt in
+  flight is joined instead of calling the model. A stream is cached for
+  `RunMacro` only if it was read to the end, and otherwise under a key of its
+  own including `num`.
+
+  Args:
+    macro_id: Macro ID.
+    user_inputs: Dictionary of user inputs.
+    temperature: Controls the randomness of the output.
+    model_id: The ID of the generative AI model to use.
+
+  Yields:
+    Suggestion texts without index numbers.
+
+  Raises:
+    ValueError: If the macro is a combined macro, whose lists are not
+      streamed.
+  """
+  if macro_id in COMBINED_MACROS:
+    raise ValueError(f'Combined macro {macro_id} cannot be streamed')
+  language = user_inputs.get('language', '')
+  num = int(user_inputs.get('num') or 5)
+  with _MacroRun(macro_id, model_id, language) as run:
+    with _RENDER_SECONDS.Time(macro_id), tracing.Span('render'):
+      prompt = RenderPrompt(macro_id, user_inputs)
+    tracing.Annotate(
+        macro_id=macro_id,
+        model_id=model_id,
+        language=language,
+        prompt_chars=len(prompt))
+    if response_log is not None:
+      result = _RunLogged(run, macro_id, model_id, prompt, temperature,
+                          language)
+      yield from itertools.islice(ParseSuggestions(result), num)
+      return
+    if temperature > 0:
+      result, _ = yield from StreamGeminiMacro(model_id, prompt, temperature,
+                                               language, num)
+      run.Finish(result)
+      return
+
+    cache_key = macro_cache.MakeKey(model_id, prompt, temperature, language)
+    stream_key = macro_cache.MakeKey('stream', model_id, prompt, temperature,
+                                     language, num)
+    result = None
+    if response_cache.enabled:
+      result = response_cache.Get(cache_key) or response_cache.Get(stream_key)
+    tracing.Annotate(cache='miss' if result is None else 'hit')
+    if result is not None:
+      run.Finish(result, cached=True)
+      yield from itertools.islice(ParseSuggestions(result), num)
+      return
+    in_flight = single_flight.Join(cache_key)
+    if in_flight is not None:
+      result = run.Finish(in_flight.result())
+      yield from itertools.islice(ParseSuggestions(result), num)
+      return
 
-  return RunGeminiMacro(model_id, prompt, temperature, language)
+    result, complete = yield from StreamGeminiMacro(model_id, prompt,
+                                                    temperature, language, num)
+    if result != _EMPTY_RESPONSE:
+      response_cache.Put(cache_key if complete else stream_key, result)
+    run.Finish(result)
@@ -0,0 +1,400 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Response cache for LLM macros.
+
+Responses are kept in an in-process LRU with a TTL, optionally backed by a
+SQLite file shared by all workers on the same host. Concurrent identical calls
+are coalesced by `SingleFlight`. `ResponseLog` records responses of whole runs
+to replay them later.
+"""
+
+import asyncio
+import collections
+from concurrent import futures
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Number of puts between purges of expired rows in the disk tier.
+_DISK_PURGE_INTERVAL = 1000
+
+# Interval between disk lookups while waiting for another worker's result.
+_DISK_POLL_INTERVAL_SECONDS = 0.02
+
+
+def MakeKey(*parts):
+  """Returns a stable hash for the given JSON-serializable key parts."""
+  data = json.dumps(parts, ensure_ascii=False, separators=(',', ':'))
+  return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+  """Two-tier LRU/TTL cache of macro responses.
+
+  The in-memory tier is an LRU bounded by `max_entries`. If `disk_path` is
+  given, entries are also written to a SQLite database so that other worker
+  processes can reuse them. Both tiers expire entries after `ttl_seconds`.
+  """
+
+  def __init__(self, max_entries, ttl_seconds, disk_path=None):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.disk_path = disk_path
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._puts = 0
+    self._counters = collections.Counter()
+
+  @property
+  def enabled(self):
+    return self.max_entries > 0 or bool(self.disk_path)
+
+  def Get(self, key):
+    """Returns the cached value for `key` or None."""
+    now = time.time()
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry:
+        expires_at, value = entry
+        if expires_at > now:
+          self._entries.move_to_end(key)
+          self._counters['hits'] += 1
+          return value
+        del self._entries[key]
+        self._counters['expirations'] += 1
+
+    value = self._DiskGet(key, now)
+    with self._lock:
+      if value is None:
+        self._counters['misses'] += 1
+        return None
+      self._counters['disk_hits'] += 1
+      self._MemoryPut(key, value, now)
+    return value
+
+  def Put(self, key, value):
+    """Stores `value` for `key` in both tiers."""
+    now = time.time()
+    with self._lock:
+      self._MemoryPut(key, value, now)
+    self._DiskPut(key, value, now)
+
+  def Stats(self):
+    """Returns a snapshot of cache counters."""
+    with self._lock:
+      stats = {
+          'hits': 0,
+          'disk_hits': 0,
+          'misses': 0,
+          'evictions': 0,
+          'expirations': 0,
+          'disk_errors': 0,
+          **self._counters,
+      }
+      stats['entries'] = len(self._entries)
+    return stats
+
+  def Clear(self):
+    """Drops all in-memory entries and counters."""
+    with self._lock:
+      self._entries.clear()
+      self._counters.clear()
+
+  def _MemoryPut(self, key, value, now):
+    if self.max_entries <= 0:
+      return
+    self._entries[key] = (now + self.ttl_seconds, value)
+    self._entries.move_to_end(key)
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+      self._counters['evictions'] += 1
+
+  def _Connection(self):
+    """Returns a SQLite connection owned by the current thread and process."""
+    connection = getattr(self._local, 'connection', None)
+    if connection and self._local.pid == os.getpid():
+      return connection
+    connection = sqlite3.connect(self.disk_path, timeout=1.0)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                       '(key TEXT PRIMARY KEY, value TEXT, expires_at REAL)')
+    connection.execute('CREATE TABLE IF NOT EXISTS leases '
+                       '(key TEXT PRIMARY KEY, expires_at REAL)')
+    self._local.connection = connection
+    self._local.pid = os.getpid()
+    return connection
+
+  def AcquireLease(self, key, lease_seconds):
+    """Claims `key` for this worker in the disk tier.
+
+    Returns:
+      True if no other worker holds an unexpired lease on `key`, or if there
+      is no disk tier.
+    """
+    if not self.disk_path:
+      return True
+    now = time.time()
+    try:
+      connection = self._Connection()
+      with connection:
+        connection.execute(
+            'DELETE FROM leases WHERE key = ? AND expires_at <= ?', (key, now))
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO leases VALUES (?, ?)',
+            (key, now + lease_seconds))
+      return cursor.rowcount == 1
+    except sqlite3.Error:
+      with self._lock:
+        self._counters['disk_errors'] += 1
+      return True
+
+  def ReleaseLease(self, key):
+    """Releases a lease taken by `AcquireLease`."""
+    if not self.disk_path:
+      return
+    try:
+      connection = self._Connection()
+      with connection:
+        connection.execute('DELETE FROM leases WHERE key = ?', (key,))
+    except sqlite3.Error:
+      with self._lock:
+        self._counters['disk_errors'] += 1
+
+  def WaitForDisk(self, key, timeout_seconds):
+    """Polls the disk tier until `key` is written or the timeout passes.
+
+    Stops early when the lease on `key` is released without a value, e.g.
+    because its holder failed or got an uncacheable response.
+
+    Returns:
+      The value, or None if the lease is gone or the timeout passed.
+    """
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+      now = time.time()
+      value = self._DiskGet(key, now)
+      if value is not None:
+        with self._lock:
+          self._MemoryPut(key, value, now)
+        return value
+      if not self._LeaseHeld(key, now):
+        return None
+      time.sleep(_DISK_POLL_INTERVAL_SECONDS)
+    return None
+
+  def _LeaseHeld(self, key, now):
+    try:
+      row = self._Connection().execute(
+          'SELECT 1 FROM leases WHERE key = ? AND expires_at > ?',
+          (key, now)).fetchone()
+    except sqlite3.Error:
+      with self._lock:
+        self._counters['disk_errors'] += 1
+      return False
+    return row is not None
+
+  def _DiskGet(self, key, now):
+    if not self.disk_path:
+      return None
+    try:
+      row = self._Connection().execute(
+          'SELECT value FROM responses WHERE key = ? AND expires_at > ?',
+          (key, now)).fetchone()
+    except sqlite3.Error:
+      with self._lock:
+        self._counters['disk_errors'] += 1
+      return None
+    return row[0] if row else None
+
+  def _DiskPut(self, key, value, now):
+    if not self.disk_path:
+      return
+    with self._lock:
+      self._puts += 1
+      purge = self._puts % _DISK_PURGE_INTERVAL == 0
+    try:
+      connection = self._Connection()
+      with connection:
+        connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                           (key, value, now + self.ttl_seconds))
+        if purge:
+          connection.execute('DELETE FROM responses WHERE expires_at <= ?',
+                             (now,))
+    except sqlite3.Error:
+      with self._lock:
+        self._counters['disk_errors'] += 1
+
+
+class SingleFlight:
+  """Coalesces concurrent calls with the same key into a single call.
+
+  The first caller for a key runs the function; callers arriving while it is
+  in flight wait for and share its result (or exception).
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+    self._async_calls = {}
+    self._counters = collections.Counter()
+
+  def Do(self, key, fn):
+    """Returns `fn()`, sharing the call with concurrent callers of `key`."""
+    with self._lock:
+      future = self._calls.get(key)
+      leader = future is None
+      if leader:
+        future = futures.Future()
+        self._calls[key] = future
+      else:
+        self._counters['coalesced'] += 1
+    if not leader:
+      return future.result()
+
+    try:
+      result = fn()
+    except BaseException as e:
+      future.set_exception(e)
+      raise
+    else:
+      future.set_result(result)
+      return result
+    finally:
+      with self._lock:
+        del self._calls[key]
+
+  def Join(self, key):
+    """Returns the future of a call of `key` in flight, or None."""
+    with self._lock:
+      future = self._calls.get(key)
+      if future is not None:
+        self._counters['coalesced'] += 1
+      return future
+
+  async def DoAsync(self, key, fn):
+    """Awaits `fn()`, sharing the call with concurrent callers of `key`.
+
+    The call runs in its own task, which is cancelled only when every caller
+    waiting for it has been cancelled.
+    """
+    entry = self._async_calls.get(key)
+    if entry:
+      self.Count('coalesced')
+    else:
+      task = asyncio.get_running_loop().create_task(fn())
+      entry = [task, 0]
+      self._async_calls[key] = entry
+      task.add_done_callback(lambda _: self._ForgetAsyncCall(key, entry))
+    task = entry[0]
+    entry[1] += 1
+    try:
+      return await asyncio.shield(task)
+    finally:
+      entry[1] -= 1
+      if entry[1] == 0 and not task.done():
+        self._ForgetAsyncCall(key, entry)
+        task.cancel()
+
+  def _ForgetAsyncCall(self, key, entry):
+    if self._async_calls.get(key) is entry:
+      del self._async_calls[key]
+
+  def Count(self, name):
+    """Increments a counter, e.g. for calls saved by other means."""
+    with self._lock:
+      self._counters[name] += 1
+
+  def Stats(self):
+    """Returns a snapshot of counters of saved calls."""
+    with self._lock:
+      return {'coalesced': 0, 'coalesced_across_workers': 0, **self._counters}
+
+
+class ReplayMissError(LookupError):
+  """Raised in replay mode when a call has not been recorded."""
+
+
+class ResponseLog:
+  """Append-only log of model responses for recording and replaying runs.
+
+  Each response is appended to a JSONL file as soon as it is received, with
+  its key and the call parameters for inspection. Opening an existing log
+  loads its entries, so a later run can serve the same calls without calling
+  the model. A line left incomplete by an interrupted run is skipped.
+  """
+
+  def __init__(self, path, replay_only=False):
+    """Opens a log.
+
+    Args:
+      path: Path of the JSONL file, created on the first append.
+      replay_only: Whether unrecorded calls fail instead of being recorded.
+    """
+    self.path = path
+    self.replay_only = replay_only
+    self._lock = threading.Lock()
+    self._entries = {}
+    self._counters = collections.Counter()
+    self._truncated = False
+    if os.path.exists(path):
+      with open(path, encoding='utf-8') as f:
+        for line in f:
+          self._truncated = not line.endswith('\n')
+          try:
+            entry = json.loads(line)
+          except json.JSONDecodeError:
+            continue
+          self._entries[entry['key']] = entry['response']
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Get(self, key):
+    """Returns the recorded response for `key`, or None."""
+    response = self._entries.get(key)
+    with self._lock:
+      self._counters['replayed' if response is not None else 'missed'] += 1
+    return response
+
+  def Append(self, key, response, **params):
+    """Records a response.
+
+    Args:
+      key: Key from `MakeKey`.
+      response: The response to record.
+      **params: JSON-serializable call parameters stored along the response.
+    """
+    entry = {'key': key, **params, 'response': response}
+    line = json.dumps(entry, ensure_ascii=False) + '\n'
+    with self._lock:
+      if key in self._entries:
+        return
+      self._entries[key] = response
+      self._counters['recorded'] += 1
+      with open(self.path, 'a', encoding='utf-8') as f:
+        if self._truncated:
+          # Terminate the incomplete line so that this entry stays readable.
+          line = '\n' + line
+          self._truncated = False
+        f.write(line)
+
+  def Stats(self):
+    """Returns a snapshot of counters of recorded and replayed calls."""
+    with self._lock:
+      return {'replayed': 0, 'missed': 0, 'recorded': 0, **self._counters}
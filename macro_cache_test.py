@@ -0,0 +1,238 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the response cache."""
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import macro_cache
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.now = 1000.0
+    patcher = mock.patch.object(
+        macro_cache.time, 'time', side_effect=lambda: self.now)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testEvictsLeastRecentlyUsed(self):
+    cache = macro_cache.ResponseCache(max_entries=2, ttl_seconds=60)
+    cache.Put('a', 'A')
+    cache.Put('b', 'B')
+    self.assertEqual(cache.Get('a'), 'A')
+    cache.Put('c', 'C')
+    self.assertIsNone(cache.Get('b'))
+    self.assertEqual(cache.Get('a'), 'A')
+    self.assertEqual(cache.Get('c'), 'C')
+    self.assertEqual(cache.Stats()['evictions'], 1)
+
+  def testExpiresEntries(self):
+    cache = macro_cache.ResponseCache(max_entries=2, ttl_seconds=60)
+    cache.Put('a', 'A')
+    self.now += 59
+    self.assertEqual(cache.Get('a'), 'A')
+    self.now += 1
+    self.assertIsNone(cache.Get('a'))
+    stats = cache.Stats()
+    self.assertEqual(stats['expirations'], 1)
+    self.assertEqual(stats['entries'], 0)
+
+  def testSharesEntriesThroughDisk(self):
+    disk_path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    writer = macro_cache.ResponseCache(0, 60, disk_path)
+    reader = macro_cache.ResponseCache(2, 60, disk_path)
+    writer.Put('a', 'A')
+    self.assertEqual(reader.Get('a'), 'A')
+    self.assertEqual(reader.Get('a'), 'A')
+    self.assertEqual(reader.Stats()['disk_hits'], 1)
+    self.assertEqual(reader.Stats()['hits'], 1)
+    self.now += 60
+    self.assertIsNone(macro_cache.ResponseCache(2, 60, disk_path).Get('a'))
+
+
+class LeaseTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    disk_path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+    self.holder = macro_cache.ResponseCache(0, 60, disk_path)
+    self.waiter = macro_cache.ResponseCache(2, 60, disk_path)
+
+  def testAcquiresLeaseOnce(self):
+    self.assertTrue(self.holder.AcquireLease('a', 60))
+    self.assertFalse(self.waiter.AcquireLease('a', 60))
+    self.holder.ReleaseLease('a')
+    self.assertTrue(self.waiter.AcquireLease('a', 60))
+
+  def testAcquiresExpiredLease(self):
+    self.assertTrue(self.holder.AcquireLease('a', -1))
+    self.assertTrue(self.waiter.AcquireLease('a', 60))
+
+  def testAlwaysAcquiresWithoutDisk(self):
+    cache = macro_cache.ResponseCache(2, 60)
+    self.assertTrue(cache.AcquireLease('a', 60))
+    self.assertTrue(cache.AcquireLease('a', 60))
+
+  def _ReleaseLater(self, value=None):
+
+    def Release():
+      time.sleep(0.1)
+      if value is not None:
+        self.holder.Put('a', value)
+      self.holder.ReleaseLease('a')
+
+    thread = threading.Thread(target=Release)
+    thread.start()
+    self.addCleanup(thread.join)
+
+  def testWaitsForValueOfLeaseHolder(self):
+    self.holder.AcquireLease('a', 60)
+    self._ReleaseLater('A')
+    self.assertEqual(self.waiter.WaitForDisk('a', 5), 'A')
+    self.assertEqual(self.waiter.Get('a'), 'A')
+    self.assertEqual(self.waiter.Stats()['hits'], 1)
+
+  def testStopsWaitingWhenLeaseIsReleased(self):
+    self.holder.AcquireLease('a', 60)
+    self._ReleaseLater()
+    start = time.monotonic()
+    self.assertIsNone(self.waiter.WaitForDisk('a', 5))
+    self.assertLess(time.monotonic() - start, 1)
+
+  def testStopsWaitingAtTimeout(self):
+    self.holder.AcquireLease('a', 60)
+    self.assertIsNone(self.waiter.WaitForDisk('a', 0.1))
+
+
+class SingleFlightTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.single_flight = macro_cache.SingleFlight()
+
+  def testSharesExceptionWithWaitingCallers(self):
+    started = threading.Event()
+    release = threading.Event()
+
+    def Fail():
+      started.set()
+      release.wait(timeout=2)
+      raise ValueError('failed')
+
+    errors = []
+
+    def Call(fn):
+      try:
+        self.single_flight.Do('a', fn)
+      except ValueError as e:
+        errors.append(e)
+
+    leader = threading.Thread(target=Call, args=(Fail,))
+    leader.start()
+    started.wait(timeout=2)
+    follower = threading.Thread(target=Call, args=(self.fail,))
+    follower.start()
+    while self.single_flight.Stats()['coalesced'] == 0:
+      time.sleep(0.01)
+    release.set()
+    leader.join()
+    follower.join()
+    self.assertEqual(len(errors), 2)
+    self.assertIs(errors[0], errors[1])
+
+  def testRunsAgainAfterCall(self):
+    self.assertEqual(self.single_flight.Do('a', lambda: 1), 1)
+    self.assertEqual(self.single_flight.Do('a', lambda: 2), 2)
+    self.assertIsNone(self.single_flight.Join('a'))
+
+  def testCancelsSharedTaskWithLastCaller(self):
+
+    async def Run():
+      release = asyncio.Event()
+      calls = []
+
+      async def Slow():
+        calls.append(1)
+        await release.wait()
+        return 'done'
+
+      first = asyncio.create_task(self.single_flight.DoAsync('a', Slow))
+      second = asyncio.create_task(self.single_flight.DoAsync('a', Slow))
+      await asyncio.sleep(0)
+      first.cancel()
+      await asyncio.sleep(0)
+      release.set()
+      self.assertEqual(await second, 'done')
+      self.assertEqual(len(calls), 1)
+
+      release.clear()
+      first = asyncio.create_task(self.single_flight.DoAsync('b', Slow))
+      second = asyncio.create_task(self.single_flight.DoAsync('b', Slow))
+      await asyncio.sleep(0)
+      first.cancel()
+      second.cancel()
+      await asyncio.gather(first, second, return_exceptions=True)
+      await asyncio.sleep(0)
+      # The cancelled call is not shared with a later caller.
+      shared = self.single_flight.DoAsync('b', Slow)
+      release.set()
+      self.assertEqual(await shared, 'done')
+      self.assertEqual(len(calls), 3)
+
+    asyncio.run(Run())
+    self.assertEqual(self.single_flight.Stats()['coalesced'], 2)
+
+
+class ResponseLogTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.path = os.path.join(tempfile.mkdtemp(), 'log.jsonl')
+
+  def testReplaysRecordedResponses(self):
+    log = macro_cache.ResponseLog(self.path)
+    log.Append('a', 'A', macro_id='m')
+    log.Append('a', 'other')
+    replay = macro_cache.ResponseLog(self.path, replay_only=True)
+    self.assertEqual(replay.Get('a'), 'A')
+    self.assertIsNone(replay.Get('b'))
+    self.assertEqual(log.Stats()['recorded'], 1)
+    stats = {'replayed': 1, 'missed': 1, 'recorded': 0}
+    self.assertEqual(replay.Stats(), stats)
+
+  def testSkipsTruncatedLastLine(self):
+    log = macro_cache.ResponseLog(self.path)
+    log.Append('a', 'A')
+    with open(self.path, 'a', encoding='utf-8') as f:
+      f.write('{"key": "b", "resp')
+    log = macro_cache.ResponseLog(self.path)
+    self.assertEqual(len(log), 1)
+    self.assertIsNone(log.Get('b'))
+    # Later entries stay readable.
+    log.Append('c', 'C')
+    log = macro_cache.ResponseLog(self.path)
+    self.assertEqual(len(log), 2)
+    self.assertEqual(log.Get('c'), 'C')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,190 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of LLM macros."""
+
+import textwrap
+import unittest
+from unittest import mock
+
+import compaction
+import macro
+
+_TEMPLATE = textwrap.dedent('''\
+    Complete [[text]].
+    #ifdef persona
+    Persona: [[persona]]
+    #ifdef conversationHistory
+    History: [[conversationHistory]]
+    #else
+    No history.
+    #endif
+    #else
+    No persona.
+    #endif
+    Give [[num]] \\
+    suggestions.''')
+
+
+def Render(template, user_inputs):
+  """Renders a template without the macro-specific input handling."""
+  # pylint: disable=protected-access
+  out = []
+  separator = macro._RenderNodes(
+      macro._CompileTemplate(template), user_inputs, out, None)
+  return ''.join(out), separator
+
+
+class RenderTemplateTest(unittest.TestCase):
+
+  user_inputs = {
+      'text': 'I',
+      'persona': 'P',
+      'conversationHistory': 'H',
+      'num': '5',
+  }
+
+  def testNestedConditionals(self):
+    self.assertEqual(
+        Render(_TEMPLATE, self.user_inputs)[0],
+        'Complete I.\nPersona: P\nHistory: H\nGive 5 suggestions.')
+    user_inputs = {**self.user_inputs, 'conversationHistory': None}
+    self.assertEqual(
+        Render(_TEMPLATE, user_inputs)[0],
+        'Complete I.\nPersona: P\nNo history.\nGive 5 suggestions.')
+    user_inputs = {**self.user_inputs, 'persona': None}
+    self.assertEqual(
+        Render(_TEMPLATE, user_inputs)[0],
+        'Complete I.\nNo persona.\nGive 5 suggestions.')
+
+  def testEmptyInputIsUndefined(self):
+    user_inputs = {**self.user_inputs, 'persona': ''}
+    self.assertEqual(
+        Render(_TEMPLATE, user_inputs)[0],
+        'Complete I.\nNo persona.\nGive 5 suggestions.')
+
+  def testContinuationLines(self):
+    self.assertEqual(Render('a \\\nb \\\nc', {}), ('a b c', '\n'))
+
+  def testContinuationAcrossConditional(self):
+    template = 'a \\\n#ifdef x\nx\n#else\ny\n#endif\nz'
+    self.assertEqual(Render(template, {'x': '1'})[0], 'a x\nz')
+    self.assertEqual(Render(template, {})[0], 'a y\nz')
+
+  def testTrailingContinuationIsPending(self):
+    self.assertEqual(Render('a\\', {}), ('a', ''))
+
+  def testKeepsMissingInputsAsPlaceholders(self):
+    self.assertEqual(
+        Render('[[text]] and [[num]]', {'text': 'I'})[0], 'I and [[num]]')
+
+  def testDoesNotSubstituteInsideUserInputs(self):
+    user_inputs = {'text': 'say [[persona]]', 'persona': 'P'}
+    self.assertEqual(
+        Render('[[text]] / [[persona]]', user_inputs)[0], 'say [[persona]] / P')
+
+  def testSkipsCopybaraLines(self):
+    self.assertEqual(Render('a\n#copybara:strip\nb', {})[0], 'a\nb')
+
+  def testRaisesOnUnbalancedDirectives(self):
+    with self.assertRaises(ValueError):
+      Render('#else', {})
+    with self.assertRaises(ValueError):
+      Render('a\n#endif', {})
+
+
+class RenderPromptTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    patcher = mock.patch.object(compaction, 'DEFAULT_TOKEN_BUDGET', 0)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def testRendersTemplateOfMacro(self):
+    with mock.patch.dict(macro.TEMPLATES, {'Test': _TEMPLATE}):
+      prompt = macro.RenderPrompt('Test', {'text': 'I', 'num': '5'})
+    self.assertEqual(prompt, 'Complete I.\nNo persona.\nGive 5 suggestions.')
+
+  def testKeepsLiteralPlaceholderInUserText(self):
+    user_inputs = {'text': 'I said [[persona]]', 'persona': 'P', 'num': '5'}
+    with mock.patch.dict(macro.TEMPLATES, {'Test': _TEMPLATE}):
+      prompt = macro.RenderPrompt('Test', user_inputs)
+    self.assertEqual(
+        prompt, 'Complete I said [[persona]].\nPersona: P\nNo history.\n'
+        'Give 5 suggestions.')
+
+  def testAppendsBackslashOfTrailingContinuation(self):
+    with mock.patch.dict(macro.TEMPLATES, {'Test': '[[text]]\\'}):
+      self.assertEqual(macro.RenderPrompt('Test', {'text': 'I'}), 'I\\')
+
+  def testRendersBuiltInTemplates(self):
+    user_inputs = {
+        'text': 'I',
+        'num': '5',
+        'persona': 'P',
+        'conversationHistory': 'H',
+    }
+    for macro_id in macro.TEMPLATES:
+      with self.subTest(macro_id=macro_id):
+        prompt = macro.RenderPrompt(macro_id, user_inputs)
+        self.assertNotIn('#ifdef', prompt)
+        self.assertNotIn('[[text]]', prompt)
+
+
+class SplitSectionsTest(unittest.TestCase):
+  # pylint: disable=protected-access
+
+  headings = ['Sentences', 'Words']
+
+  def testSplitsListsInOrderOfHeadings(self):
+    text = 'Sure!\nWords:\n1. am\nSentences:\n1. I am\n2. I was'
+    self.assertEqual(
+        macro._SplitSections(text, self.headings),
+        ['1. I am\n2. I was', '1. am'])
+
+  def testMatchesMarkdownHeadingsCaseInsensitively(self):
+    text = '## sentences:\n1. I am\n# WORDS :\n1. am'
+    self.assertEqual(
+        macro._SplitSections(text, self.headings), ['1. I am', '1. am'])
+
+  def testReturnsEmptyMissingList(self):
+    self.assertEqual(
+        macro._SplitSections('Sentences:\n1. I am', self.headings),
+        ['1. I am', ''])
+
+
+class DeriveWordSuggestionsTest(unittest.TestCase):
+
+  def testReturnsNextWords(self):
+    sentences = ['I am here.', 'I was there', 'I am fine', 'I will!']
+    self.assertEqual(
+        macro.DeriveWordSuggestions('I ', sentences, 5), ['am', 'was', 'will'])
+
+  def testCompletesPartialWordWithHyphen(self):
+    sentences = ['He was there', 'Hello there', 'Help me']
+    self.assertEqual(
+        macro.DeriveWordSuggestions('He', sentences, 5), ['was', '-llo', '-lp'])
+
+  def testSkipsSentencesNotStartingWithText(self):
+    sentences = ['You are', 'i am', 'I']
+    self.assertEqual(macro.DeriveWordSuggestions('I ', sentences, 5), ['am'])
+
+  def testReturnsAtMostNum(self):
+    sentences = ['I am', 'I was', 'I will']
+    self.assertEqual(
+        macro.DeriveWordSuggestions('I ', sentences, 2), ['am', 'was'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,6 +14,9 @@
 """The main page of Project VOICE app.
 """
 
+from concurrent import futures
+import contextlib
+import contextvars
 import json
 import os
 
@@ -22,27 +25,330 @@ from flask_cors import CORS
 from flask_seasurf import SeaSurf
 
 import macro
+import metrics
+import sessions
+import tracing
 
 app = flask.Flask(__name__)
 CORS(app)
 csrf = SeaSurf(app)
 app.secret_key = os.environ.get('SECRET_KEY') or 'localkey'
 
+# Executor shared by batch requests to run macros concurrently.
+_macro_executor = futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('MACRO_BATCH_WORKERS', '16')),
+    thread_name_prefix='macro')
+
+# Interval at which a batch request checks whether it has been superseded.
+_STALE_CHECK_INTERVAL_SECONDS = 0.05
+
+sequence_tracker = sessions.SequenceTracker()
+metrics.RegisterCollector('voice_stale_requests_total',
+                          'Requests superseded or abandoned by the client.',
+                          'counter', sequence_tracker.Stats)
+
+# Persona and conversation history registered by clients once per turn. Off
+# unless SESSION_CONTEXT is set, as each worker process keeps its own contexts:
+# requests reaching another worker are resent with the context, unless they
+# share SESSION_CONTEXT_DIR.
+_SESSION_CONTEXT = bool(os.environ.get('SESSION_CONTEXT'))
+context_store = sessions.ContextStore(
+    max_sessions=int(os.environ.get('SESSION_CONTEXT_MAX_SESSIONS', '1000')),
+    disk_dir=os.environ.get('SESSION_CONTEXT_DIR'),
+    disk_ttl_seconds=int(
+        os.environ.get('SESSION_CONTEXT_TTL_SECONDS', '86400')))
+metrics.RegisterCollector('voice_session_context',
+                          'Session context store counters.', 'gauge',
+                          context_store.Stats)
+
+# Recent sentence suggestions of each session, served again while the user
+# types what they predicted. Off unless SUGGESTION_REUSE_MAX_CANDIDATES is set,
+# and SUGGESTION_REUSE_REFRESH also calls the model in the background.
+suggestion_index = sessions.SuggestionIndex(
+    max_candidates=int(os.environ.get('SUGGESTION_REUSE_MAX_CANDIDATES', '0')))
+_REFRESH_REUSED_SUGGESTIONS = bool(os.environ.get('SUGGESTION_REUSE_REFRESH'))
+# Macros whose suggestions are reused.
+_REUSABLE_MACRO_PREFIX = 'Sentence'
+metrics.RegisterCollector('voice_suggestion_reuse',
+                          'Lookups of reusable sentence suggestions.',
+                          'counter', suggestion_index.Stats)
+
+# Answer word macros of `/run-macros` from the sentence suggestions of the
+# same batch, and only call them when too few words come out.
+_DERIVE_WORD_SUGGESTIONS = bool(os.environ.get('DERIVE_WORD_SUGGESTIONS'))
+
 
 @app.route('/')
 def Root():
-  return flask.make_response(flask.render_template('index.jinja'))
+  return flask.make_response(
+      flask.render_template('index.jinja', session_context=_SESSION_CONTEXT))
+
+
+@app.route('/metrics')
+def Metrics():
+  return flask.Response(
+      metrics.ExportText(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/run-macro', methods=['POST'])
 def RunMacro():
+  """Runs a macro.
+
+  With a `session_id` and a `context_version`, `userInputs` may leave out the
+  session context, see `_UserInputs`. An unknown version is answered with
+  412. The response carries a `Server-Timing` header with the durations of the
+  request phases, so that they show up in the browser's developer tools.
+  """
+  request = flask.request
+  with tracing.Start(endpoint='/run-macro') as trace:
+    with tracing.Span('parse'):
+      macro_id = request.form.get('id')
+      temperature = float(request.form.get('temperature'))
+      model_id = request.form.get('model_id')
+      session_id, sequence = _SessionSequence(request.form)
+      try:
+        user_inputs = _UserInputs(request.form, session_id)
+      except sessions.UnknownContextError:
+        return _UnknownContextResponse()
+    if session_id and not sequence_tracker.Begin(session_id, sequence):
+      return _StaleResponse()
+
+    response = flask.make_response(
+        _RunMacro(session_id, macro_id, user_inputs, temperature, model_id))
+  response.headers['Server-Timing'] = trace.ServerTimingHeader()
+  return response
+
+
+def _RunMacro(session_id, macro_id, user_inputs, temperature, model_id):
+  """Runs a macro, reusing earlier suggestions of the session if possible."""
+  if (not session_id or not suggestion_index.enabled or
+      not macro_id.startswith(_REUSABLE_MACRO_PREFIX)):
+    return macro.RunMacro(macro_id, user_inputs, temperature, model_id)
+  context_key = suggestion_index.ContextKey(macro_id, model_id, temperature,
+                                            user_inputs)
+  text = user_inputs.get('text', '')
+  suggestions = suggestion_index.Lookup(session_id, context_key, text,
+                                        int(user_inputs.get('num', 5)))
+  if suggestions is not None:
+    tracing.Annotate(cache='reused')
+    if _REFRESH_REUSED_SUGGESTIONS:
+      _macro_executor.submit(_RunAndIndex, session_id, context_key, macro_id,
+                             user_inputs, temperature, model_id)
+    return macro.FormatSuggestions(suggestions)
+  return _RunAndIndex(session_id, context_key, macro_id, user_inputs,
+                      temperature, model_id)
+
+
+def _RunAndIndex(session_id, context_key, macro_id, user_inputs, temperature,
+                 model_id):
+  result = macro.RunMacro(macro_id, user_inputs, temperature, model_id)
+  suggestion_index.Record(session_id, context_key, user_inputs.get('text', ''),
+                          macro.ParseSuggestions(result))
+  return result
+
+
+def _SessionSequence(form):
+  """Returns the client session ID and request sequence number of a form."""
+  return form.get('session_id'), int(form.get('sequence', 0))
+
+
+def _UserInputs(form, session_id):
+  """Returns the user inputs of a form, merged with the session context.
+
+  A request with a `context_version` field refers to the persona and
+  conversation history of its session instead of including them in
+  `userInputs`. The first request of a version also carries them in a
+  `context` field, and they are stored for the next ones.
+
+  Raises:
+    sessions.UnknownContextError: If the context version is not stored, e.g.
+      after a restart. The client then resends the request with its context.
+  """
+  user_inputs = json.loads(form.get('userInputs'))
+  version = form.get('context_version')
+  if version is None or not session_id:
+    return user_inputs
+  context = context_store.Resolve(session_id, int(version), form.get('context'))
+  return {**context, **user_inputs}
+
+
+def _StaleResponse():
+  return flask.Response(
+      json.dumps({'error': 'Superseded by a newer request'}),
+      status=409,
+      mimetype='application/json')
+
+
+def _UnknownContextResponse():
+  return flask.Response(
+      json.dumps({'error': 'Unknown context version'}),
+      status=412,
+      mimetype='application/json')
+
+
+@app.route('/run-macro-stream', methods=['POST'])
+def RunMacroStream():
+  """Streams suggestions of a macro as Server-Sent Events.
+
+  Takes the same form fields as `/run-macro`. Each suggestion is sent as a
+  `suggestion` event with `{"index": i, "text": ...}` data as soon as its
+  numbered line is complete, followed by a `done` event. Failures are reported
+  as an `error` event. The frontend does not use it yet.
+  """
   request = flask.request
   macro_id = request.form.get('id')
-  user_inputs = json.loads(request.form.get('userInputs'))
   temperature = float(request.form.get('temperature'))
   model_id = request.form.get('model_id')
+  session_id, sequence = _SessionSequence(request.form)
+  try:
+    user_inputs = _UserInputs(request.form, session_id)
+  except sessions.UnknownContextError:
+    return _UnknownContextResponse()
+  if session_id and not sequence_tracker.Begin(session_id, sequence):
+    return _StaleResponse()
+
+  def Events():
+    # Closing the suggestions closes the upstream stream, which happens when
+    # the client disconnects or a newer request supersedes this one.
+    try:
+      with tracing.Start(endpoint='/run-macro-stream'):
+        with contextlib.closing(
+            macro.StreamMacro(macro_id, user_inputs, temperature,
+                              model_id)) as suggestions:
+          for index, text in enumerate(suggestions):
+            if session_id and sequence_tracker.IsStale(session_id, sequence):
+              sequence_tracker.Count('cancelled_in_flight')
+              return
+            yield _ServerSentEvent('suggestion', {'index': index, 'text': text})
+    except GeneratorExit:
+      sequence_tracker.Count('disconnected')
+      raise
+    except Exception as e:  # pylint: disable=broad-exception-caught
+      app.logger.exception('Streaming macro %s failed', macro_id)
+      yield _ServerSentEvent('error', {'error': f'{type(e).__name__}: {e}'})
+      return
+    yield _ServerSentEvent('done', {})
+
+  return flask.Response(
+      flask.stream_with_context(Events()),
+      mimetype='text/event-stream',
+      headers={
+          'Cache-Control': 'no-cache',
+          # Disable response buffering on nginx-based proxies.
+          'X-Accel-Buffering': 'no',
+      })
+
+
+def _ServerSentEvent(event, data):
+  return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+@app.route('/run-macros', methods=['POST'])
+def RunMacros():
+  """Runs several macros sharing one set of user inputs.
+
+  Like `/run-macro`, it accepts a `context_version`, and optionally a
+  `context`, instead of the persona and history in `userInputs`.
+
+  The `macros` form field is a JSON list of objects with an `id` and optional
+  `temperature` and `model_id` overriding the request-wide values. Results are
+  returned in the same order. A failing macro yields an `error` entry instead
+  of failing the whole batch. Phases in the `Server-Timing` header are
+  prefixed with the index of their macro, e.g. `0.render`.
+
+  With DERIVE_WORD_SUGGESTIONS set, word macros wait for the sentence macro
+  of the batch and take the next words of its suggestions, see
+  `macro.DeriveWordResult`.
+  """
+  request = flask.request
+  with tracing.Start(endpoint='/run-macros') as trace:
+    with tracing.Span('parse'):
+      invocations = json.loads(request.form.get('macros'))
+      temperature = float(request.form.get('temperature', 0))
+      model_id = request.form.get('model_id')
+      session_id, sequence = _SessionSequence(request.form)
+      try:
+        user_inputs = _UserInputs(request.form, session_id)
+      except sessions.UnknownContextError:
+        return _UnknownContextResponse()
+    if session_id and not sequence_tracker.Begin(session_id, sequence):
+      return _StaleResponse()
+
+    def IsStale():
+      return bool(session_id) and sequence_tracker.IsStale(session_id, sequence)
+
+    def Submit(index):
+      # Each macro runs in a copy of the request context to record its phases
+      # in the request trace.
+      return _macro_executor.submit(contextvars.copy_context().run,
+                                    _RunInvocation, index, invocations[index],
+                                    user_inputs, temperature, model_id,
+                                    session_id, IsStale)
+
+    derived = {}
+    if _DERIVE_WORD_SUGGESTIONS:
+      derived = macro.DerivableWordSources(
+          [invocation.get('id', '') for invocation in invocations],
+          user_inputs.get('language'))
+    pending = {
+        index: Submit(index)
+        for index in range(len(invocations))
+        if index not in derived
+    }
+    if not _WaitForBatch(pending.values(), IsStale):
+      return _StaleResponse()
+    for index, sentence_index in derived.items():
+      sentence_future = pending[sentence_index]
+      result = None
+      if not sentence_future.exception():
+        result = macro.DeriveWordResult(invocations[index]['id'], user_inputs,
+                                        sentence_future.result())
+      if result is None:
+        pending[index] = Submit(index)
+      else:
+        tracing.Annotate(**{f'{index}.cache': 'derived'})
+        pending[index] = futures.Future()
+        pending[index].set_result(result)
+    if derived and not _WaitForBatch(pending.values(), IsStale):
+      return _StaleResponse()
+
+    results = []
+    for _, future in sorted(pending.items()):
+      try:
+        results.append(json.loads(future.result()))
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        app.logger.exception('Macro in batch failed')
+        results.append({'error': f'{type(e).__name__}: {e}'})
+  return flask.Response(
+      json.dumps({'results': results}, ensure_ascii=False),
+      mimetype='application/json',
+      headers={'Server-Timing': trace.ServerTimingHeader()})
+
+
+def _WaitForBatch(pending, is_stale):
+  """Waits for macros, returning False as soon as the request is stale.
+
+  Queued macros of a stale request are cancelled, while running ones finish
+  in the background.
+  """
+  while futures.wait(pending, timeout=_STALE_CHECK_INTERVAL_SECONDS).not_done:
+    if is_stale():
+      not_cancelled = [future for future in pending if not future.cancel()]
+      if any(not future.done() for future in not_cancelled):
+        sequence_tracker.Count('abandoned_in_flight')
+      return False
+  return True
+
 
-  return macro.RunMacro(macro_id, user_inputs, temperature, model_id)
+def _RunInvocation(index, invocation, user_inputs, temperature, model_id,
+                   session_id, is_stale):
+  tracing.SetPrefix(f'{index}.')
+  if is_stale():
+    sequence_tracker.Count('skipped_before_upstream')
+    raise sessions.StaleRequestError()
+  return _RunMacro(session_id, invocation['id'], user_inputs,
+                   float(invocation.get('temperature', temperature)),
+                   invocation.get('model_id', model_id))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,302 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""The async (ASGI) serving mode of Project VOICE app.
+
+Serves the same endpoints as `main.py`, but Gemini calls are awaited on the
+async client so that a single worker can hold many upstream calls at once.
+
+Usage:
+  $ pip install -r requirements-async.txt
+  $ uvicorn main_async:app --workers 2
+"""
+
+import asyncio
+import contextlib
+import hmac
+import json
+import os
+import secrets
+import urllib.parse
+
+import quart
+import quart_cors
+
+import macro
+import metrics
+import sessions
+import tracing
+
+app = quart_cors.cors(quart.Quart(__name__))
+app.secret_key = os.environ.get('SECRET_KEY') or 'localkey'
+
+# Same name as the token used by SeaSurf in `main.py`, so the frontend posts
+# it unchanged.
+_CSRF_NAME = '_csrf_token'
+_CSRF_HEADER_NAME = 'X-CSRFToken'
+_CSRF_SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+sequence_tracker = sessions.SequenceTracker()
+metrics.RegisterCollector('voice_stale_requests_total',
+                          'Requests superseded or abandoned by the client.',
+                          'counter', sequence_tracker.Stats)
+
+# See `main.context_store`.
+_SESSION_CONTEXT = bool(os.environ.get('SESSION_CONTEXT'))
+context_store = sessions.ContextStore(
+    max_sessions=int(os.environ.get('SESSION_CONTEXT_MAX_SESSIONS', '1000')),
+    disk_dir=os.environ.get('SESSION_CONTEXT_DIR'),
+    disk_ttl_seconds=int(
+        os.environ.get('SESSION_CONTEXT_TTL_SECONDS', '86400')))
+metrics.RegisterCollector('voice_session_context',
+                          'Session context store counters.', 'gauge',
+                          context_store.Stats)
+
+# See `main.suggestion_index`.
+suggestion_index = sessions.SuggestionIndex(
+    max_candidates=int(os.environ.get('SUGGESTION_REUSE_MAX_CANDIDATES', '0')))
+_REFRESH_REUSED_SUGGESTIONS = bool(os.environ.get('SUGGESTION_REUSE_REFRESH'))
+_REUSABLE_MACRO_PREFIX = 'Sentence'
+metrics.RegisterCollector('voice_suggestion_reuse',
+                          'Lookups of reusable sentence suggestions.',
+                          'counter', suggestion_index.Stats)
+# Background refreshes, referenced until they finish.
+_refresh_tasks = set()
+
+# See `main.RunMacros`.
+_DERIVE_WORD_SUGGESTIONS = bool(os.environ.get('DERIVE_WORD_SUGGESTIONS'))
+
+
+def _CsrfToken():
+  """Returns the CSRF token of the session, creating one if needed."""
+  token = quart.session.get(_CSRF_NAME)
+  if not token:
+    token = secrets.token_hex(20)
+    quart.session[_CSRF_NAME] = token
+  return token
+
+
+app.jinja_env.globals['csrf_token'] = _CsrfToken
+
+
+def _SameOrigin(url1, url2):
+  parsed1 = urllib.parse.urlparse(url1)
+  parsed2 = urllib.parse.urlparse(url2)
+  return (parsed1.scheme, parsed1.netloc) == (parsed2.scheme, parsed2.netloc)
+
+
+@app.before_request
+async def _CheckCsrf():
+  """Validates the CSRF token like SeaSurf does for the sync app."""
+  request = quart.request
+  if request.method in _CSRF_SAFE_METHODS:
+    return
+  if request.scheme == 'https':
+    referer = request.headers.get('Referer')
+    allowed = request.headers.get('Origin') or request.url_root
+    if not referer or not _SameOrigin(referer, allowed):
+      quart.abort(403)
+  server_token = quart.session.get(_CSRF_NAME)
+  request_token = ((await request.form).get(_CSRF_NAME) or
+                   request.headers.get(_CSRF_HEADER_NAME, ''))
+  if not server_token or not hmac.compare_digest(request_token, server_token):
+    quart.abort(403)
+
+
+@app.route('/')
+async def Root():
+  return await quart.make_response(await quart.render_template(
+      'index.jinja', session_context=_SESSION_CONTEXT))
+
+
+@app.route('/metrics')
+async def Metrics():
+  return quart.Response(
+      metrics.ExportText(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/run-macro', methods=['POST'])
+async def RunMacro():
+  """Runs a macro. See `main.RunMacro`."""
+  form = await quart.request.form
+  with tracing.Start(endpoint='/run-macro') as trace:
+    with tracing.Span('parse'):
+      macro_id = form.get('id')
+      user_inputs = _UserInputs(form)
+      temperature = float(form.get('temperature'))
+      model_id = form.get('model_id')
+
+    async with _TrackRequest(form):
+      result = await _RunMacro(
+          form.get('session_id'), macro_id, user_inputs, temperature, model_id)
+  response = await quart.make_response(result)
+  response.headers['Server-Timing'] = trace.ServerTimingHeader()
+  return response
+
+
+def _UserInputs(form):
+  """Returns the user inputs merged with the session context.
+
+  See `main._UserInputs`. Aborts with 412 if the context version is unknown.
+  """
+  user_inputs = json.loads(form.get('userInputs'))
+  session_id = form.get('session_id')
+  version = form.get('context_version')
+  if version is None or not session_id:
+    return user_inputs
+  try:
+    context = context_store.Resolve(session_id, int(version),
+                                    form.get('context'))
+  except sessions.UnknownContextError:
+    quart.abort(412, 'Unknown context version')
+  return {**context, **user_inputs}
+
+
+@contextlib.asynccontextmanager
+async def _TrackRequest(form):
+  """Cancels the request when it is superseded or the client disconnects.
+
+  The current task is registered with the sequence tracker, which cancels it
+  once a newer request of the same session arrives. Quart also cancels it when
+  the client disconnects. Cancellation aborts the upstream Gemini call, and
+  the client, which has already aborted its fetch, gets no response.
+  """
+  session_id = form.get('session_id')
+  sequence = int(form.get('sequence', 0))
+  task = asyncio.current_task()
+  if session_id and not sequence_tracker.Begin(session_id, sequence, task):
+    quart.abort(409, 'Superseded by a newer request')
+  try:
+    yield
+  except asyncio.CancelledError:
+    if session_id and sequence_tracker.IsStale(session_id, sequence):
+      sequence_tracker.Count('cancelled_in_flight')
+    else:
+      sequence_tracker.Count('disconnected')
+    raise
+  finally:
+    if session_id:
+      sequence_tracker.End(session_id, task)
+
+
+@app.route('/run-macros', methods=['POST'])
+async def RunMacros():
+  """Runs several macros concurrently. See `main.RunMacros`."""
+  form = await quart.request.form
+  with tracing.Start(endpoint='/run-macros') as trace:
+    with tracing.Span('parse'):
+      invocations = json.loads(form.get('macros'))
+      user_inputs = _UserInputs(form)
+      temperature = float(form.get('temperature', 0))
+      model_id = form.get('model_id')
+
+    async with _TrackRequest(form):
+      derived = {}
+      if _DERIVE_WORD_SUGGESTIONS:
+        derived = macro.DerivableWordSources(
+            [invocation.get('id', '') for invocation in invocations],
+            user_inputs.get('language'))
+      tasks = {
+          index:
+              asyncio.ensure_future(
+                  _RunInvocation(index, invocation, user_inputs, temperature,
+                                 model_id, form.get('session_id')))
+          for index, invocation in enumerate(invocations)
+          if index not in derived
+      }
+      for index, sentence_index in derived.items():
+        tasks[index] = asyncio.ensure_future(
+            _DeriveInvocation(index, invocations[index], tasks[sentence_index],
+                              user_inputs, temperature, model_id,
+                              form.get('session_id')))
+      outcomes = await asyncio.gather(
+          *(tasks[index] for index in range(len(invocations))),
+          return_exceptions=True)
+  results = []
+  for outcome in outcomes:
+    if isinstance(outcome, Exception):
+      app.logger.error('Macro in batch failed', exc_info=outcome)
+      results.append({'error': f'{type(outcome).__name__}: {outcome}'})
+    else:
+      results.append(json.loads(outcome))
+  return quart.Response(
+      json.dumps({'results': results}, ensure_ascii=False),
+      mimetype='application/json',
+      headers={'Server-Timing': trace.ServerTimingHeader()})
+
+
+async def _RunInvocation(index, invocation, user_inputs, temperature, model_id,
+                         session_id):
+  # Runs in its own task, so the prefix does not leak into other macros.
+  tracing.SetPrefix(f'{index}.')
+  return await _RunMacro(session_id, invocation['id'], user_inputs,
+                         float(invocation.get('temperature', temperature)),
+                         invocation.get('model_id', model_id))
+
+
+async def _DeriveInvocation(index, invocation, sentence_task, user_inputs,
+                            temperature, model_id, session_id):
+  """Derives a word macro result from the sentence macro, or runs it."""
+  try:
+    sentence_result = await sentence_task
+  except Exception:  # pylint: disable=broad-exception-caught
+    # Reported in the result of the sentence macro.
+    sentence_result = None
+  result = None
+  if sentence_result is not None:
+    result = macro.DeriveWordResult(invocation['id'], user_inputs,
+                                    sentence_result)
+  if result is None:
+    return await _RunInvocation(index, invocation, user_inputs, temperature,
+                                model_id, session_id)
+  tracing.SetPrefix(f'{index}.')
+  tracing.Annotate(cache='derived')
+  return result
+
+
+async def _RunMacro(session_id, macro_id, user_inputs, temperature, model_id):
+  """Runs a macro, reusing earlier suggestions. See `main._RunMacro`."""
+  if (not session_id or not suggestion_index.enabled or
+      not macro_id.startswith(_REUSABLE_MACRO_PREFIX)):
+    return await macro.RunMacroAsync(macro_id, user_inputs, temperature,
+                                     model_id)
+  context_key = suggestion_index.ContextKey(macro_id, model_id, temperature,
+                                            user_inputs)
+  suggestions = suggestion_index.Lookup(session_id, context_key,
+                                        user_inputs.get('text', ''),
+                                        int(user_inputs.get('num', 5)))
+  if suggestions is not None:
+    tracing.Annotate(cache='reused')
+    if _REFRESH_REUSED_SUGGESTIONS:
+      # Not cancelled with the request, so that the refresh completes.
+      task = asyncio.create_task(
+          _RunAndIndex(session_id, context_key, macro_id, user_inputs,
+                       temperature, model_id))
+      _refresh_tasks.add(task)
+      task.add_done_callback(_refresh_tasks.discard)
+    return macro.FormatSuggestions(suggestions)
+  return await _RunAndIndex(session_id, context_key, macro_id, user_inputs,
+                            temperature, model_id)
+
+
+async def _RunAndIndex(session_id, context_key, macro_id, user_inputs,
+                       temperature, model_id):
+  result = await macro.RunMacroAsync(macro_id, user_inputs, temperature,
+                                     model_id)
+  suggestion_index.Record(session_id, context_key, user_inputs.get('text', ''),
+                          macro.ParseSuggestions(result))
+  return result
+
+
+if __name__ == '__main__':
+  app.run(debug=True, host=os.environ.get('FLASK_HOST', '127.0.0.1'))
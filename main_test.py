@@ -0,0 +1,202 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of the sync app."""
+
+from concurrent import futures
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+import macro
+import main
+
+
+class RunMacrosTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    main.csrf._csrf_disable = True  # pylint: disable=protected-access
+    self.client = main.app.test_client()
+    self.release = threading.Event()
+    self.addCleanup(self.release.set)
+
+  def _FakeRunMacro(self, macro_id, user_inputs, temperature, model_id):
+    del user_inputs, temperature, model_id  # Unused.
+    if macro_id.startswith('Sentence'):
+      # A slow sentence macro, still running when the request is superseded.
+      self.release.wait(timeout=2)
+    return macro.FormatSuggestions([macro_id])
+
+  def _Supersede(self, macros):
+    """Posts a batch, supersedes it after 0.3 s and returns the response."""
+    session_id = f'session-{time.time()}'
+    form = {
+        'macros': json.dumps(macros),
+        'userInputs': json.dumps({
+            'language': 'English',
+            'text': 'I'
+        }),
+        'temperature': '0',
+        'model_id': 'model',
+        'session_id': session_id,
+        'sequence': '1',
+    }
+    response = {}
+
+    def Post():
+      response['value'] = self.client.post('/run-macros', data=form)
+
+    with mock.patch.object(macro, 'RunMacro', self._FakeRunMacro):
+      thread = threading.Thread(target=Post)
+      start = time.monotonic()
+      thread.start()
+      time.sleep(0.3)
+      # A newer request of the same session arrives.
+      self.assertTrue(main.sequence_tracker.Begin(session_id, 2))
+      thread.join(timeout=1.5)
+      elapsed = time.monotonic() - start
+
+    self.assertFalse(thread.is_alive())
+    self.assertLess(elapsed, 1.5)
+    return response['value']
+
+  def testSupersededBatchReturnsWhileMacroIsRunning(self):
+    abandoned = main.sequence_tracker.Stats().get('abandoned_in_flight', 0)
+    macros = [{'id': 'SentenceGeneric20250311'}, {'id': 'WordGeneric20240628'}]
+    response = self._Supersede(macros)
+    self.assertEqual(response.status_code, 409)
+    self.assertEqual(
+        main.sequence_tracker.Stats().get('abandoned_in_flight', 0),
+        abandoned + 1)
+
+  def testSupersededBatchCancelsEveryQueuedMacro(self):
+    executor = futures.ThreadPoolExecutor(max_workers=1)
+    macros = [{'id': 'SentenceGeneric20250311'}] * 3
+    # pylint: disable-next=protected-access
+    run_invocation = mock.Mock(wraps=main._RunInvocation)
+    with mock.patch.multiple(
+        main, _macro_executor=executor, _RunInvocation=run_invocation):
+      response = self._Supersede(macros)
+      self.release.set()
+      executor.shutdown(wait=True)
+    self.assertEqual(response.status_code, 409)
+    # Only the running macro was started, the queued ones were cancelled.
+    self.assertEqual(run_invocation.call_count, 1)
+
+
+class RunMacroTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    main.csrf._csrf_disable = True  # pylint: disable=protected-access
+    self.client = main.app.test_client()
+
+  def testUnknownContextVersionGets412(self):
+    form = {
+        'id': 'SentenceGeneric20250311',
+        'userInputs': json.dumps({'text': 'I'}),
+        'temperature': '0',
+        'model_id': 'model',
+        'session_id': f'session-{time.time()}',
+        'sequence': '1',
+        'context_version': '1',
+    }
+    response = self.client.post('/run-macro', data=form)
+    self.assertEqual(response.status_code, 412)
+
+
+class DeriveWordsTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    main.csrf._csrf_disable = True  # pylint: disable=protected-access
+    self.client = main.app.test_client()
+
+  def testInvocationWithoutIdFailsAlone(self):
+    macros = [{'id': 'SentenceGeneric20250311'}, {}]
+    user_inputs = {'language': 'English', 'text': 'I'}
+    form = {
+        'macros': json.dumps(macros),
+        'userInputs': json.dumps(user_inputs),
+        'temperature': '0',
+        'model_id': 'model',
+    }
+
+    def FakeRunMacro(*unused_args):
+      return macro.FormatSuggestions(['I am'])
+
+    with mock.patch.object(main, '_DERIVE_WORD_SUGGESTIONS', True), \
+        mock.patch.object(macro, 'RunMacro', FakeRunMacro):
+      response = self.client.post('/run-macros', data=form)
+    self.assertEqual(response.status_code, 200)
+    results = response.get_json()['results']
+    self.assertIn('messages', results[0])
+    self.assertIn('error', results[1])
+
+  def _RunBatch(self, sentences):
+    """Runs a batch whose macros finish in reverse order, returns suggestions.
+
+    The sentence macro returns `sentences`, and other macros return their ID.
+    """
+    macros = [
+        {
+            'id': 'WordGeneric20240628'
+        },
+        {
+            'id': 'SentenceGeneric20250311'
+        },
+        {
+            'id': 'Other'
+        },
+    ]
+    user_inputs = {'language': 'English', 'text': 'I'}
+    form = {
+        'macros': json.dumps(macros),
+        'userInputs': json.dumps(user_inputs),
+        'temperature': '0',
+        'model_id': 'model',
+    }
+
+    def FakeRunMacro(macro_id, *unused_args):
+      if macro_id.startswith('Sentence'):
+        time.sleep(0.1)
+        return macro.FormatSuggestions(sentences)
+      return macro.FormatSuggestions([macro_id])
+
+    with mock.patch.object(main, '_DERIVE_WORD_SUGGESTIONS', True), \
+        mock.patch.object(macro, 'RunMacro', FakeRunMacro):
+      response = self.client.post('/run-macros', data=form)
+    self.assertEqual(response.status_code, 200)
+    return [
+        macro.ParseSuggestions(json.dumps(result))
+        for result in response.get_json()['results']
+    ]
+
+  def testReturnsDerivedWordsInOrder(self):
+    sentences = ['I am', 'I was', 'I will']
+    self.assertEqual(
+        self._RunBatch(sentences),
+        [['am', 'was', 'will'], sentences, ['Other']])
+
+  def testReturnsWordMacroRunAfterSentenceInOrder(self):
+    # Too few words to derive, so the word macro runs last.
+    self.assertEqual(
+        self._RunBatch(['I am']),
+        [['WordGeneric20240628'], ['I am'], ['Other']])
+
+
+if __name__ == '__main__':
+  unittest.main()
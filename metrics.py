@@ -0,0 +1,182 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Minimal Prometheus-style metrics.
+
+Each thread records into its own shard, so recording on the hot path takes no
+lock. Shards are merged only when metrics are exported. Metrics are per
+process, so with several gunicorn workers each scrape reports the values of
+the worker that served it.
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+# Latency buckets in seconds, from sub-millisecond template rendering up to
+# slow upstream calls.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_collectors = []
+
+
+class _Metric:
+  """Base class of metrics with per-thread shards."""
+
+  kind = ''
+
+  def __init__(self, name, documentation, label_names):
+    self.name = name
+    self.documentation = documentation
+    self.label_names = tuple(label_names)
+    self._local = threading.local()
+    self._shards = []
+    self._shards_lock = threading.Lock()
+    _registry.append(self)
+
+  def _Shard(self):
+    shard = getattr(self._local, 'shard', None)
+    if shard is None:
+      shard = {}
+      self._local.shard = shard
+      with self._shards_lock:
+        self._shards.append(shard)
+    return shard
+
+  def _Snapshots(self):
+    with self._shards_lock:
+      shards = list(self._shards)
+    return [list(shard.items()) for shard in shards]
+
+  def _Labels(self, values, extra=()):
+    pairs = list(zip(self.label_names, values)) + list(extra)
+    return ','.join(f'{k}="{_Escape(v)}"' for k, v in pairs)
+
+
+class Counter(_Metric):
+  """A monotonically increasing counter."""
+
+  kind = 'counter'
+
+  def Inc(self, *label_values, amount=1):
+    shard = self._Shard()
+    shard[label_values] = shard.get(label_values, 0) + amount
+
+  def Values(self):
+    """Returns totals merged across threads, keyed by label values."""
+    totals = collections.Counter()
+    for snapshot in self._Snapshots():
+      for labels, value in snapshot:
+        totals[labels] += value
+    return dict(totals)
+
+  def Export(self):
+    return [
+        f'{self.name}{{{self._Labels(labels)}}} {value}'
+        for labels, value in sorted(self.Values().items())
+    ]
+
+
+class Histogram(_Metric):
+  """A histogram of observed values with cumulative buckets."""
+
+  kind = 'histogram'
+
+  def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS):
+    super().__init__(name, documentation, label_names)
+    self.buckets = tuple(buckets)
+
+  def Observe(self, value, *label_values):
+    shard = self._Shard()
+    state = shard.get(label_values)
+    if state is None:
+      # Bucket counts, then the +Inf bucket, sum and count.
+      state = [0] * (len(self.buckets) + 1) + [0.0, 0]
+      shard[label_values] = state
+    state[bisect.bisect_left(self.buckets, value)] += 1
+    state[-2] += value
+    state[-1] += 1
+
+  def Time(self, *label_values):
+    """Returns a context manager observing the elapsed time of its body."""
+    return _Timer(self, label_values)
+
+  def Export(self):
+    merged = {}
+    for snapshot in self._Snapshots():
+      for labels, state in snapshot:
+        total = merged.setdefault(labels, [0] * len(state))
+        for i, value in enumerate(list(state)):
+          total[i] += value
+    lines = []
+    for labels, state in sorted(merged.items()):
+      cumulative = 0
+      for bound, count in zip(self.buckets + ('+Inf',), state):
+        cumulative += count
+        label_text = self._Labels(labels, [('le', bound)])
+        lines.append(f'{self.name}_bucket{{{label_text}}} {cumulative}')
+      lines.append(f'{self.name}_sum{{{self._Labels(labels)}}} {state[-2]}')
+      lines.append(f'{self.name}_count{{{self._Labels(labels)}}} {state[-1]}')
+    return lines
+
+
+class _Timer:
+
+  def __init__(self, histogram, label_values):
+    self._histogram = histogram
+    self._label_values = label_values
+    self._start = 0.0
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self._histogram.Observe(time.perf_counter() - self._start,
+                            *self._label_values)
+
+
+def RegisterCollector(name, documentation, kind, collect):
+  """Registers a callback exported on scrape.
+
+  Args:
+    name: Metric name.
+    documentation: Help text of the metric.
+    kind: Prometheus metric type, e.g. 'counter' or 'gauge'.
+    collect: A function returning a dict of values, each exported with its
+      dict key as the `key` label.
+  """
+  _collectors.append((name, documentation, kind, collect))
+
+
+def _Escape(value):
+  value = str(value).replace('\\', '\\\\')
+  return value.replace('"', '\\"').replace('\n', '\\n')
+
+
+def ExportText():
+  """Returns all metrics in the Prometheus text exposition format."""
+  lines = []
+  for metric in _registry:
+    lines.append(f'# HELP {metric.name} {metric.documentation}')
+    lines.append(f'# TYPE {metric.name} {metric.kind}')
+    lines.extend(metric.Export())
+  for name, documentation, kind, collect in _collectors:
+    lines.append(f'# HELP {name} {documentation}')
+    lines.append(f'# TYPE {name} {kind}')
+    for key, value in sorted(collect().items()):
+      lines.append(f'{name}{{key="{_Escape(key)}"}} {value}')
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,151 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Client-side rate limiting of model calls.
+
+Used by batch tools that call the model from many threads, so that they stay
+within the requests per minute (RPM) and tokens per minute (TPM) quotas of the
+API instead of failing with 429 errors.
+"""
+
+import random
+import threading
+import time
+
+# Seconds of quota that may be spent in a burst.
+_BURST_SECONDS = 10
+
+
+class _TokenBucket:
+  """A bucket refilled at `rate` per second up to `capacity`."""
+
+  def __init__(self, per_minute):
+    self.rate = per_minute / 60
+    self.capacity = self.rate * _BURST_SECONDS
+    self.level = self.capacity
+
+  def Refill(self, elapsed, factor):
+    self.level = min(self.capacity, self.level + elapsed * self.rate * factor)
+
+  def Wait(self, amount, factor):
+    """Returns seconds until `amount` can be taken, capped at the capacity."""
+    missing = min(amount, self.capacity) - self.level
+    return max(0.0, missing / (self.rate * factor))
+
+
+class RateLimiter:
+  """Shared RPM and TPM token buckets with adaptive backoff on 429 errors.
+
+  Each call takes one request and its estimated tokens from the buckets,
+  waiting until they are available. The estimate is corrected with the actual
+  token count once the call returns. When the API still answers 429, the
+  refill rate is halved and the call is retried after an exponential backoff;
+  successful calls restore the rate gradually.
+  """
+
+  def __init__(self,
+               requests_per_minute=None,
+               tokens_per_minute=None,
+               max_retries=6,
+               backoff_seconds=1.0):
+    """Creates a limiter.
+
+    Args:
+      requests_per_minute: Request quota, or None for no limit.
+      tokens_per_minute: Token quota, or None for no limit.
+      max_retries: Retries of a call failing with 429 before giving up.
+      backoff_seconds: Delay before the first retry, doubled on each retry.
+    """
+    self._requests = (
+        _TokenBucket(requests_per_minute) if requests_per_minute else None)
+    self._tokens = (
+        _TokenBucket(tokens_per_minute) if tokens_per_minute else None)
+    self.max_retries = max_retries
+    self.backoff_seconds = backoff_seconds
+    # Fraction of the quota currently used, lowered on 429 errors.
+    self._factor = 1.0
+    self._lock = threading.Lock()
+    self._last_refill = time.monotonic()
+    self.rate_limited_count = 0
+
+  def Acquire(self, tokens):
+    """Blocks until a request with `tokens` tokens fits in the quota."""
+    while True:
+      with self._lock:
+        self._Refill()
+        wait = 0.0
+        if self._requests:
+          wait = self._requests.Wait(1, self._factor)
+        if self._tokens:
+          wait = max(wait, self._tokens.Wait(tokens, self._factor))
+        if wait == 0:
+          if self._requests:
+            self._requests.level -= 1
+          if self._tokens:
+            self._tokens.level -= tokens
+          return
+      time.sleep(wait)
+
+  def Adjust(self, tokens):
+    """Charges `tokens` more (or fewer if negative) to the token bucket."""
+    if self._tokens:
+      with self._lock:
+        self._Refill()
+        self._tokens.level -= tokens
+
+  def Call(self, fn, tokens, count_tokens=None):
+    """Calls `fn` within the quota, retrying it on 429 errors.
+
+    Args:
+      fn: The function calling the model.
+      tokens: Estimated number of tokens of the call.
+      count_tokens: Optional function returning the actual number of tokens
+        from the result of `fn`, or None if unknown.
+
+    Returns:
+      The result of `fn`.
+    """
+    for attempt in range(self.max_retries + 1):
+      self.Acquire(tokens)
+      try:
+        result = fn()
+      except Exception as e:  # pylint: disable=broad-exception-caught
+        if getattr(e, 'code', None) != 429 or attempt == self.max_retries:
+          raise
+        self._Throttle()
+        delay = self.backoff_seconds * 2**attempt
+        time.sleep(delay * random.uniform(0.5, 1.5))
+        continue
+      self._Recover()
+      actual = count_tokens(result) if count_tokens else None
+      if actual is not None:
+        self.Adjust(actual - tokens)
+      return result
+
+  def _Refill(self):
+    now = time.monotonic()
+    elapsed = now - self._last_refill
+    self._last_refill = now
+    for bucket in (self._requests, self._tokens):
+      if bucket:
+        bucket.Refill(elapsed, self._factor)
+
+  def _Throttle(self):
+    with self._lock:
+      self.rate_limited_count += 1
+      self._factor = max(0.05, self._factor / 2)
+
+  def _Recover(self):
+    if self._factor < 1:
+      with self._lock:
+        self._factor = min(1.0, self._factor + 0.05)
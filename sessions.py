@@ -0,0 +1,348 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-session state of frontend clients.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Number of disk writes of a `ContextStore` between purges of expired files.
+_DISK_PURGE_INTERVAL = 1000
+
+
+class StaleRequestError(Exception):
+  """Raised when a request has been superseded by a newer one."""
+
+
+class UnknownContextError(LookupError):
+  """Raised when a request refers to a context version the server lacks."""
+
+
+class SequenceTracker:
+  """Tracks the latest request sequence number of each client session.
+
+  The frontend numbers its requests per session. Once a request with a higher
+  number arrives, older requests of the session are stale: their results will
+  be discarded by the client, so the server should stop working on them.
+  Tasks registered with `Begin` are cancelled when they become stale.
+  """
+
+  def __init__(self, max_sessions=10000):
+    self.max_sessions = max_sessions
+    self._lock = threading.Lock()
+    # session ID -> [latest sequence, {task: sequence}]
+    self._sessions = collections.OrderedDict()
+    self._counters = collections.Counter()
+
+  def Begin(self, session_id, sequence, task=None):
+    """Registers a request.
+
+    Args:
+      session_id: Client session ID.
+      sequence: Sequence number of the request within the session.
+      task: Optional `asyncio.Task` serving the request, cancelled when the
+        request becomes stale.
+
+    Returns:
+      False if a newer request of the session has already arrived.
+    """
+    with self._lock:
+      state = self._sessions.get(session_id)
+      if state is None:
+        state = [sequence, {}]
+        self._sessions[session_id] = state
+        while len(self._sessions) > self.max_sessions:
+          self._sessions.popitem(last=False)
+      self._sessions.move_to_end(session_id)
+      if sequence < state[0]:
+        self._counters['superseded_on_arrival'] += 1
+        return False
+      state[0] = sequence
+      stale_tasks = [t for t, s in state[1].items() if s < sequence]
+      for stale_task in stale_tasks:
+        del state[1][stale_task]
+      if task is not None:
+        state[1][task] = sequence
+    for stale_task in stale_tasks:
+      stale_task.cancel()
+    return True
+
+  def End(self, session_id, task):
+    """Unregisters a task passed to `Begin`."""
+    with self._lock:
+      state = self._sessions.get(session_id)
+      if state:
+        state[1].pop(task, None)
+
+  def IsStale(self, session_id, sequence):
+    """Returns whether a newer request of the session has arrived."""
+    with self._lock:
+      state = self._sessions.get(session_id)
+      return bool(state) and sequence < state[0]
+
+  def Count(self, name):
+    with self._lock:
+      self._counters[name] += 1
+
+  def Stats(self):
+    """Returns a snapshot of counters of stale requests."""
+    with self._lock:
+      return dict(self._counters)
+
+
+class ContextStore:
+  """Conversation context of each client session, keyed by version.
+
+  The persona and conversation history only change once per turn, so the
+  client sends them with the first request of a turn under a new version
+  number, and then only the version. Contexts are kept in an LRU bounded by
+  `max_sessions`. If `disk_dir` is given, they are also written there, so that
+  evicted sessions and other worker processes sharing the directory can
+  still find them. Files not written for `disk_ttl_seconds` are ignored and
+  removed from time to time. Disk errors are counted and only leave the
+  context in memory.
+  """
+
+  def __init__(self, max_sessions=1000, disk_dir=None, disk_ttl_seconds=86400):
+    self.max_sessions = max_sessions
+    self.disk_dir = disk_dir
+    self.disk_ttl_seconds = disk_ttl_seconds
+    if disk_dir:
+      os.makedirs(disk_dir, exist_ok=True)
+    self._lock = threading.Lock()
+    # session ID -> (version, context)
+    self._sessions = collections.OrderedDict()
+    self._counters = collections.Counter()
+    self._disk_puts = 0
+
+  def Resolve(self, session_id, version, context_json=None):
+    """Returns the context of a request.
+
+    Args:
+      session_id: Client session ID.
+      version: Context version the request refers to.
+      context_json: JSON object of the context if the request carries it,
+        which is then stored under `version`.
+
+    Returns:
+      The context dictionary.
+
+    Raises:
+      UnknownContextError: If the request does not carry its context and the
+        version is not stored.
+    """
+    if context_json is not None:
+      context = json.loads(context_json)
+      self.Put(session_id, version, context)
+      return context
+    context = self.Get(session_id, version)
+    if context is None:
+      raise UnknownContextError(
+          f'Context version {version} of session {session_id} not found')
+    return context
+
+  def Put(self, session_id, version, context):
+    """Stores a context unless a newer version of the session is stored."""
+    with self._lock:
+      stored = self._sessions.get(session_id)
+      if stored and stored[0] > version:
+        self._counters['outdated_puts'] += 1
+        return
+      self._MemoryPut(session_id, version, context)
+      self._counters['puts'] += 1
+    self._DiskPut(session_id, version, context)
+
+  def Get(self, session_id, version):
+    """Returns the context stored under `version`, or None."""
+    with self._lock:
+      stored = self._sessions.get(session_id)
+      if stored and stored[0] == version:
+        self._sessions.move_to_end(session_id)
+        self._counters['hits'] += 1
+        return stored[1]
+    stored = self._DiskGet(session_id)
+    with self._lock:
+      if stored is None or stored[0] != version:
+        self._counters['misses'] += 1
+        return None
+      self._counters['disk_hits'] += 1
+      self._MemoryPut(session_id, *stored)
+    return stored[1]
+
+  def Stats(self):
+    """Returns a snapshot of store counters."""
+    with self._lock:
+      stats = {
+          'hits': 0,
+          'disk_hits': 0,
+          'misses': 0,
+          'puts': 0,
+          'outdated_puts': 0,
+          'evictions': 0,
+          'disk_errors': 0,
+          'disk_expirations': 0,
+      }
+      stats.update(self._counters)
+      stats['sessions'] = len(self._sessions)
+      return stats
+
+  def _MemoryPut(self, session_id, version, context):
+    self._sessions[session_id] = (version, context)
+    self._sessions.move_to_end(session_id)
+    while len(self._sessions) > self.max_sessions:
+      self._sessions.popitem(last=False)
+      self._counters['evictions'] += 1
+
+  def _DiskPath(self, session_id):
+    name = hashlib.sha256(session_id.encode('utf-8')).hexdigest()
+    return os.path.join(self.disk_dir, f'{name}.json')
+
+  def _DiskPut(self, session_id, version, context):
+    if not self.disk_dir:
+      return
+    with self._lock:
+      self._disk_puts += 1
+      purge = self._disk_puts % _DISK_PURGE_INTERVAL == 0
+    path = self._DiskPath(session_id)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    stored = {'version': version, 'context': context}
+    try:
+      with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(stored, f, ensure_ascii=False)
+      os.replace(temp_path, path)
+    except OSError:
+      self._Count('disk_errors')
+      try:
+        os.remove(temp_path)
+      except OSError:
+        pass
+    if purge:
+      self._PurgeDisk()
+
+  def _DiskGet(self, session_id):
+    if not self.disk_dir:
+      return None
+    path = self._DiskPath(session_id)
+    try:
+      if os.path.getmtime(path) <= time.time() - self.disk_ttl_seconds:
+        return None
+      with open(path, encoding='utf-8') as f:
+        stored = json.load(f)
+    except FileNotFoundError:
+      return None
+    except (OSError, ValueError):
+      self._Count('disk_errors')
+      return None
+    return stored['version'], stored['context']
+
+  def _PurgeDisk(self):
+    """Removes files not written for `disk_ttl_seconds`."""
+    cutoff = time.time() - self.disk_ttl_seconds
+    try:
+      with os.scandir(self.disk_dir) as entries:
+        for entry in entries:
+          try:
+            if entry.stat().st_mtime <= cutoff:
+              os.remove(entry.path)
+              self._Count('disk_expirations')
+          except FileNotFoundError:
+            pass  # Removed by another worker.
+    except OSError:
+      self._Count('disk_errors')
+
+  def _Count(self, name):
+    with self._lock:
+      self._counters[name] += 1
+
+
+class SuggestionIndex:
+  """Recent sentence suggestions of each session, reused while typing on.
+
+  When the user types characters that earlier suggestions already predicted,
+  e.g. "I want" after suggestions for "I w", the suggestions still starting
+  with the new text can be served without calling the model. Suggestions are
+  only reused for the same macro, model and other user inputs, and while the
+  text keeps extending the text they were made for.
+  """
+
+  def __init__(self, max_sessions=10000, max_candidates=20):
+    self.max_sessions = max_sessions
+    self.max_candidates = max_candidates
+    self._lock = threading.Lock()
+    # session ID -> [context key, text, candidates]
+    self._sessions = collections.OrderedDict()
+    self._counters = collections.Counter()
+
+  @property
+  def enabled(self):
+    return self.max_candidates > 0
+
+  @staticmethod
+  def ContextKey(macro_id, model_id, temperature, user_inputs):
+    """Returns a hash of everything but the text a macro result depends on."""
+    context = {
+        key: value for key, value in user_inputs.items() if key != 'text'
+    }
+    data = json.dumps([macro_id, model_id, temperature, context],
+                      ensure_ascii=False,
+                      sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+  def Lookup(self, session_id, context_key, text, num):
+    """Returns `num` stored suggestions extending `text`, or None."""
+    with self._lock:
+      state = self._sessions.get(session_id)
+      if (state is None or state[0] != context_key or
+          not text.startswith(state[1])):
+        self._counters['misses'] += 1
+        return None
+      matches = [
+          candidate for candidate in state[2]
+          if candidate.startswith(text) and candidate != text
+      ]
+      if len(matches) < num:
+        self._counters['misses'] += 1
+        return None
+      self._sessions.move_to_end(session_id)
+      self._counters['hits'] += 1
+      return matches[:num]
+
+  def Record(self, session_id, context_key, text, suggestions):
+    """Stores suggestions made for `text`.
+
+    Candidates made for a shorter text that are still consistent with `text`
+    are kept after the new ones.
+    """
+    with self._lock:
+      state = self._sessions.get(session_id)
+      candidates = list(suggestions)
+      if state and state[0] == context_key and text.startswith(state[1]):
+        candidates.extend(
+            candidate for candidate in state[2] if candidate.startswith(text))
+      candidates = list(dict.fromkeys(candidates))[:self.max_candidates]
+      self._sessions[session_id] = [context_key, text, candidates]
+      self._sessions.move_to_end(session_id)
+      while len(self._sessions) > self.max_sessions:
+        self._sessions.popitem(last=False)
+
+  def Stats(self):
+    """Returns a snapshot of lookup counters."""
+    with self._lock:
+      stats = {'hits': 0, 'misses': 0}
+      stats.update(self._counters)
+      return stats
@@ -0,0 +1,134 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests of per-session state."""
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import sessions
+
+
+class ContextStoreTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.store = sessions.ContextStore()
+
+  def testResolvesStoredVersion(self):
+    context = {'persona': 'p'}
+    self.assertEqual(
+        self.store.Resolve('session', 1, json.dumps(context)), context)
+    self.assertEqual(self.store.Resolve('session', 1), context)
+
+  def testRaisesOnUnknownVersion(self):
+    self.store.Resolve('session', 1, json.dumps({'persona': 'p'}))
+    with self.assertRaises(sessions.UnknownContextError):
+      self.store.Resolve('session', 2)
+    with self.assertRaises(sessions.UnknownContextError):
+      self.store.Resolve('other', 1)
+
+  def testIgnoresOlderVersionArrivingLate(self):
+    self.store.Put('session', 2, {'persona': 'new'})
+    self.store.Put('session', 1, {'persona': 'old'})
+    self.assertEqual(self.store.Get('session', 2), {'persona': 'new'})
+    self.assertIsNone(self.store.Get('session', 1))
+    self.assertEqual(self.store.Stats()['outdated_puts'], 1)
+
+  def testReadsEvictedSessionFromDisk(self):
+    store = sessions.ContextStore(max_sessions=1, disk_dir=tempfile.mkdtemp())
+    store.Put('a', 1, {'persona': 'a'})
+    store.Put('b', 1, {'persona': 'b'})
+    self.assertEqual(store.Get('a', 1), {'persona': 'a'})
+    self.assertEqual(store.Stats()['disk_hits'], 1)
+
+  def testPurgesExpiredFiles(self):
+    disk_dir = tempfile.mkdtemp()
+    store = sessions.ContextStore(
+        max_sessions=1, disk_dir=disk_dir, disk_ttl_seconds=60)
+    store.Put('a', 1, {'persona': 'a'})
+    for name in os.listdir(disk_dir):
+      os.utime(os.path.join(disk_dir, name), (0, 0))
+    store.Put('b', 1, {'persona': 'b'})
+    # Expired files are not read.
+    self.assertIsNone(store.Get('a', 1))
+    with mock.patch.object(sessions, '_DISK_PURGE_INTERVAL', 1):
+      store.Put('c', 1, {'persona': 'c'})
+    self.assertEqual(len(os.listdir(disk_dir)), 2)
+    self.assertEqual(store.Stats()['disk_expirations'], 1)
+
+
+class SuggestionIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.index = sessions.SuggestionIndex(max_candidates=20)
+    self.index.Record('session', 'context', 'I w',
+                      ['I want water', 'I will go', 'I want', 'I wish'])
+
+  def testReturnsSuggestionsExtendingTheText(self):
+    self.assertEqual(
+        self.index.Lookup('session', 'context', 'I wa', 1), ['I want water'])
+
+  def testSkipsSuggestionEqualToTheText(self):
+    self.assertIsNone(self.index.Lookup('session', 'context', 'I want', 2))
+    self.assertEqual(
+        self.index.Lookup('session', 'context', 'I want', 1), ['I want water'])
+
+  def testReturnsAtMostNum(self):
+    self.assertEqual(
+        self.index.Lookup('session', 'context', 'I wi', 2),
+        ['I will go', 'I wish'])
+    self.assertEqual(
+        self.index.Lookup('session', 'context', 'I wi', 1), ['I will go'])
+
+  def testMissesWithFewerThanNumSuggestions(self):
+    self.assertIsNone(self.index.Lookup('session', 'context', 'I wi', 3))
+
+  def testMissesOnOtherContext(self):
+    self.assertIsNone(self.index.Lookup('session', 'other', 'I wa', 1))
+
+  def testMissesOnTextNotExtendingTheRecordedOne(self):
+    self.assertIsNone(self.index.Lookup('session', 'context', 'I', 1))
+    self.assertIsNone(self.index.Lookup('other', 'context', 'I wa', 1))
+
+  def testKeepsConsistentOlderSuggestions(self):
+    self.index.Record('session', 'context', 'I wa', ['I was'])
+    self.assertEqual(
+        self.index.Lookup('session', 'context', 'I wa', 3),
+        ['I was', 'I want water', 'I want'])
+
+  def testDropsOlderSuggestionsNotExtendingTheText(self):
+    self.index.Record('session', 'context', 'I wi', ['I win'])
+    self.assertEqual(
+        self.index.Lookup('session', 'context', 'I wi', 3),
+        ['I win', 'I will go', 'I wish'])
+    self.assertIsNone(self.index.Lookup('session', 'context', 'I wi', 4))
+
+  def testKeepsAtMostMaxCandidates(self):
+    index = sessions.SuggestionIndex(max_candidates=2)
+    index.Record('session', 'context', 'I', ['I a', 'I b', 'I c'])
+    self.assertIsNone(index.Lookup('session', 'context', 'I', 3))
+    self.assertEqual(index.Lookup('session', 'context', 'I', 2), ['I a', 'I b'])
+
+  def testStats(self):
+    self.index.Lookup('session', 'context', 'I wa', 1)
+    self.index.Lookup('session', 'other', 'I wa', 1)
+    self.assertEqual(self.index.Stats(), {'hits': 1, 'misses': 1})
+
+
+if __name__ == '__main__':
+  unittest.main()
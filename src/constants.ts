@@ -18,6 +18,8 @@ import {Config} from './config-storage.js';
 
 export const RUN_MACRO_ENDPOINT_URL = '/run-macro';
 
+export const RUN_MACROS_ENDPOINT_URL = '/run-macros';
+
 export const CONFIG_DEFAULT: Config = {
   aiConfig: 'smart',
   checkedLanguages: [],
@@ -14,7 +14,7 @@
  * limitations under the License.
  */
 
-import {RUN_MACRO_ENDPOINT_URL} from './constants.js';
+import {RUN_MACRO_ENDPOINT_URL, RUN_MACROS_ENDPOINT_URL} from './constants.js';
 
 /**
  * Extracts suggestions from a response from LLM.
@@ -33,9 +33,82 @@ function parseResponse(response: string) {
     .map(text => text.replace(/^\d+\.\s?/, ''));
 }
 
+/**
+ * Extracts response texts from a macro result.
+ * @param data A macro result returned by the endpoint
+ * @returns A response text per message, e.g. the sentences and the words of
+ *     a combined macro, or an empty string if there is no message
+ */
+function extractTexts(data: unknown): string[] {
+  if (!(data instanceof Object && 'messages' in data)) {
+    throw new Error("API response doesn't have messages");
+  }
+  if (!Array.isArray(data.messages) || data.messages.length === 0) {
+    return [''];
+  }
+  return data.messages.map(message => message.text);
+}
+
+/**
+ * Extracts response texts from a batch response.
+ * Failed macros are logged and yield empty strings so that the other results
+ * can still be shown.
+ * @param data A response from the batch endpoint
+ * @returns The response texts of each requested macro, in their order, where
+ *     a combined macro has a text per list
+ */
+function extractBatchTexts(data: unknown): string[][] {
+  if (!(data instanceof Object && 'results' in data)) {
+    throw new Error("API response doesn't have results");
+  }
+  if (!Array.isArray(data.results)) {
+    throw new Error('API response has malformed results');
+  }
+  return data.results.map(result => {
+    if (result instanceof Object && 'error' in result) {
+      console.error('Macro failed:', result.error);
+      return [''];
+    }
+    return extractTexts(result);
+  });
+}
+
+/**
+ * Thrown when the server does not know the context version of a request,
+ * e.g. after a restart. The request should be resent with its context.
+ */
+export class UnknownContextError extends Error {}
+
+/**
+ * Conversation context of a session sent to the server once per version.
+ * Requests of the same version only send the version number.
+ */
+interface SharedContext {
+  version: number;
+  // JSON of the context, included only if the server may not have it yet.
+  json?: string;
+}
+
 export class MacroApiClient {
   private fetchAbortController: AbortController | null = null;
 
+  /**
+   * Identifies this client so that the server can drop requests superseded
+   * by a newer one.
+   */
+  private readonly sessionId = `${Date.now().toString(36)}-${Math.random()
+    .toString(36)
+    .slice(2)}`;
+
+  private sequence = 0;
+
+  private contextVersion = 0;
+
+  /**
+   * JSON of the context registered with the server under contextVersion.
+   */
+  private registeredContext: string | null = null;
+
   /**
    * Aborts fetching results from the endpoint.
    */
@@ -79,30 +152,60 @@ export class MacroApiClient {
       language, // [[language]]
       num, // [[num]]
       text: textValue, // [[text]]
+      sentenceEmotion: context.sentenceEmotion,
+    };
+    // Only changes once per turn, so a server with session contexts enabled
+    // keeps it between keystrokes, and it is only sent with a new version.
+    const sessionContext = {
       persona: context.persona,
       lastOutputSpeech: context.lastOutputSpeech,
       lastInputSpeech: context.lastInputSpeech,
       conversationHistory: context.conversationHistory,
-      sentenceEmotion: context.sentenceEmotion,
     };
-
-    const wordsFetch = MacroApiClient.fetchSuggestion(
-      userInputs,
-      abortSignal,
-      wordMacroId,
-      model,
-    );
+    const shareContext = document.body.dataset.sessionContext !== undefined;
+    const contextJson = JSON.stringify(sessionContext);
+    const isNewContext = contextJson !== this.registeredContext;
+    if (isNewContext) {
+      this.contextVersion++;
+      this.registeredContext = contextJson;
+    }
+    const version = this.contextVersion;
 
     const sentenceMacroId = context.sentenceMacroId;
+    // A combined macro set as both the sentence and the word macro generates
+    // both lists in one call.
+    const macroIds =
+      sentenceMacroId === wordMacroId
+        ? [sentenceMacroId]
+        : [sentenceMacroId, wordMacroId];
 
-    const sentencesFetch = MacroApiClient.fetchSuggestion(
-      userInputs,
-      abortSignal,
-      sentenceMacroId,
-      model,
-    );
+    const fetchWithContext = (includeContext: boolean) =>
+      MacroApiClient.fetchMacros(
+        shareContext ? userInputs : {...userInputs, ...sessionContext},
+        abortSignal,
+        macroIds,
+        model,
+        0.0,
+        {id: this.sessionId, sequence: ++this.sequence},
+        shareContext
+          ? {version, json: includeContext ? contextJson : undefined}
+          : null,
+      );
+    const suggestionsFetch = fetchWithContext(isNewContext)
+      .catch(err => {
+        if (err instanceof UnknownContextError) {
+          return fetchWithContext(true);
+        }
+        throw err;
+      })
+      .then((texts): [string[], string[]] => {
+        // A combined macro returns the sentences and then the words.
+        const [sentences, words = ''] =
+          macroIds.length === 1 ? texts[0] : [texts[0][0], texts[1][0]];
+        return [parseResponse(sentences), parseResponse(words)];
+      });
 
-    const result = Promise.all([sentencesFetch, wordsFetch]).catch(err => {
+    const result = suggestionsFetch.catch(err => {
       if (err instanceof DOMException) {
         console.log('Request was aborted by user:', userInputs);
       } else {
@@ -114,23 +217,6 @@ export class MacroApiClient {
     return result;
   }
 
-  private static async fetchSuggestion(
-    userInputs: {[key: string]: string},
-    abortSignal: AbortSignal,
-    macroId: string,
-    model: string,
-    temperature = 0.0,
-  ): Promise<string[]> {
-    const text = await MacroApiClient.fetchMacro(
-      userInputs,
-      abortSignal,
-      macroId,
-      model,
-      temperature,
-    );
-    return parseResponse(text);
-  }
-
   /**
    * Fetches a response text for the given input and macro.
    * @param userInputs Input text
@@ -154,25 +240,70 @@ export class MacroApiClient {
     formData.append('model_id', model);
     formData.append('_csrf_token', document.body.dataset.csrfToken || '');
 
-    const extractText = (data: unknown): string => {
-      if (!(data instanceof Object && 'messages' in data)) {
-        throw new Error("API response doesn't have messages");
-      }
-      if (!Array.isArray(data.messages) || data.messages.length === 0) {
-        return '';
-      }
-      return data.messages[0].text;
-    };
-
     const text = fetch(RUN_MACRO_ENDPOINT_URL, {
       method: 'POST',
       body: formData,
       signal: abortSignal,
     })
       .then(res => res.json())
-      .then(extractText);
+      .then(data => extractTexts(data)[0]);
     return text;
   }
+
+  /**
+   * Fetches response texts for the given input and macros in one request.
+   * @param userInputs Input text
+   * @param abortSignal Abort signal for the request
+   * @param macroIds Macro IDs
+   * @param model Language model to use
+   * @param temperature Temperature parameter
+   * @param session Client session ID and sequence number of the request, used
+   *     by the server to cancel requests superseded by a newer one
+   * @param sharedContext Version of the session context stored on the server
+   *     to merge into userInputs, and its JSON if the server may lack it
+   * @returns A promise for the response texts of each macro, in the order of
+   *     macroIds
+   * @throws UnknownContextError if the server does not have the context
+   */
+  public static async fetchMacros(
+    userInputs: {[key: string]: string},
+    abortSignal: AbortSignal | null,
+    macroIds: string[],
+    model: string,
+    temperature: number,
+    session: {id: string; sequence: number} | null = null,
+    sharedContext: SharedContext | null = null,
+  ): Promise<string[][]> {
+    const formData = new FormData();
+    formData.append('macros', JSON.stringify(macroIds.map(id => ({id}))));
+    formData.append('userInputs', JSON.stringify(userInputs));
+    formData.append('temperature', `${temperature}`);
+    formData.append('model_id', model);
+    if (session) {
+      formData.append('session_id', session.id);
+      formData.append('sequence', `${session.sequence}`);
+      if (sharedContext) {
+        formData.append('context_version', `${sharedContext.version}`);
+        if (sharedContext.json !== undefined) {
+          formData.append('context', sharedContext.json);
+        }
+      }
+    }
+    formData.append('_csrf_token', document.body.dataset.csrfToken || '');
+
+    return fetch(RUN_MACROS_ENDPOINT_URL, {
+      method: 'POST',
+      body: formData,
+      signal: abortSignal,
+    })
+      .then(res => {
+        if (res.status === 412) {
+          throw new UnknownContextError('Unknown context version');
+        }
+        return res.json();
+      })
+      .then(extractBatchTexts);
+  }
 }
 
-export const TEST_ONLY = {parseResponse};
+export const TEST_ONLY = {parseResponse, extractBatchTexts};
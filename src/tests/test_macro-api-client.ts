@@ -14,7 +14,11 @@
  * limitations under the License.
  */
 
-import {TEST_ONLY} from '../macro-api-client.js';
+import {
+  MacroApiClient,
+  TEST_ONLY,
+  UnknownContextError,
+} from '../macro-api-client.js';
 
 describe('Macro API Client', () => {
   describe('parseResponse', () => {
@@ -79,4 +83,171 @@ describe('Macro API Client', () => {
       ]);
     });
   });
+
+  describe('extractBatchTexts', () => {
+    it('should return texts in order', () => {
+      const result = TEST_ONLY.extractBatchTexts({
+        results: [
+          {messages: [{text: '1. sentence'}]},
+          {messages: [{text: '1. word'}]},
+        ],
+      });
+      expect(result).toEqual([['1. sentence'], ['1. word']]);
+    });
+
+    it('should return an empty text for a failed or empty macro', () => {
+      spyOn(console, 'error');
+      const result = TEST_ONLY.extractBatchTexts({
+        results: [{error: 'ValueError: boom'}, {messages: []}],
+      });
+      expect(result).toEqual([[''], ['']]);
+      expect(console.error).toHaveBeenCalled();
+    });
+
+    it('should return a text per list of a combined macro', () => {
+      const result = TEST_ONLY.extractBatchTexts({
+        results: [
+          {messages: [{text: '1. sentence'}, {text: '1. combined word'}]},
+          {messages: [{text: '1. word'}]},
+        ],
+      });
+      expect(result).toEqual([
+        ['1. sentence', '1. combined word'],
+        ['1. word'],
+      ]);
+    });
+
+    it('should throw on a malformed response', () => {
+      expect(() => TEST_ONLY.extractBatchTexts({messages: []})).toThrowError();
+    });
+  });
+
+  describe('fetchMacros', () => {
+    const okResponse = () =>
+      new Response(JSON.stringify({results: [{messages: [{text: '1. a'}]}]}));
+
+    it('should send the context only with its JSON', async () => {
+      const fetchSpy = spyOn(window, 'fetch').and.callFake(() =>
+        Promise.resolve(okResponse()),
+      );
+      await MacroApiClient.fetchMacros(
+        {text: 'a'},
+        null,
+        ['macro'],
+        'model',
+        0,
+        {id: 'session', sequence: 1},
+        {version: 3, json: '{"persona":"p"}'},
+      );
+      await MacroApiClient.fetchMacros(
+        {text: 'ab'},
+        null,
+        ['macro'],
+        'model',
+        0,
+        {id: 'session', sequence: 2},
+        {version: 3},
+      );
+
+      const [first, second] = fetchSpy.calls
+        .allArgs()
+        .map(([, init]) => init!.body as FormData);
+      expect(first.get('context_version')).toBe('3');
+      expect(first.get('context')).toBe('{"persona":"p"}');
+      expect(second.get('context_version')).toBe('3');
+      expect(second.has('context')).toBeFalse();
+    });
+
+    it('should throw UnknownContextError on 412', async () => {
+      spyOn(window, 'fetch').and.resolveTo(
+        new Response(JSON.stringify({error: 'Unknown context version'}), {
+          status: 412,
+        }),
+      );
+      await expectAsync(
+        MacroApiClient.fetchMacros(
+          {text: 'a'},
+          null,
+          ['macro'],
+          'model',
+          0,
+          {id: 'session', sequence: 1},
+          {version: 1},
+        ),
+      ).toBeRejectedWithError(UnknownContextError);
+    });
+  });
+
+  describe('fetchSuggestions', () => {
+    const context = {
+      sentenceMacroId: 'SentenceMacro',
+      wordMacroId: 'WordMacro',
+      persona: '',
+      lastOutputSpeech: '',
+      lastInputSpeech: '',
+      conversationHistory: '',
+      sentenceEmotion: '',
+    };
+    const respond = (results: unknown[]) =>
+      spyOn(window, 'fetch').and.callFake(() =>
+        Promise.resolve(new Response(JSON.stringify({results}))),
+      );
+
+    it('should send the context only with its version if enabled', async () => {
+      const fetchSpy = respond([{messages: []}, {messages: []}]);
+      document.body.dataset.sessionContext = '';
+      const client = new MacroApiClient();
+      try {
+        await client.fetchSuggestions('a', 'English', 'model', context);
+        await client.fetchSuggestions('ab', 'English', 'model', context);
+      } finally {
+        delete document.body.dataset.sessionContext;
+      }
+
+      const [first, second] = fetchSpy.calls
+        .allArgs()
+        .map(([, init]) => init!.body as FormData);
+      expect(first.get('context_version')).toBe('1');
+      expect(first.has('context')).toBeTrue();
+      expect(second.get('context_version')).toBe('1');
+      expect(second.has('context')).toBeFalse();
+    });
+
+    it('should send the context in userInputs by default', async () => {
+      const fetchSpy = respond([{messages: []}, {messages: []}]);
+      await new MacroApiClient().fetchSuggestions('a', 'English', 'model', {
+        ...context,
+        persona: 'p',
+      });
+
+      const body = fetchSpy.calls.mostRecent().args[1]!.body as FormData;
+      expect(body.has('context_version')).toBeFalse();
+      expect(JSON.parse(body.get('userInputs') as string).persona).toBe('p');
+    });
+
+    it('should take both lists from a combined macro', async () => {
+      respond([{messages: [{text: '1. sentence'}, {text: '1. word'}]}]);
+      const result = await new MacroApiClient().fetchSuggestions(
+        'a',
+        'English',
+        'model',
+        {...context, sentenceMacroId: 'Combined', wordMacroId: 'Combined'},
+      );
+      expect(result).toEqual([['sentence'], ['word']]);
+    });
+
+    it('should take the words from the word macro', async () => {
+      respond([
+        {messages: [{text: '1. sentence'}, {text: '1. combined word'}]},
+        {messages: [{text: '1. word'}]},
+      ]);
+      const result = await new MacroApiClient().fetchSuggestions(
+        'a',
+        'English',
+        'model',
+        {...context, sentenceMacroId: 'Combined'},
+      );
+      expect(result).toEqual([['sentence'], ['word']]);
+    });
+  });
 });
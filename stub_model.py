@@ -0,0 +1,210 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A local stand-in for the Gemini API.
+
+The stub client implements the subset of `genai.Client` used by `macro`, so
+the app and the simulators can run without network access, e.g. to measure
+throughput and tail latency on a laptop. It is selected with
+`MODEL_BACKEND=stub`.
+
+Responses are numbered lists generated deterministically from the prompt: the
+same prompt always gets the same suggestions, which start with the text the
+user typed. Prompts of combined macros get a list of words and a list of
+sentences under their headings. Latency and failures are random and configured
+with environment variables:
+
+  STUB_LATENCY_MS: Median latency of a call in milliseconds (default 300).
+  STUB_LATENCY_SIGMA: Sigma of the log-normal latency distribution
+    (default 0.5). 0 makes every call take the median latency.
+  STUB_ERROR_RATE: Fraction of calls failing with a 503 error (default 0).
+  STUB_RATE_LIMIT_RATE: Fraction of calls failing with a 429 error
+    (default 0).
+  STUB_SEED: Seed of the latency and failure draws.
+"""
+
+import asyncio
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+import types
+
+from google.genai import errors
+
+_NUM_RE = re.compile(r'(\d+)\s*(?:つ|different|single)')
+_TEXT_RE = re.compile(r'「([^」]*)」で始まる'
+                      r'|start with "([^"]*)"'
+                      r'|sentence: "([^"]*)"'
+                      r'|continues the text "([^"]*)"')
+_JAPANESE_RE = re.compile(r'[぀-ヿ一-鿿]')
+_DEFAULT_NUM = 5
+
+_WORDS = {
+    'English': ('want', 'need', 'the', 'to', 'some', 'water', 'help', 'go',
+                'home', 'now', 'please', 'later', 'you', 'it', 'more', 'rest'),
+    'Japanese': ('です', 'ます', 'を', 'が', 'に', 'は', '水', '飲みたい', 'ください', '少し',
+                 '休み', 'たい', '今日', '明日', 'お願い', '行き'),
+}
+
+
+class StubModels:
+  """Implements `generate_content` and `generate_content_stream`."""
+
+  def __init__(self, config):
+    self._config = config
+
+  def generate_content(self, model, contents, config=None):
+    del config  # Unused.
+    time.sleep(self._config.Draw())
+    return _Response(GenerateText(model, contents), contents)
+
+  def generate_content_stream(self, model, contents, config=None):
+    del config  # Unused.
+    latency = self._config.Draw()
+    lines = GenerateText(model, contents).split('\n')
+    # The first line takes half of the latency, the rest is spread evenly.
+    time.sleep(latency / 2)
+    for i, line in enumerate(lines):
+      if i:
+        time.sleep(latency / 2 / (len(lines) - 1))
+      # Chunks add up to the text of `generate_content`.
+      yield _Response(line if i == len(lines) - 1 else line + '\n', contents)
+
+
+class AsyncStubModels:
+  """Implements the async `generate_content`."""
+
+  def __init__(self, config):
+    self._config = config
+
+  async def generate_content(self, model, contents, config=None):
+    del config  # Unused.
+    await asyncio.sleep(self._config.Draw())
+    return _Response(GenerateText(model, contents), contents)
+
+
+class StubConfig:
+  """Latency distribution and failure rates of the stub."""
+
+  def __init__(self,
+               latency_ms=300,
+               latency_sigma=0.5,
+               error_rate=0.0,
+               rate_limit_rate=0.0,
+               seed=None):
+    self.latency_ms = latency_ms
+    self.latency_sigma = latency_sigma
+    self.error_rate = error_rate
+    self.rate_limit_rate = rate_limit_rate
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  @classmethod
+  def FromEnv(cls):
+    seed = os.environ.get('STUB_SEED')
+    return cls(
+        latency_ms=float(os.environ.get('STUB_LATENCY_MS', '300')),
+        latency_sigma=float(os.environ.get('STUB_LATENCY_SIGMA', '0.5')),
+        error_rate=float(os.environ.get('STUB_ERROR_RATE', '0')),
+        rate_limit_rate=float(os.environ.get('STUB_RATE_LIMIT_RATE', '0')),
+        seed=None if seed is None else int(seed))
+
+  def Draw(self):
+    """Returns the latency of a call in seconds, or raises its error.
+
+    Raises:
+      errors.ServerError: For a fraction `error_rate` of calls.
+      errors.ClientError: With code 429 for a fraction `rate_limit_rate` of
+        calls.
+    """
+    with self._lock:
+      failure = self._random.random()
+      latency = self._random.lognormvariate(0, self.latency_sigma)
+    if failure < self.error_rate:
+      raise errors.ServerError(
+          503,
+          {'error': {
+              'message': 'Stub server error',
+              'status': 'UNAVAILABLE'
+          }})
+    if failure < self.error_rate + self.rate_limit_rate:
+      raise errors.ClientError(429, {
+          'error': {
+              'message': 'Stub rate limit',
+              'status': 'RESOURCE_EXHAUSTED'
+          }
+      })
+    return self.latency_ms / 1000 * latency
+
+
+class StubClient:
+  """A drop-in replacement of `genai.Client` for `macro`."""
+
+  def __init__(self, config=None):
+    config = config or StubConfig.FromEnv()
+    self.models = StubModels(config)
+    self.aio = types.SimpleNamespace(models=AsyncStubModels(config))
+
+
+def GenerateText(model, prompt):
+  """Returns a deterministic numbered list for a prompt.
+
+  Args:
+    model: Model ID, which also seeds the generated suggestions.
+    prompt: Rendered prompt of a macro.
+
+  Returns:
+    Suggestions starting with the text found in the prompt, single words if
+    the prompt asks for words, or both under "Words:" and "Sentences:"
+    headings if it asks for both.
+  """
+  matched = _NUM_RE.search(prompt)
+  num = int(matched.group(1)) if matched else _DEFAULT_NUM
+  matched = _TEXT_RE.search(prompt)
+  text = next((group for group in matched.groups() if group is not None),
+              '') if matched else ''
+  language = 'Japanese' if _JAPANESE_RE.search(prompt) else 'English'
+  words = _WORDS[language]
+  separator = '' if language == 'Japanese' else ' '
+  seed = hashlib.sha256(f'{model}\n{prompt}'.encode('utf-8')).digest()
+  rng = random.Random(seed)
+  word_items = [words[(seed[0] + i) % len(words)] for i in range(num)]
+  sentence_items = []
+  for i in range(num):
+    continuation = separator.join(rng.sample(words, 2 + i % 3))
+    sentence_items.append(f'{text}{separator}{continuation}'.strip())
+  if 'Words:' in prompt and 'Sentences:' in prompt:
+    return '\n'.join(('Words:', _NumberedList(word_items), 'Sentences:',
+                      _NumberedList(sentence_items)))
+  if 'single words' in prompt:
+    return _NumberedList(word_items)
+  return _NumberedList(sentence_items)
+
+
+def _NumberedList(items):
+  return '\n'.join(f'{i}. {item}' for i, item in enumerate(items, 1))
+
+
+def _Response(text, prompt):
+  prompt_tokens = len(prompt) // 4
+  candidates_tokens = len(text) // 4
+  return types.SimpleNamespace(
+      text=text,
+      usage_metadata=types.SimpleNamespace(
+          prompt_token_count=prompt_tokens,
+          candidates_token_count=candidates_tokens,
+          thoughts_token_count=None,
+          total_token_count=prompt_tokens + candidates_tokens))
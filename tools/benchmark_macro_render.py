@@ -0,0 +1,135 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Microbenchmark of macro prompt rendering.
+
+Compares the compiled template renderer in `macro.RenderPrompt` with the
+previous line-by-line implementation, and checks that both produce the same
+prompts. Context compaction is disabled, so only rendering is timed.
+
+Usage:
+  $ PYTHONPATH=(Path to VOICE app) python benchmark_macro_render.py
+"""
+
+import argparse
+import re
+import timeit
+
+import compaction
+import macro
+
+USER_INPUTS = [
+    {
+        'language': 'English',
+        'num': '5',
+        'text': 'I would like ',
+    },
+    {
+        'language': 'English',
+        'num': '5',
+        'text': 'Could you',
+        'persona': 'I am a retired teacher living in Tokyo.',
+        'lastInputSpeech': 'How are you today?',
+        'lastOutputSpeech': 'Hello.',
+        'conversationHistory': 'Partner: Hi\nYou: Hello.',
+        'sentenceEmotion': 'Question',
+    },
+    {
+        'language': 'Japanese',
+        'num': '5',
+        'text': 'きょうは ',
+        'persona': '東京在住の元教師です。',
+        'conversationHistory': '相手: こんにちは\n自分: こんにちは',
+    },
+    {
+        'language':
+            'English',
+        'num':
+            '5',
+        'text':
+            'See you',
+        'persona':
+            'I like long walks. ' * 100,
+        'conversationHistory':
+            '\n'.join(
+                f'Partner: This is turn {i} of a long chat.' for i in range(200)
+            ),
+    },
+]
+
+
+def legacy_render_prompt(macro_id, user_inputs):
+  """The renderer used before templates were compiled."""
+  lines = []
+  include_block = []
+  for line in macro.TEMPLATES[macro_id].split('\n'):
+    matched_defined_keyword = re.match(r'^#ifdef (\w+)$', line)
+    if matched_defined_keyword:
+      is_defined = bool(user_inputs.get(matched_defined_keyword.group(1)))
+      include_block.append(is_defined)
+      continue
+    if re.match(r'^#else$', line):
+      top = include_block.pop()
+      include_block.append(not top)
+      continue
+    if re.match(r'^#endif$', line):
+      include_block.pop()
+      continue
+    if re.match(r'^#copybara:', line):
+      continue
+    if all(include_block):
+      lines.append(line)
+  prompt = '\n'.join(lines)
+  prompt = re.sub(r'\\\n', '', prompt, flags=re.MULTILINE | re.DOTALL)
+  language = user_inputs.get('language', '')
+  for key in user_inputs:
+    user_input = user_inputs[key]
+    if key == 'text' and language == 'Japanese':
+      user_input = user_input.replace(' ', '§')
+    if key == 'text' and macro_id == 'WordGeneric20240628':
+      user_input = re.sub(r'§$', ' ', user_input.replace(' ', '§'))
+    prompt = prompt.replace(f'[[{key}]]', user_input)
+  return prompt
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      '-n',
+      '--number',
+      type=int,
+      default=2000,
+      help='Number of renders per macro and input.')
+  args = parser.parse_args()
+  # The legacy renderer did not compact the context.
+  compaction.DEFAULT_TOKEN_BUDGET = 0
+
+  print(f'{"Macro ID":32} {"legacy (us)":>12} {"compiled (us)":>14} '
+        f'{"speedup":>8}')
+  for macro_id in macro.TEMPLATES:
+    for user_inputs in USER_INPUTS:
+      assert macro.RenderPrompt(macro_id, user_inputs) == legacy_render_prompt(
+          macro_id, user_inputs), macro_id
+    legacy = timeit.timeit(
+        lambda: [legacy_render_prompt(macro_id, u) for u in USER_INPUTS],
+        number=args.number)
+    compiled = timeit.timeit(
+        lambda: [macro.RenderPrompt(macro_id, u) for u in USER_INPUTS],
+        number=args.number)
+    renders = args.number * len(USER_INPUTS)
+    print(f'{macro_id:32} {legacy / renders * 1e6:12.2f} '
+          f'{compiled / renders * 1e6:14.2f} {legacy / compiled:7.1f}x')
+
+
+if __name__ == '__main__':
+  main()
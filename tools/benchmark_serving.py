@@ -0,0 +1,120 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Load generator comparing the sync and async serving modes.
+
+Sends concurrent `/run-macro` requests to a running server and reports
+throughput and latency percentiles. Start each server in turn and point the
+benchmark at it, e.g.:
+
+  $ gunicorn -w 2 --threads 8 -b 127.0.0.1:8000 main:app
+  $ python benchmark_serving.py --url http://127.0.0.1:8000 -c 64 -n 1000
+
+  $ uvicorn main_async:app --workers 2 --port 8001
+  $ python benchmark_serving.py --url http://127.0.0.1:8001 -c 64 -n 1000
+
+Note that every request calls the configured model, so a cold cache and a
+non-zero temperature are used by default to avoid measuring cache hits.
+"""
+
+import argparse
+import asyncio
+import json
+import re
+import statistics
+import time
+
+import httpx
+
+
+async def fetch_csrf_token(client):
+  response = await client.get('/')
+  response.raise_for_status()
+  return re.search(r'data-csrf-token="([^"]*)"', response.text).group(1)
+
+
+async def run_request(client, form, latencies, errors):
+  start = time.perf_counter()
+  try:
+    response = await client.post('/run-macro', data=form)
+    response.raise_for_status()
+    latencies.append(time.perf_counter() - start)
+  except httpx.HTTPError as e:
+    errors.append(e)
+
+
+async def run_benchmark(args):
+  limits = httpx.Limits(max_connections=args.concurrency)
+  async with httpx.AsyncClient(
+      base_url=args.url, limits=limits, timeout=args.timeout) as client:
+    token = await fetch_csrf_token(client)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    errors = []
+
+    async def worker(i):
+      form = {
+          'id':
+              args.macro_id,
+          'userInputs':
+              json.dumps({
+                  'language': 'English',
+                  'num': '5',
+                  # Vary the text so that no response is served from cache.
+                  'text': f'{args.text} {i}',
+              }),
+          'temperature':
+              str(args.temperature),
+          'model_id':
+              args.model_id,
+          '_csrf_token':
+              token,
+      }
+      async with semaphore:
+        await run_request(client, form, latencies, errors)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+  print(f'URL: {args.url}')
+  print(f'Requests: {args.requests} (concurrency {args.concurrency})')
+  print(f'Errors: {len(errors)}')
+  print(f'Throughput: {len(latencies) / elapsed:.2f} req/s')
+  if len(latencies) >= 2:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f'Latency p50: {quantiles[49] * 1000:.1f} ms')
+    print(f'Latency p90: {quantiles[89] * 1000:.1f} ms')
+    print(f'Latency p99: {quantiles[98] * 1000:.1f} ms')
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument(
+      '--url', default='http://127.0.0.1:5000', help='Server base URL.')
+  parser.add_argument(
+      '-c', '--concurrency', type=int, default=32, help='Concurrent requests.')
+  parser.add_argument(
+      '-n', '--requests', type=int, default=200, help='Total requests.')
+  parser.add_argument('--macro-id', default='SentenceGeneric20250311')
+  parser.add_argument('--model-id', default='gemini-2.0-flash-001')
+  parser.add_argument('--text', default='I would like')
+  parser.add_argument('--temperature', type=float, default=0.1)
+  parser.add_argument(
+      '--timeout', type=float, default=60, help='Request timeout in seconds.')
+  asyncio.run(run_benchmark(parser.parse_args()))
+
+
+if __name__ == '__main__':
+  main()
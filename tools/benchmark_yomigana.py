@@ -0,0 +1,132 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark of target preprocessing in the Japanese simulator.
+
+Compares `simple_simulator_ja.align_yomigana`, which parses each target once
+with MeCab, with the previous approach of parsing every token and then the
+whole target again. TinySegmenter is timed separately for reference. Also
+reports tokens whose yomigana differ, since the single parse reads tokens in
+the context of their sentence.
+
+Usage:
+  $ python benchmark_yomigana.py --input sentences.txt
+"""
+
+import argparse
+import time
+
+import simple_simulator_ja as sim
+
+SAMPLE_TARGETS = [
+    '水を飲みたいです。',
+    '今日は少し休みたい。',
+    'テレビをつけてください。',
+    'すみません、足が痛いです。',
+    '明日の午後に病院へ行く予定があります。',
+    'ヘルパーさんに連絡してもらえますか？',
+    '窓を開けて、部屋の空気を入れ替えてほしい。',
+    '昨日見た映画はとても面白かったです。',
+]
+
+
+def legacy_katakana_to_hiragana(text):
+  return ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ン' else ch for ch in text)
+
+
+def legacy_align_yomigana(target, target_tokens, mecab_tagger):
+  """Per-token parses followed by a parse of the whole target."""
+  token_yomigana = [
+      sim.get_yomigana(token, mecab_tagger) for token in target_tokens
+  ]
+  return token_yomigana, sim.get_sentence_yomigana(target, mecab_tagger)
+
+
+def time_per_target(fn, targets, repeat):
+  start = time.perf_counter()
+  for _ in range(repeat):
+    for target in targets:
+      fn(target)
+  return (time.perf_counter() - start) / repeat / len(targets)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument(
+      '-i',
+      '--input',
+      help='Corpus with one target per line. Defaults to sample targets.')
+  parser.add_argument(
+      '-n',
+      '--repeat',
+      type=int,
+      default=500,
+      help='Number of times the corpus is processed.')
+  args = parser.parse_args()
+
+  if args.input:
+    with open(args.input, encoding='utf-8') as f:
+      targets = [line.strip() for line in f if line.strip()]
+  else:
+    targets = SAMPLE_TARGETS
+  tiny_segmenter = sim.initialize_tiny_segmenter()
+  mecab_tagger = sim.initialize_mecab_tagger()
+
+  tokens_by_target = {
+      target: sim.tokenize_with_tinysegmenter(target, tiny_segmenter)
+      for target in targets
+  }
+  tokenize = time_per_target(
+      lambda t: sim.tokenize_with_tinysegmenter(t, tiny_segmenter), targets,
+      args.repeat)
+  legacy = time_per_target(
+      lambda t: legacy_align_yomigana(t, tokens_by_target[t], mecab_tagger),
+      targets, args.repeat)
+  single_parse = time_per_target(
+      lambda t: sim.align_yomigana(t, tokens_by_target[t], mecab_tagger),
+      targets, args.repeat)
+
+  text = ''.join(targets) * 100
+  start = time.perf_counter()
+  legacy_katakana_to_hiragana(text)
+  legacy_kana = time.perf_counter() - start
+  start = time.perf_counter()
+  sim.katakana_to_hiragana(text)
+  translate_kana = time.perf_counter() - start
+
+  tokens = 0
+  differences = []
+  for target, target_tokens in tokens_by_target.items():
+    old = legacy_align_yomigana(target, target_tokens, mecab_tagger)
+    new = sim.align_yomigana(target, target_tokens, mecab_tagger)
+    assert old[1] == new[1], target
+    tokens += len(target_tokens)
+    differences.extend((token, old_yomigana, new_yomigana)
+                       for token, old_yomigana, new_yomigana in zip(
+                           target_tokens, *old[:1], new[0])
+                       if old_yomigana != new_yomigana)
+
+  print(f'Targets: {len(targets)} x {args.repeat}')
+  print(f'TinySegmenter: {tokenize * 1e6:.1f} us/target')
+  print(f'Yomigana, per-token parses: {legacy * 1e6:.1f} us/target')
+  print(f'Yomigana, single parse: {single_parse * 1e6:.1f} us/target '
+        f'({legacy / single_parse:.1f}x)')
+  print(f'Kana conversion: {legacy_kana / translate_kana:.1f}x faster')
+  print(f'Tokens with a different yomigana: {len(differences)} / {tokens}')
+  for token, old_yomigana, new_yomigana in differences[:20]:
+    print(f'  {token}: {old_yomigana} -> {new_yomigana}')
+
+
+if __name__ == '__main__':
+  main()
@@ -16,15 +16,30 @@
 Usage:
   $ export API_KEY=(API key)
   $ PYTHONPATH=(Path to VOICE app) python -u simple_simulator.py < input.txt
+
+Also reports the share of keystrokes whose word suggestions can be derived
+from the sentence suggestions, i.e. that would not need the word macro call
+with DERIVE_WORD_SUGGESTIONS on the server. With --derive-words, the derived
+words are also used instead of calling the word macro, to measure their
+effect on the metrics.
+
+With --combined-macro-id, a macro of `macro.COMBINED_MACROS` generates both
+lists in one call per keystroke, to compare it with the pair of macros.
+
+Set MODEL_BACKEND=stub to run offline against the local stand-in model in
+`stub_model.py` instead of the Gemini API. Set MACRO_RECORD_PATH to record
+model responses to a file, and MACRO_REPLAY_PATH to re-run from the recorded
+responses without any model calls.
 """
 
+import argparse
 import json
 import re
 import sys
 
 import macro
 
-SENTENCE_MACRO_ID = 'SentenceEnglish20240703'
+SENTENCE_MACRO_ID = 'SentenceGeneric20250311'
 WORD_MACRO_ID = 'WordGeneric20240628'
 MODEL_ID = 'gemini-1.5-flash-002'
 
@@ -47,8 +62,8 @@ INITIAL_PHRASES = [
 ]
 
 
-def parse_response(response):
-  response_text = json.loads(response)['messages'][0]['text']
+def parse_response(response, message_index=0):
+  response_text = json.loads(response)['messages'][message_index]['text']
   response_text = response_text.replace('\\\n', '')
   lines = [
       re.sub(r'^\d+\.\s?', '', text.strip())
@@ -58,16 +73,25 @@ def parse_response(response):
   return lines
 
 
-def word_suggestions(text):
+def word_suggestions(text, macro_id=WORD_MACRO_ID):
   user_input = {'language': 'English', 'num': '5', 'text': text}
-  response = macro.RunMacro(WORD_MACRO_ID, user_input, 0, MODEL_ID)
-  return parse_response(response)
+  response = macro.RunMacro(macro_id, user_input, 0, MODEL_ID)
+  # Words are the second list of a combined macro.
+  return parse_response(response, 1 if macro_id in macro.COMBINED_MACROS else 0)
 
 
-def sentence_suggestions(text):
+def sentence_suggestions(text, macro_id=SENTENCE_MACRO_ID):
   user_input = {'language': 'English', 'num': '5', 'text': text}
-  response = macro.RunMacro(SENTENCE_MACRO_ID, user_input, 0, MODEL_ID)
-  return parse_response(response)[0:NUM_SENTENCE_SUGGESTIONS]
+  response = macro.RunMacro(macro_id, user_input, 0, MODEL_ID)
+  return parse_response(response)
+
+
+def derived_word_suggestions(text, sentences):
+  """Returns the next words in sentence suggestions, or None if too few."""
+  words = macro.DeriveWordSuggestions(text, sentences, 5)
+  if len(words) < macro.DERIVED_WORDS_MIN_CANDIDATES:
+    return None
+  return words
 
 
 def tokenize(sentence):
@@ -122,7 +146,7 @@ def join_tokens(tokens):
   return re.sub(r' ([.,!?]+)(?= |$)', r'\1', text)
 
 
-def simulate(target):
+def simulate(target, derive_words=False, combined_macro_id=None):
 
   print('target:', target)
   target_tokens = tokenize(target)
@@ -135,6 +159,11 @@ def simulate(target):
   word_len = 0
   sentence_len = 0
 
+  sentence_calls = 0
+  derivable_count = 0
+  word_calls = 0
+  word_calls_avoided = 0
+
   for phrase in INITIAL_PHRASES:
     if target.lower().startswith(phrase.lower()):
       # Is this OK...?
@@ -152,7 +181,13 @@ def simulate(target):
 
     text_tokens = tokenize(text)
 
-    sentences = sentence_suggestions(text)
+    all_sentences = sentence_suggestions(text, combined_macro_id or
+                                         SENTENCE_MACRO_ID)
+    sentence_calls += 1
+    derived_words = derived_word_suggestions(text, all_sentences)
+    if derived_words:
+      derivable_count += 1
+    sentences = all_sentences[0:NUM_SENTENCE_SUGGESTIONS]
     print('sentence suggestions:', sentences)
     selected_sentence = select_from_sentence_suggestions(
         target_tokens, text_tokens, sentences)
@@ -164,8 +199,18 @@ def simulate(target):
       sentence_len += len(text) - text_len
       continue
 
-    words = word_suggestions(text)
-    print('word suggestions:', words)
+    if combined_macro_id:
+      # Served from the response cache without another model call.
+      words = word_suggestions(text, combined_macro_id)
+      print('word suggestions:', words)
+    elif derive_words and derived_words:
+      words = derived_words
+      word_calls_avoided += 1
+      print('derived word suggestions:', words)
+    else:
+      words = word_suggestions(text)
+      word_calls += 1
+      print('word suggestions:', words)
     selected_word = select_from_word_suggestions(target_tokens, text_tokens,
                                                  words)
     if selected_word:
@@ -205,11 +250,26 @@ def simulate(target):
 
   return [
       len(text), initial_phrase_count, char_count, word_count, word_len,
-      sentence_count, sentence_len
+      sentence_count, sentence_len, sentence_calls, derivable_count, word_calls,
+      word_calls_avoided
   ]
 
 
 def main():
+  parser = argparse.ArgumentParser(
+      description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument(
+      '--derive-words',
+      action='store_true',
+      help='Use word suggestions derived from the sentence suggestions when '
+      'enough come out, instead of calling the word macro.')
+  parser.add_argument(
+      '--combined-macro-id',
+      choices=sorted(macro.COMBINED_MACROS),
+      help='Combined macro generating both the word and the sentence '
+      'suggestions, instead of the pair of macros.')
+  args = parser.parse_args()
+
   total_len = 0
   char_count = 0
   word_count = 0
@@ -217,8 +277,13 @@ def main():
   initial_phrase_count = 0
   word_len = 0
   sentence_len = 0
+  sentence_calls = 0
+  derivable_count = 0
+  word_calls = 0
+  word_calls_avoided = 0
   for line in sys.stdin:
-    [t, i, c, wc, wl, sc, sl] = simulate(line.rstrip('\n'))
+    [t, i, c, wc, wl, sc, sl, scalls, dc, wcalls, wca
+    ] = simulate(line.rstrip('\n'), args.derive_words, args.combined_macro_id)
     total_len += t
     initial_phrase_count += i
     char_count += c
@@ -226,6 +291,10 @@ def main():
     sentence_count += sc
     word_len += wl
     sentence_len += sl
+    sentence_calls += scalls
+    derivable_count += dc
+    word_calls += wcalls
+    word_calls_avoided += wca
 
     # TODO: Emit the result more reliable way and only when necessary.
     print('total len:', total_len, 'initial_phrase_count:',
@@ -246,6 +315,12 @@ def main():
     print(
         'average chars per selection:', total_len /
         (char_count + word_count + sentence_count + initial_phrase_count))
+    # The app requests both macros on every keystroke, so this is the share of
+    # word macro calls avoided with DERIVE_WORD_SUGGESTIONS.
+    print('keystrokes with derivable word suggestions:', derivable_count, '/',
+          sentence_calls, f'({derivable_count / max(sentence_calls, 1):.1%})')
+    print('word macro calls:', word_calls, 'avoided:', word_calls_avoided)
+    print('model calls:', sentence_calls + word_calls)
 
 
 if __name__ == '__main__':
@@ -37,16 +37,48 @@ It can be run in two modes:
       --output <results.csv> \
       --model-id 'gemini-2.0-flash-001' \
       --sentence-macro-id 'SentenceJapaneseLong20241002'
+   Add `--concurrency 16` to simulate 16 lines in parallel, and `--rpm` and
+   `--tpm` to stay within the API quota. The results are the same as with a
+   sequential run.
+   To split a run across machines, run each shard with e.g.
+   `--shard 0/4 --partial-output part0.json`, then merge them with
+   `--merge part*.json --output <results.csv>`. The merged row is the same as
+   that of a single run; its duration is the sum of those of the shards.
+   To compare macros or models, pass several values to `--model-ids`,
+   `--sentence-macro-ids` or `--word-macro-ids`. Every combination is
+   simulated in one job with one CSV row each, and identical model calls are
+   made once.
+   With `--stop-ksr-ci 2`, lines are simulated in random order until the 95%
+   confidence interval of the KSR is narrower than 2 points (and likewise
+   `--stop-cpc-ci` for chars per click). In a grid experiment,
+   `--stop-when-separable` stops once every two configurations differ. As
+   the intervals are checked repeatedly without correction, this finds more
+   differences than there are; confirm them with a fixed-length run. The
+   CSV reports the interval widths, and the lines used. Each row also has
+   bootstrap 95% confidence intervals of the KSR and the suggestion select
+   rate over lines (see `--bootstrap-resamples`).
+   The tokenized input is saved as `<input>.<hash>.prep.jsonl` next to the
+   input (or in `--preprocessed-dir`) and reused while the input is unchanged.
 """
-from collections import Counter
+from concurrent import futures
+import contextlib
+import functools
+import hashlib
+import itertools
+import math
+import random
+import statistics
 from datetime import datetime
 import MeCab
+import io
 import json
 import os
 import sys
+import threading
 import traceback
 import re
 import ipadic
+import numpy as np
 import tinysegmenter
 import argparse
 import csv
@@ -67,9 +99,12 @@ if parent_directory not in sys.path:
   sys.path.append(parent_directory)
 
 import macro
+import rate_limit
 # --- macro imported ---
 
 NUM_SENTENCE_SUGGESTIONS = 2
+# Bump when `analyze_target` changes to invalidate preprocessed corpora.
+PREPROCESS_VERSION = 1
 INITIAL_PHRASES_JA = [
     'はい', 'いいえ', 'ありがとう', 'すみません', 'お願いします', '私', 'あなた', '彼', '彼女', '今日', '昨日',
     '明日'
@@ -77,12 +112,13 @@ INITIAL_PHRASES_JA = [
 
 
 # --- Helper Functions ---
-def parse_response(response):
+def parse_response(response, message_index=0):
   try:
     if not response:
       return []
     response_data = json.loads(response)
-    response_text = response_data.get('messages', [{}])[0].get('text', '')
+    response_text = response_data.get('messages',
+                                      [{}])[message_index].get('text', '')
     if not response_text:
       return []
     response_text = response_text.replace('\\\n', '')
@@ -103,7 +139,9 @@ def word_suggestions(text_context, word_macro_id, model_id):
   if DEBUG_LLM_RAW:
     print(f"DEBUG LLM word_suggestions response for '{text_context}':",
           repr(response))
-  parsed_suggestions = parse_response(response)
+  # Words are the second list of a combined macro.
+  parsed_suggestions = parse_response(
+      response, 1 if word_macro_id in macro.COMBINED_MACROS else 0)
   if DEBUG_LLM_PARSED:
     print(f"DEBUG Parsed word suggestions:", parsed_suggestions)
   return parsed_suggestions
@@ -121,8 +159,52 @@ def sentence_suggestions(text, sentence_macro_id, model_id):
   return parsed_suggestions[0:NUM_SENTENCE_SUGGESTIONS]
 
 
+def word_macro_of(sentence_macro_id, word_macro_id):
+  """Returns the word macro used with a sentence macro.
+
+  A combined macro of `macro.COMBINED_MACROS` also generates the words, and a
+  word call for the text of a sentence call is served from the response cache
+  without calling the model again.
+  """
+  if sentence_macro_id in macro.COMBINED_MACROS:
+    return sentence_macro_id
+  return word_macro_id
+
+
+def iter_word_suggestions(contexts, sim_params):
+  """Yields word suggestions for each context in order.
+
+  With a `prefetch_executor` in `sim_params`, all the calls are issued ahead of
+  time and run concurrently, so that the caller only waits for the first one.
+  Calls not started yet are cancelled when the caller closes the generator,
+  e.g. once a suggestion has been taken.
+  """
+  word_macro_id = sim_params['word_macro_id']
+  model_id = sim_params['model_id']
+  executor = sim_params.get('prefetch_executor')
+  if executor is None:
+    for context in contexts:
+      yield word_suggestions(context, word_macro_id, model_id)
+    return
+  pending = [
+      executor.submit(word_suggestions, context, word_macro_id, model_id)
+      for context in contexts
+  ]
+  try:
+    for future in pending:
+      yield future.result()
+  finally:
+    for future in pending:
+      future.cancel()
+
+
+# Maps katakana (from 'ァ' to 'ン') to hiragana for `str.translate`.
+_KATAKANA_TO_HIRAGANA = str.maketrans(''.join(map(chr, range(0x30A1, 0x30F4))),
+                                      ''.join(map(chr, range(0x3041, 0x3094))))
+
+
 def katakana_to_hiragana(text):
-  return ''.join(chr(ord(ch) - 0x60) if 'ァ' <= ch <= 'ン' else ch for ch in text)
+  return text.translate(_KATAKANA_TO_HIRAGANA)
 
 
 def initialize_tiny_segmenter():
@@ -212,6 +294,121 @@ def get_sentence_yomigana(text, mecab_tagger):
     return ""
 
 
+def _node_reading(node):
+  features = node.feature.split(',')
+  if len(features) > 7 and features[7] != '*':
+    return features[7]
+  return node.surface
+
+
+@functools.lru_cache(maxsize=65536)
+def _cached_token_yomigana(token, mecab_tagger):
+  # Tokens not aligned with MeCab nodes, e.g. 'く' and 'ださい' split from
+  # 'ください', recur across a corpus.
+  return get_yomigana(token, mecab_tagger)
+
+
+def analyze_target(target, tiny_segmenter, mecab_tagger):
+  """Preprocesses a target for `simulate_japanese`.
+
+  The target is tokenized and its yomigana are derived with a single MeCab
+  parse. The result only depends on the target, so it can be stored in a
+  preprocessed corpus (see `load_preprocessed_corpus`).
+
+  Returns:
+    A JSON-serializable dict with the target, its tokens, the yomigana of
+    each token, the yomigana of the whole target, its keystroke count and the
+    tokens of the matching initial phrase, if any.
+  """
+  target_tokens = tokenize_with_tinysegmenter(target, tiny_segmenter)
+  if not target_tokens and target:
+    print(
+        f"WARN: Tokenizer returned empty list for non-empty target: '{target}'. Using char split.",
+        file=sys.stderr)
+    target_tokens = [char for char in target]
+  token_yomigana, sentence_yomigana = align_yomigana(target, target_tokens,
+                                                     mecab_tagger)
+  initial_phrase_tokens = match_initial_phrase(target, target_tokens,
+                                               tiny_segmenter)
+  return {
+      'target': target,
+      'tokens': target_tokens,
+      'yomigana': token_yomigana,
+      'sentence_yomigana': sentence_yomigana,
+      'keystrokes': len(sentence_yomigana),
+      'initial_phrase_tokens': initial_phrase_tokens,
+  }
+
+
+def match_initial_phrase(target, target_tokens, tiny_segmenter):
+  """Returns the tokens of the longest initial phrase starting the target."""
+  best_match_tokens = []
+  best_match_phrase = ""
+  for phrase in INITIAL_PHRASES_JA:
+    if target.startswith(phrase):
+      if len(phrase) > len(best_match_phrase):
+        current_match_tokens = tokenize_with_tinysegmenter(
+            phrase, tiny_segmenter)
+        if target_tokens[:len(current_match_tokens)] == current_match_tokens:
+          best_match_phrase = phrase
+          best_match_tokens = current_match_tokens
+  return best_match_tokens
+
+
+def align_yomigana(target, target_tokens, mecab_tagger):
+  """Returns the yomigana of each token and of the whole target.
+
+  The target is parsed once, and MeCab nodes are aligned to the tokens by
+  their character offsets. A token made of whole nodes gets the readings of
+  those nodes, i.e. its reading in the context of the sentence. Tokens whose
+  boundaries fall inside a node are parsed on their own with `get_yomigana`.
+  """
+  if not mecab_tagger:
+    return ([get_yomigana(t, None) for t in target_tokens],
+            get_sentence_yomigana(target, mecab_tagger))
+
+  # (start, end, reading) of each node with a surface.
+  spans = []
+  readings = []
+  try:
+    mecab_tagger.parse('')
+    node = mecab_tagger.parseToNode(target)
+    pos = 0
+    while node:
+      reading = _node_reading(node)
+      readings.append(reading)
+      start = target.find(node.surface, pos) if node.surface else -1
+      if start >= 0:
+        pos = start + len(node.surface)
+        spans.append((start, pos, reading))
+      node = node.next
+  except Exception as e:
+    print(f"ERROR: analyze_target failed: {e}", file=sys.stderr)
+    spans = []
+    readings = []
+  sentence_yomigana = katakana_to_hiragana(''.join(readings))
+
+  span_index_by_start = {span[0]: i for i, span in enumerate(spans)}
+  token_yomigana = []
+  pos = 0
+  for token in target_tokens:
+    start = target.find(token, pos)
+    if start < 0:
+      token_yomigana.append(_cached_token_yomigana(token, mecab_tagger))
+      continue
+    pos = start + len(token)
+    i = span_index_by_start.get(start)
+    token_readings = []
+    while i is not None and i < len(spans) and spans[i][1] <= pos:
+      token_readings.append(spans[i][2])
+      i += 1
+    if token_readings and spans[i - 1][1] == pos:
+      token_yomigana.append(katakana_to_hiragana(''.join(token_readings)))
+    else:
+      token_yomigana.append(_cached_token_yomigana(token, mecab_tagger))
+  return token_yomigana, sentence_yomigana
+
+
 def tokenize_with_tinysegmenter(text, tiny_segmenter):
   if not tiny_segmenter:
     return [char for char in text]
@@ -227,20 +424,22 @@ def common_prefix(target_tokens, text_tokens):
 
 
 # --- Main Simulation Function ---
-def simulate_japanese(target, tiny_segmenter, mecab_tagger, sim_params,
-                      sugg_lengths_log):
+def simulate_japanese(target,
+                      tiny_segmenter,
+                      mecab_tagger,
+                      sim_params,
+                      sugg_lengths_log,
+                      analysis=None):
   model_id = sim_params['model_id']
   sentence_macro_id = sim_params['sentence_macro_id']
   word_macro_id = sim_params['word_macro_id']
   output_stream = sim_params['output_stream']
 
-  target_tokens = tokenize_with_tinysegmenter(target, tiny_segmenter)
-  if not target_tokens and target:
-    print(
-        f"WARN: Tokenizer returned empty list for non-empty target: '{target}'. Using char split.",
-        file=sys.stderr)
-    target_tokens = [char for char in target]
-  elif not target_tokens and not target:
+  if analysis is None:
+    analysis = analyze_target(target, tiny_segmenter, mecab_tagger)
+  target_tokens = analysis['tokens']
+  token_yomigana = analysis['yomigana']
+  if not target_tokens:
     return [0, 0, 0, 0, 0, 0, 0]
 
   text_tokens = []
@@ -252,19 +451,9 @@ def simulate_japanese(target, tiny_segmenter, mecab_tagger, sim_params,
   w_sugg_segments_this_run = 0
 
   # --- Start Initial Phase ---
-  best_match_tokens = []
-  best_match_phrase = ""
-  for phrase in INITIAL_PHRASES_JA:
-    if target.startswith(phrase):
-      if len(phrase) > len(best_match_phrase):
-        current_match_tokens = tokenize_with_tinysegmenter(
-            phrase, tiny_segmenter)
-        if target_tokens[:len(current_match_tokens)] == current_match_tokens:
-          best_match_phrase = phrase
-          best_match_tokens = current_match_tokens
-
+  best_match_tokens = analysis['initial_phrase_tokens']
   if best_match_tokens:
-    text_tokens = best_match_tokens
+    text_tokens = list(best_match_tokens)
     cost_added = 1
     total_clicks += cost_added
     word_suggestion_used += 1
@@ -277,17 +466,21 @@ def simulate_japanese(target, tiny_segmenter, mecab_tagger, sim_params,
   else:
     if target_tokens:
       next_target_surface_token = target_tokens[0]
-      yomigana_hiragana = get_yomigana(next_target_surface_token, mecab_tagger)
-      current_char_input = ""
+      yomigana_hiragana = token_yomigana[0]
       typed_chars_count = 0
       suggestion_taken_initial = False
 
-      for yomi_char in yomigana_hiragana:
-        current_char_input += yomi_char
-        typed_chars_count += 1
-        context_text = current_char_input
-        suggestions = word_suggestions(context_text, word_macro_id, model_id)
-        if next_target_surface_token in suggestions:
+      # The typed prefixes are known in advance, so they can be prefetched.
+      prefixes = [
+          yomigana_hiragana[:i] for i in range(1,
+                                               len(yomigana_hiragana) + 1)
+      ]
+      with contextlib.closing(iter_word_suggestions(prefixes,
+                                                    sim_params)) as ahead:
+        for suggestions in ahead:
+          typed_chars_count += 1
+          if next_target_surface_token not in suggestions:
+            continue
           text_tokens = [next_target_surface_token]
           cost_added = typed_chars_count + 1
           total_clicks += cost_added
@@ -390,15 +583,24 @@ def simulate_japanese(target, tiny_segmenter, mecab_tagger, sim_params,
     # --- Step 3 & 4: Fallback Logic ---
     if len(text_tokens) < len(target_tokens):
       next_target_surface_token = target_tokens[len(text_tokens)]
-      yomigana_hiragana = get_yomigana(next_target_surface_token, mecab_tagger)
+      yomigana_hiragana = token_yomigana[len(text_tokens)]
 
       suggestion_taken_in_fallback = False
 
+      # The contexts of Steps 3 and 4 are known in advance, so they can be
+      # prefetched: the first character after the current text, and then
+      # each prefix of the token typed on its own.
+      fallback_contexts = []
+      if yomigana_hiragana:
+        fallback_contexts.append("".join(text_tokens) + yomigana_hiragana[0])
+      fallback_contexts.extend(yomigana_hiragana[:i]
+                               for i in range(1,
+                                              len(yomigana_hiragana) + 1))
+      ahead = iter_word_suggestions(fallback_contexts, sim_params)
+
       # --- Step 3: First-Character Suggestion ---
       if yomigana_hiragana:
-        context_text_1st_char = "".join(text_tokens) + yomigana_hiragana[0]
-        suggestions = word_suggestions(context_text_1st_char, word_macro_id,
-                                       model_id)
+        suggestions = next(ahead)
         if next_target_surface_token in suggestions:
           text_tokens.append(next_target_surface_token)
           cost_added = 2
@@ -414,16 +616,12 @@ def simulate_japanese(target, tiny_segmenter, mecab_tagger, sim_params,
 
       # --- Step 4: Final Fallback (Character-by-character) ---
       if not suggestion_taken_in_fallback:
-        current_char_input_final = ""
         typed_chars_count_final = 0
         suggestion_taken_in_char_loop = False
 
-        for yomi_char in yomigana_hiragana:
-          current_char_input_final += yomi_char
+        # Each context is the typed prefix of the token alone (mid-word typing).
+        for suggestions in ahead:
           typed_chars_count_final += 1
-          context_text_char_loop = current_char_input_final  # Local context for mid-word typing
-          suggestions = word_suggestions(context_text_char_loop, word_macro_id,
-                                         model_id)
           if next_target_surface_token in suggestions:
             text_tokens.append(next_target_surface_token)
             cost_added = typed_chars_count_final + 1
@@ -447,6 +645,8 @@ def simulate_japanese(target, tiny_segmenter, mecab_tagger, sim_params,
             print(
                 f"  [STATS] Direct Input (Yomi): clicks +{cost_added} (Added: '{next_target_surface_token}' by typing '{yomigana_hiragana}')",
                 file=output_stream)
+      # Cancel prefetched calls that were not needed.
+      ahead.close()
 
     if text_tokens == target_tokens:
       break
@@ -482,9 +682,15 @@ def append_to_csv(output_file, results_dict):
   for i in range(1, num_hist_bins + 1):
     fieldnames.append(f'WordSuggFreq_{i}')
   fieldnames.append(f'WordSuggFreq_{num_hist_bins + 1}plus')
+  fieldnames.extend(
+      ['KSR 95% CI Width', 'Chars per Click 95% CI Width', 'Stop Reason'])
+  for name in ('KSR', 'Select Rate'):
+    fieldnames.append(f'{name} Bootstrap CI Low (%)')
+    fieldnames.append(f'{name} Bootstrap CI High (%)')
 
-  file_exists = os.path.isfile(output_file)
   try:
+    output_file = csv_output_path(output_file, fieldnames)
+    file_exists = os.path.isfile(output_file)
     with open(
         output_file, 'a', newline='',
         encoding='utf-8') as f:  # 'a' is for append mode
@@ -494,6 +700,36 @@ def append_to_csv(output_file, results_dict):
       writer.writerow(results_dict)
   except IOError as e:
     print(f"Error writing to output file {output_file}: {e}", file=sys.stderr)
+  return output_file
+
+
+def read_csv_header(path):
+  """Returns the header of a CSV file, or None if it has none."""
+  with open(path, newline='', encoding='utf-8') as f:
+    return next(csv.reader(f), None)
+
+
+def csv_output_path(output_file, fieldnames):
+  """Returns the path to append a row with `fieldnames` to.
+
+  Rows are not appended to a file with another header, e.g. one written by an
+  older version with fewer columns, as the columns would not line up. The
+  first `<name>.<n>.csv` that does not exist or has the same header is used
+  instead.
+  """
+  root, ext = os.path.splitext(output_file)
+  path = output_file
+  n = 0
+  while os.path.isfile(path) and read_csv_header(path) not in (None,
+                                                               fieldnames):
+    n += 1
+    path = f'{root}.{n}{ext}'
+  if path != output_file:
+    print(
+        f"Warning: {output_file} has different columns. "
+        f"Writing to {path} instead.",
+        file=sys.stderr)
+  return path
 
 
 def run_batch_simulation(args):
@@ -501,7 +737,7 @@ def run_batch_simulation(args):
   """Runs simulation on a whole file and writes results to CSV."""
   print(f"Starting batch simulation...")
   print(f"  Input file: {args.input}")
-  print(f"  Output CSV: {args.output}")
+  print(f"  Output: {args.partial_output or args.output}")
   print(f"  Model ID: {args.model_id}")
 
   tiny_segmenter = initialize_tiny_segmenter()
@@ -509,20 +745,6 @@ def run_batch_simulation(args):
   if not tiny_segmenter or not mecab_tagger:
     return
 
-  stats = {
-      'total_len': 0,
-      'total_clicks': 0,
-      's_count': 0,
-      'w_count': 0,
-      'fb_count': 0,
-      'kb_input': 0,
-      'line_count': 0,
-      's_sugg_segments': 0,
-      'w_sugg_segments': 0
-  }
-
-  sugg_lengths_log = {'sentence': [], 'word': []}
-
   sim_params = {
       'model_id':
           args.model_id,
@@ -535,32 +757,78 @@ def run_batch_simulation(args):
   }
 
   try:
-    with open(args.input, 'r', encoding='utf-8') as f_in:
-      for line in f_in:
-        target = line.strip()
-        if not target:
-          continue
-        stats['line_count'] += 1
-
-        line_stats = simulate_japanese(target, tiny_segmenter, mecab_tagger,
-                                       sim_params, sugg_lengths_log)
-
-        stats['total_clicks'] += line_stats[0]
-        stats['s_count'] += line_stats[1]
-        stats['w_count'] += line_stats[2]
-        stats['fb_count'] += line_stats[3]
-        stats['total_len'] += line_stats[4]
-        stats['kb_input'] += len(get_sentence_yomigana(target, mecab_tagger))
-        stats['s_sugg_segments'] += line_stats[5]
-        stats['w_sugg_segments'] += line_stats[6]
-
+    corpus = load_preprocessed_corpus(args.input, tiny_segmenter, mecab_tagger,
+                                      args.preprocessed_dir)
   except FileNotFoundError:
     print(f"Error: Input file not found at {args.input}", file=sys.stderr)
     return
+  if args.shard:
+    shard_index, shard_count = args.shard
+    corpus = corpus[shard_index::shard_count]
+
+  if args.prefetch > 0:
+    sim_params['prefetch_executor'] = futures.ThreadPoolExecutor(
+        max_workers=args.prefetch)
+
+  if early_stopping_enabled(args):
+    random.Random(args.seed).shuffle(corpus)
+  stats_before = model_call_stats()
+  results, stop_reason = simulate_configs(corpus, [sim_params], tiny_segmenter,
+                                          mecab_tagger, args)
+  upstream, _ = model_calls_since(stats_before)
+  lines, sugg_lengths, _ = results[0]
+
+  duration_seconds = (datetime.now() - start_time).total_seconds()
+  run_params = {
+      'model_id': args.model_id,
+      'sentence_macro_id': args.sentence_macro_id,
+      'word_macro_id': args.word_macro_id,
+      'input_file': os.path.basename(args.input),
+  }
+  if args.partial_output:
+    write_partial_results(
+        args.partial_output, {
+            'run_params': run_params,
+            'input_sha256': file_sha256(args.input),
+            'shard': list(args.shard or (0, 1)),
+            'duration_seconds': duration_seconds,
+            'lines': lines.tolist(),
+            'sugg_lengths': {
+                kind: lengths.tolist() for kind, lengths in sugg_lengths.items()
+            },
+        })
+    print(f"Shard complete. Took {format_duration(duration_seconds)}. "
+          f"Partial results written to {args.partial_output}")
+    return
+
+  results_dict = build_results_row(run_params, lines, sugg_lengths,
+                                   duration_seconds, args, stop_reason)
+  output_file = append_to_csv(args.output, results_dict)
+  print(
+      f"Simulation complete. Took {format_duration(duration_seconds)}. Model calls: {upstream}. Results appended to {output_file}"
+  )
 
-  end_time = datetime.now()
-  duration_timedelta = end_time - start_time
-  duration_str = format_duration(duration_timedelta.total_seconds())
+
+def build_results_row(run_params,
+                      lines,
+                      sugg_lengths,
+                      duration_seconds,
+                      args,
+                      stop_reason='end of corpus'):
+  """Returns the CSV row of a run from its per-line results.
+
+  Args:
+    run_params: Model and macro IDs and the input file name of the run.
+    lines: Per-line results, see `simulate_corpus`.
+    sugg_lengths: Arrays of the segment counts added by each selected sentence
+      and word suggestion.
+    duration_seconds: Duration of the run.
+    args: Command line arguments, for the bootstrap parameters.
+    stop_reason: Why the run stopped, see `simulate_configs`.
+  """
+  stats = dict(zip(LINE_FIELDS, lines.sum(axis=0).tolist()))
+  stats['line_count'] = len(lines)
+  duration_str = format_duration(duration_seconds)
 
   # Calculate final metrics
   ksr = (1 - (stats['total_clicks'] /
@@ -579,17 +847,17 @@ def run_batch_simulation(args):
   # Calculate binned frequency distributions for making histogram
   num_hist_bins = 5  # We'll have bins for 1, 2, 3, 4, 5, and then 6+
   sentence_sugg_binned_freq = calculate_binned_frequency(
-      sugg_lengths_log['sentence'], num_hist_bins)
-  word_sugg_binned_freq = calculate_binned_frequency(sugg_lengths_log['word'],
+      sugg_lengths['sentence'], num_hist_bins)
+  word_sugg_binned_freq = calculate_binned_frequency(sugg_lengths['word'],
                                                      num_hist_bins)
 
   results_dict = {
       'Timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
       'Duration': duration_str,
-      'Model ID': args.model_id,
-      'Sentence Macro ID': args.sentence_macro_id,
-      'Word Macro ID': args.word_macro_id,
-      'Input File': os.path.basename(args.input),
+      'Model ID': run_params['model_id'],
+      'Sentence Macro ID': run_params['sentence_macro_id'],
+      'Word Macro ID': run_params['word_macro_id'],
+      'Input File': run_params['input_file'],
       'Total Lines Processed': stats['line_count'],
       'Total Target Characters': stats['total_len'],
       'Total Clicks': stats['total_clicks'],
@@ -622,10 +890,488 @@ def run_batch_simulation(args):
       f'WordSuggFreq_{num_hist_bins + 1}plus'] = word_sugg_binned_freq.get(
           f'Freq_{num_hist_bins + 1}plus', 0)
 
-  append_to_csv(args.output, results_dict)
-  print(
-      f"Simulation complete. Took {duration_str}. Results appended to {args.output}"
-  )
+  results_dict['KSR 95% CI Width'] = f"{ksr_ci_width(lines):.2f}"
+  results_dict['Chars per Click 95% CI Width'] = (
+      f"{chars_per_click_ci_width(lines):.2f}")
+  results_dict['Stop Reason'] = stop_reason
+
+  intervals = bootstrap_intervals(lines, args.bootstrap_resamples, args.seed)
+  for name, interval in zip(('KSR', 'Select Rate'), intervals):
+    results_dict[f'{name} Bootstrap CI Low (%)'] = f"{interval[0]:.2f}"
+    results_dict[f'{name} Bootstrap CI High (%)'] = f"{interval[1]:.2f}"
+  return results_dict
+
+
+def parse_shard(value):
+  """Parses a `--shard` value like '0/4' into (index, count)."""
+  index, sep, count = value.partition('/')
+  try:
+    index, count = int(index), int(count)
+  except ValueError:
+    raise argparse.ArgumentTypeError(
+        f"Shard must look like INDEX/COUNT, e.g. 0/4: '{value}'")
+  if not sep or not 0 <= index < count:
+    raise argparse.ArgumentTypeError(
+        f"Shard index must be in [0, COUNT): '{value}'")
+  return index, count
+
+
+def file_sha256(path):
+  with open(path, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_partial_results(path, partial):
+  """Writes the per-line results of a shard as JSON."""
+  with open(path, 'w', encoding='utf-8') as f:
+    json.dump(partial, f, ensure_ascii=False, indent=2)
+
+
+def merge_partial_results(paths):
+  """Merges partial results written by the shards of a run.
+
+  Returns:
+    A tuple of the run parameters, the per-line results and suggestion lengths
+    of all shards, and the summed duration of the shards.
+
+  Raises:
+    ValueError: If the partial results are not from the same run, or do not
+      cover every shard exactly once.
+  """
+  partials = []
+  for path in paths:
+    with open(path, encoding='utf-8') as f:
+      partials.append(json.load(f))
+  first = partials[0]
+  for key in ('run_params', 'input_sha256'):
+    if any(partial[key] != first[key] for partial in partials):
+      raise ValueError(f"Partial results differ in {key}.")
+  shard_count = first['shard'][1]
+  shard_indices = sorted(partial['shard'][0] for partial in partials)
+  if (any(partial['shard'][1] != shard_count for partial in partials) or
+      shard_indices != list(range(shard_count))):
+    raise ValueError(f"Expected each of {shard_count} shards exactly once, "
+                     f"got shards {shard_indices}.")
+
+  # Restores the order of lines in the corpus, so that the bootstrap draws the
+  # same resamples as a single run.
+  lines = np.zeros(
+      (sum(len(partial['lines']) for partial in partials), len(LINE_FIELDS)),
+      dtype=np.int64)
+  for partial in partials:
+    if partial['lines']:
+      lines[partial['shard'][0]::shard_count] = partial['lines']
+  sugg_lengths = {
+      kind:
+          np.array([
+              length
+              for partial in partials
+              for length in partial['sugg_lengths'][kind]
+          ],
+                   dtype=np.int64) for kind in ('sentence', 'word')
+  }
+  duration_seconds = sum(partial['duration_seconds'] for partial in partials)
+  return first['run_params'], lines, sugg_lengths, duration_seconds
+
+
+def run_merge(args):
+  """Merges partial results and appends the row of the whole run to CSV."""
+  run_params, lines, sugg_lengths, duration_seconds = (
+      merge_partial_results(args.merge))
+  results_dict = build_results_row(run_params, lines, sugg_lengths,
+                                   duration_seconds, args)
+  output_file = append_to_csv(args.output, results_dict)
+  print(f"Merged {len(args.merge)} shards. Results appended to {output_file}")
+
+
+def run_grid_experiment(args):
+  """Simulates every configuration of a grid and appends a CSV row for each.
+
+  Configurations are the product of `--model-ids`, `--sentence-macro-ids` and
+  `--word-macro-ids`. The corpus is preprocessed once, and the response cache
+  of `macro` keeps every temperature 0 response for the whole job, so a call
+  made by several configurations, e.g. a word suggestion call of a shared word
+  macro, reaches the model only once. A combined sentence macro generates the
+  words too, so it is not paired with the word macros.
+  """
+  configs = list(
+      dict.fromkeys(
+          (model_id, sentence_macro_id,
+           word_macro_of(sentence_macro_id, word_macro_id))
+          for model_id, sentence_macro_id, word_macro_id in itertools.product(
+              args.model_ids or [args.model_id], args.sentence_macro_ids or
+              [args.sentence_macro_id], args.word_macro_ids or
+              [args.word_macro_id])))
+  print(f"Starting grid experiment of {len(configs)} configurations...")
+  print(f"  Input file: {args.input}")
+  print(f"  Output CSV: {args.output}")
+
+  tiny_segmenter = initialize_tiny_segmenter()
+  mecab_tagger = initialize_mecab_tagger()
+  if not tiny_segmenter or not mecab_tagger:
+    return
+  try:
+    corpus = load_preprocessed_corpus(args.input, tiny_segmenter, mecab_tagger,
+                                      args.preprocessed_dir)
+  except FileNotFoundError:
+    print(f"Error: Input file not found at {args.input}", file=sys.stderr)
+    return
+
+  # Responses of earlier configurations must not be evicted or expire.
+  macro.response_cache.max_entries = sys.maxsize
+  macro.response_cache.ttl_seconds = float('inf')
+  stats_before = model_call_stats()
+
+  output_stream = sys.stderr if DEBUG_STATS_TRANSITION else open(
+      os.devnull, 'w')
+  prefetch_executor = futures.ThreadPoolExecutor(
+      max_workers=args.prefetch) if args.prefetch > 0 else None
+  configs_sim_params = []
+  for model_id, sentence_macro_id, word_macro_id in configs:
+    sim_params = {
+        'model_id': model_id,
+        'sentence_macro_id': sentence_macro_id,
+        'word_macro_id': word_macro_id,
+        'output_stream': output_stream,
+    }
+    if prefetch_executor:
+      sim_params['prefetch_executor'] = prefetch_executor
+    configs_sim_params.append(sim_params)
+  if early_stopping_enabled(args):
+    random.Random(args.seed).shuffle(corpus)
+  results, stop_reason = simulate_configs(corpus, configs_sim_params,
+                                          tiny_segmenter, mecab_tagger, args)
+
+  output_file = args.output
+  for config, (lines, sugg_lengths, duration_seconds) in zip(configs, results):
+    model_id, sentence_macro_id, word_macro_id = config
+    run_params = {
+        'model_id': model_id,
+        'sentence_macro_id': sentence_macro_id,
+        'word_macro_id': word_macro_id,
+        'input_file': os.path.basename(args.input),
+    }
+    output_file = append_to_csv(
+        args.output,
+        build_results_row(run_params, lines, sugg_lengths, duration_seconds,
+                          args, stop_reason))
+
+  upstream, shared = model_calls_since(stats_before)
+  print(f"Grid experiment complete. Model calls: {upstream}, "
+        f"served from earlier responses: {shared}. "
+        f"Results appended to {output_file}")
+
+
+def model_call_stats():
+  """Returns the counters compared by `model_calls_since`."""
+  stats = {**macro.response_cache.Stats(), **macro.single_flight.Stats()}
+  if macro.response_log is not None:
+    stats.update(macro.response_log.Stats())
+  return stats
+
+
+def model_calls_since(stats_before):
+  """Returns calls that reached the model and calls served without it.
+
+  With a response log, calls bypass the response cache, so they are counted
+  from the log instead.
+
+  Args:
+    stats_before: `model_call_stats()` taken at the start.
+  """
+  stats = model_call_stats()
+  delta = {key: stats[key] - stats_before.get(key, 0) for key in stats}
+  if macro.response_log is not None:
+    return delta['recorded'], delta['replayed'] + delta['coalesced']
+  shared = delta['hits'] + delta['disk_hits'] + delta['coalesced']
+  upstream = delta['misses'] - delta['coalesced']
+  return upstream, shared
+
+
+# Columns of the per-line results returned by `simulate_corpus`.
+LINE_FIELDS = ('total_clicks', 's_count', 'w_count', 'fb_count', 'total_len',
+               's_sugg_segments', 'w_sugg_segments', 'kb_input')
+
+
+def simulate_corpus(corpus, tiny_segmenter, mecab_tagger, sim_params,
+                    concurrency):
+  """Simulates preprocessed lines and returns their results.
+
+  Args:
+    corpus: Lines preprocessed by `analyze_target`.
+    tiny_segmenter: TinySegmenter for suggestions.
+    mecab_tagger: MeCab tagger.
+    sim_params: Simulation parameters.
+    concurrency: Number of lines simulated in parallel.
+
+  Returns:
+    A tuple of an integer array with a row per line and a column per field of
+    `LINE_FIELDS`, and arrays of the segment counts added by each selected
+    sentence and word suggestion.
+  """
+  if concurrency > 1:
+    line_results = simulate_lines_concurrently(corpus, sim_params, concurrency)
+  else:
+    line_results = (
+        simulate_line(analysis, tiny_segmenter, mecab_tagger, sim_params)
+        for analysis in corpus)
+  rows = []
+  sugg_lengths = {'sentence': [], 'word': []}
+  for line_stats, kb_input, line_sugg_lengths in line_results:
+    rows.append((*line_stats, kb_input))
+    for kind, lengths in line_sugg_lengths.items():
+      sugg_lengths[kind].extend(lengths)
+  return (np.array(rows, dtype=np.int64).reshape(-1, len(LINE_FIELDS)), {
+      kind: np.array(lengths, dtype=np.int64)
+      for kind, lengths in sugg_lengths.items()
+  })
+
+
+def line_column(lines, field):
+  return lines[:, LINE_FIELDS.index(field)]
+
+
+# --- Confidence Interval Functions ---
+# Normal quantile of two-sided 95% confidence intervals.
+CI_Z = 1.96
+
+# Resample-by-line weights computed at once by `bootstrap_intervals`, bounding
+# its memory use.
+_BOOTSTRAP_CHUNK_CELLS = 1 << 22
+
+
+def ratio_ci_width(numerators, denominators):
+  """Returns the width of the 95% CI of a ratio of sums over lines.
+
+  Lines are treated as a random sample of the corpus, and the variance of
+  sum(numerators) / sum(denominators) is estimated with the delta method.
+  """
+  n = len(numerators)
+  total = denominators.sum()
+  if n < 2 or total == 0:
+    return math.inf
+  residuals = numerators - numerators.sum() / total * denominators
+  return 2 * CI_Z * math.sqrt(residuals.var(ddof=1) / n) / (total / n)
+
+
+def ksr_ci_width(lines):
+  """Returns the width of the 95% CI of the keystroke saving rate in %."""
+  return 100 * ratio_ci_width(
+      line_column(lines, 'total_clicks'), line_column(lines, 'kb_input'))
+
+
+def chars_per_click_ci_width(lines):
+  return ratio_ci_width(
+      line_column(lines, 'total_len'), line_column(lines, 'total_clicks'))
+
+
+def bootstrap_intervals(lines, resamples, seed):
+  """Returns percentile bootstrap 95% CIs of the KSR and select rate in %.
+
+  Each resample draws as many lines as there are, with replacement. The sums
+  of all resamples are computed as products of their line counts with the
+  per-line results, in chunks of resamples.
+
+  Returns:
+    (low, high) tuples for the keystroke saving rate and the suggestion select
+    rate, which are NaN without lines or resamples.
+  """
+  n = len(lines)
+  if n == 0 or resamples <= 0:
+    return (math.nan, math.nan), (math.nan, math.nan)
+  selected = line_column(lines, 's_count') + line_column(lines, 'w_count')
+  values = np.stack([
+      line_column(lines, 'total_clicks'),
+      line_column(lines, 'kb_input'),
+      selected,
+      selected + line_column(lines, 'fb_count'),
+  ],
+                    axis=1).astype(np.float64)
+  rng = np.random.default_rng(seed)
+  sums = np.empty((resamples, values.shape[1]))
+  chunk = max(1, _BOOTSTRAP_CHUNK_CELLS // n)
+  for start in range(0, resamples, chunk):
+    size = min(chunk, resamples - start)
+    # Offsets each resample's draws by its row, so one bincount counts them.
+    draws = rng.integers(0, n, size=(size, n)) + n * np.arange(size)[:, None]
+    counts = np.bincount(draws.ravel(), minlength=size * n).reshape(size, n)
+    sums[start:start + size] = counts @ values
+  with np.errstate(divide='ignore', invalid='ignore'):
+    ksr = 100 * (1 - sums[:, 0] / sums[:, 1])
+    select_rate = 100 * sums[:, 2] / sums[:, 3]
+  return tuple(
+      tuple(np.nanpercentile(metric, [2.5, 97.5]))
+      for metric in (ksr, select_rate))
+
+
+def separable(clicks1, clicks2):
+  """Returns whether two configurations differ in KSR with 95% confidence.
+
+  Both configurations ran the same lines, whose keystrokes are the same, so
+  the difference of their KSRs is tested with the paired per-line difference
+  of their clicks.
+  """
+  diffs = clicks1 - clicks2
+  if len(diffs) < 2:
+    return False
+  return abs(diffs.mean()) > CI_Z * diffs.std(ddof=1) / math.sqrt(len(diffs))
+
+
+def early_stopping_enabled(args):
+  return bool(args.stop_ksr_ci or args.stop_cpc_ci or args.stop_when_separable)
+
+
+def stop_reason_of(results, args):
+  """Returns why simulation can stop after the lines so far, or None."""
+  if args.stop_when_separable and len(results) > 1 and all(
+      separable(
+          line_column(lines1, 'total_clicks'),
+          line_column(lines2, 'total_clicks'))
+      for (lines1, _, _), (lines2, _, _) in itertools.combinations(results, 2)):
+    return 'separable'
+  if (args.stop_ksr_ci or args.stop_cpc_ci) and all(
+      (not args.stop_ksr_ci or ksr_ci_width(lines) <= args.stop_ksr_ci) and
+      (not args.stop_cpc_ci or
+       chars_per_click_ci_width(lines) <= args.stop_cpc_ci)
+      for lines, _, _ in results):
+    return 'ci width'
+  return None
+
+
+def simulate_configs(corpus, configs_sim_params, tiny_segmenter, mecab_tagger,
+                     args):
+  """Simulates configurations over the same lines of a corpus.
+
+  Without early stopping, every configuration simulates the whole corpus.
+  Otherwise, they simulate it in rounds of `--check-every` lines, after at
+  least `--min-lines` lines, until a stopping rule holds.
+
+  Returns:
+    A tuple of a (per-line results, suggestion lengths, duration in seconds)
+    tuple for each configuration, and the reason simulation stopped.
+  """
+  results = [(np.zeros((0, len(LINE_FIELDS)), dtype=np.int64), {
+      'sentence': np.zeros(0, dtype=np.int64),
+      'word': np.zeros(0, dtype=np.int64)
+  }, 0.0) for _ in configs_sim_params]
+  if early_stopping_enabled(args):
+    boundaries = range(args.min_lines, len(corpus), args.check_every)
+  else:
+    boundaries = []
+  start = 0
+  for end in [*boundaries, len(corpus)]:
+    chunk = corpus[start:end]
+    start = end
+    for i, sim_params in enumerate(configs_sim_params):
+      lines, sugg_lengths, duration_seconds = results[i]
+      chunk_start_time = datetime.now()
+      chunk_lines, chunk_sugg_lengths = simulate_corpus(chunk, tiny_segmenter,
+                                                        mecab_tagger,
+                                                        sim_params,
+                                                        args.concurrency)
+      results[i] = (np.concatenate([lines, chunk_lines]), {
+          kind: np.concatenate([lengths, chunk_sugg_lengths[kind]])
+          for kind, lengths in sugg_lengths.items()
+      }, duration_seconds + (datetime.now() - chunk_start_time).total_seconds())
+    if end < len(corpus):
+      stop_reason = stop_reason_of(results, args)
+      if stop_reason:
+        return results, stop_reason
+  return results, 'end of corpus'
+
+
+def simulate_line(analysis, tiny_segmenter, mecab_tagger, sim_params):
+  """Simulates a line and returns its stats, keystrokes and suggestion lengths.
+
+  Args:
+    analysis: The line preprocessed by `analyze_target`.
+    tiny_segmenter: TinySegmenter for suggestions.
+    mecab_tagger: MeCab tagger.
+    sim_params: Simulation parameters.
+  """
+  sugg_lengths_log = {'sentence': [], 'word': []}
+  line_stats = simulate_japanese(analysis['target'], tiny_segmenter,
+                                 mecab_tagger, sim_params, sugg_lengths_log,
+                                 analysis)
+  return line_stats, analysis['keystrokes'], sugg_lengths_log
+
+
+def load_preprocessed_corpus(input_path,
+                             tiny_segmenter,
+                             mecab_tagger,
+                             preprocessed_dir=None):
+  """Returns `analyze_target` results for each non-empty line of a corpus.
+
+  Results are stored in a JSONL artifact named after the SHA-256 of the
+  corpus and of the preprocessing inputs (`PREPROCESS_VERSION` and
+  `INITIAL_PHRASES_JA`), so later runs on the same corpus load it instead of
+  running TinySegmenter and MeCab again. A changed corpus gets a new artifact.
+
+  Args:
+    input_path: Path of the corpus with one target per line.
+    tiny_segmenter: TinySegmenter, used only if there is no artifact yet.
+    mecab_tagger: MeCab tagger, used only if there is no artifact yet.
+    preprocessed_dir: Directory of artifacts. Defaults to the directory of the
+      corpus.
+
+  Raises:
+    FileNotFoundError: If the corpus does not exist.
+  """
+  with open(input_path, 'rb') as f:
+    content = f.read()
+  digest = hashlib.sha256()
+  digest.update(json.dumps([PREPROCESS_VERSION, INITIAL_PHRASES_JA]).encode())
+  digest.update(content)
+  artifact_path = os.path.join(
+      preprocessed_dir or os.path.dirname(os.path.abspath(input_path)),
+      f'{os.path.basename(input_path)}.{digest.hexdigest()[:16]}.prep.jsonl')
+  if os.path.exists(artifact_path):
+    with open(artifact_path, encoding='utf-8') as f:
+      return [json.loads(line) for line in f]
+
+  targets = [
+      line.strip()
+      for line in content.decode('utf-8').splitlines()
+      if line.strip()
+  ]
+  corpus = [
+      analyze_target(target, tiny_segmenter, mecab_tagger) for target in targets
+  ]
+  # Written to a temporary file first, so that an interrupted run leaves no
+  # partial artifact behind.
+  os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+  temp_path = f'{artifact_path}.{os.getpid()}.tmp'
+  with open(temp_path, 'w', encoding='utf-8') as f:
+    for analysis in corpus:
+      f.write(json.dumps(analysis, ensure_ascii=False) + '\n')
+  os.replace(temp_path, artifact_path)
+  return corpus
+
+
+def simulate_lines_concurrently(corpus, sim_params, concurrency):
+  """Simulates lines in a thread pool and yields `simulate_line` results.
+
+  Lines are independent of each other, so the results are yielded in input
+  order and the aggregated stats match a sequential run. Each thread has its
+  own tokenizers, and the debug output of each line is buffered and written
+  in order too.
+  """
+  local = threading.local()
+
+  def run(analysis):
+    if not hasattr(local, 'mecab_tagger'):
+      local.tiny_segmenter = initialize_tiny_segmenter()
+      local.mecab_tagger = initialize_mecab_tagger()
+    output = io.StringIO()
+    result = simulate_line(analysis, local.tiny_segmenter, local.mecab_tagger, {
+        **sim_params, 'output_stream': output
+    })
+    return result, output.getvalue()
+
+  with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+    for result, output in executor.map(run, corpus):
+      sim_params['output_stream'].write(output)
+      yield result
 
 
 def format_duration(total_seconds):
@@ -761,6 +1507,9 @@ def run_interactive_mode(args):
       'word_macro_id': args.word_macro_id,
       'output_stream': sys.stdout
   }
+  if args.prefetch > 0:
+    sim_params['prefetch_executor'] = futures.ThreadPoolExecutor(
+        max_workers=args.prefetch)
 
   for line in sys.stdin:
     target = line.strip()
@@ -771,13 +1520,14 @@ def run_interactive_mode(args):
     print(f"\n  [Processing] -> {target}")
     stats['line_count'] += 1
 
-    target_yomigana = get_sentence_yomigana(target, mecab_tagger)
+    analysis = analyze_target(target, tiny_segmenter, mecab_tagger)
+    target_yomigana = analysis['sentence_yomigana']
     print(f"  [Yomigana ({len(target_yomigana)} chars)] -> {target_yomigana}")
 
     sentence_process_start_time = datetime.now()
 
     line_stats = simulate_japanese(target, tiny_segmenter, mecab_tagger,
-                                   sim_params, sugg_lengths_log)
+                                   sim_params, sugg_lengths_log, analysis)
 
     sentence_process_end_time = datetime.now()
     sentence_duration_seconds = (sentence_process_end_time -
@@ -790,7 +1540,7 @@ def run_interactive_mode(args):
       stats['w_count'] += line_stats[2]
       stats['fb_count'] += line_stats[3]
       stats['total_len'] += line_stats[4]
-      stats['kb_input'] += len(get_sentence_yomigana(target, mecab_tagger))
+      stats['kb_input'] += analysis['keystrokes']
       stats['s_sugg_segments'] += line_stats[5]
       stats['w_sugg_segments'] += line_stats[6]
 
@@ -818,18 +1568,11 @@ def calculate_binned_frequency(lengths_list, num_individual_bins=5):
   bin_keys = [f"Freq_{i}" for i in range(1, num_individual_bins + 1)]
   bin_keys.append(f"Freq_{num_individual_bins + 1}plus")
 
-  binned_counts = {key: 0 for key in bin_keys}
-
-  if not lengths_list:
-    return binned_counts
-
-  counts = Counter(lengths_list)
-  for length, count in counts.items():
-    if length <= num_individual_bins:
-      binned_counts[f"Freq_{length}"] += count
-    else:
-      binned_counts[f"Freq_{num_individual_bins + 1}plus"] += count
-  return binned_counts
+  # Lengths above num_individual_bins all fall in the last bin.
+  lengths = np.minimum(
+      np.asarray(lengths_list, dtype=np.int64), num_individual_bins + 1)
+  counts = np.bincount(lengths, minlength=num_individual_bins + 2)
+  return {key: int(count) for key, count in zip(bin_keys, counts[1:])}
 
 
 def main():
@@ -867,17 +1610,169 @@ Usage examples:
       '--word-macro-id',
       type=str,
       default='WordGeneric20240628',
-      help='The macro ID for word suggestions.')
+      help=('The macro ID for word suggestions. Ignored if the sentence '
+            'macro is a\ncombined macro, which generates the words too.'))
+  parser.add_argument(
+      '--model-ids',
+      nargs='+',
+      metavar='MODEL_ID',
+      help=('Model IDs of a grid experiment. With any of --model-ids,\n'
+            '--sentence-macro-ids and --word-macro-ids, every combination is\n'
+            'simulated in one job and gets its own CSV row. Identical model '
+            'calls\nare shared across combinations.'))
+  parser.add_argument(
+      '--sentence-macro-ids',
+      nargs='+',
+      metavar='MACRO_ID',
+      help='Sentence macro IDs of a grid experiment.')
+  parser.add_argument(
+      '--word-macro-ids',
+      nargs='+',
+      metavar='MACRO_ID',
+      help='Word macro IDs of a grid experiment.')
+  parser.add_argument(
+      '--model-backend',
+      choices=macro.MODEL_BACKENDS,
+      help=('Backend serving model calls. Use "stub" to run offline with '
+            'deterministic responses.\nDefaults to the MODEL_BACKEND '
+            'environment variable, or "gemini".'))
+
+  recording = parser.add_mutually_exclusive_group()
+  recording.add_argument(
+      '--record',
+      metavar='PATH',
+      help=('Append model responses to a JSONL log, reusing responses '
+            'already\nrecorded there.'))
+  recording.add_argument(
+      '--replay',
+      metavar='PATH',
+      help=('Serve model responses from a log written with --record, '
+            'without\nany model calls. Unrecorded calls fail.'))
+
+  parser.add_argument(
+      '--preprocessed-dir',
+      type=str,
+      help=('Directory of preprocessed corpus artifacts, reused across runs '
+            'on the\nsame input. Defaults to the directory of the input.'))
+
+  # Sharding arguments
+  parser.add_argument(
+      '--shard',
+      type=parse_shard,
+      metavar='INDEX/COUNT',
+      help=('Simulate only every COUNT-th line starting at line INDEX, e.g. '
+            '0/4.'))
+  parser.add_argument(
+      '--partial-output',
+      type=str,
+      help=('Write raw counters of the run as JSON instead of appending a '
+            'CSV row.\nUsed with --shard and merged with --merge.'))
+  parser.add_argument(
+      '--merge',
+      nargs='+',
+      metavar='PARTIAL',
+      help=('Merge partial results of all shards of a run and append its '
+            'row to\n--output.'))
+
+  # Early stopping arguments
+  parser.add_argument(
+      '--stop-ksr-ci',
+      type=float,
+      metavar='WIDTH',
+      help=('Stop once the 95%% confidence interval of the keystroke saving '
+            'rate is\nnarrower than WIDTH percentage points. Lines are '
+            'simulated in random order.'))
+  parser.add_argument(
+      '--stop-cpc-ci',
+      type=float,
+      metavar='WIDTH',
+      help=('Stop once the 95%% confidence interval of chars per click is '
+            'narrower\nthan WIDTH.'))
+  parser.add_argument(
+      '--stop-when-separable',
+      action='store_true',
+      help=('In a grid experiment, stop once the KSRs of every two '
+            'configurations\ndiffer with 95%% confidence. The intervals are '
+            'checked repeatedly\nwithout correction, which inflates the '
+            'false-positive rate: confirm\na difference on a fresh run '
+            'with a fixed number of lines.'))
+  parser.add_argument(
+      '--min-lines',
+      type=int,
+      default=100,
+      help='Lines simulated before checking the stopping rules.')
+  parser.add_argument(
+      '--check-every',
+      type=int,
+      default=50,
+      help='Lines simulated between checks of the stopping rules.')
+  parser.add_argument(
+      '--bootstrap-resamples',
+      type=int,
+      default=10000,
+      help=('Resamples of lines for the bootstrap confidence intervals of the '
+            'KSR\nand the suggestion select rate. 0 disables them.'))
+  parser.add_argument(
+      '--seed',
+      type=int,
+      default=0,
+      help=('Seed of the random order of lines with early stopping, and of '
+            'the\nbootstrap.'))
+
+  # Concurrency arguments
+  parser.add_argument(
+      '--concurrency',
+      type=int,
+      default=1,
+      help='Number of lines simulated in parallel in batch mode.')
+  parser.add_argument(
+      '--prefetch',
+      type=int,
+      default=0,
+      help=('Number of threads issuing word suggestion calls for typed '
+            'prefixes\nahead of time. Unneeded calls are discarded, so this '
+            'trades extra\ncalls for latency. 0 disables prefetching.'))
+  parser.add_argument(
+      '--rpm',
+      type=int,
+      help='Maximum model requests per minute across all threads.')
+  parser.add_argument(
+      '--tpm',
+      type=int,
+      help='Maximum model tokens per minute across all threads.')
 
   args = parser.parse_args()
+  if args.concurrency > 1 or args.rpm or args.tpm:
+    # Also retries calls failing with 429 with an adaptive backoff.
+    macro.SetRateLimiter(rate_limit.RateLimiter(args.rpm, args.tpm))
+  if args.model_backend:
+    macro.SetModelBackend(args.model_backend)
+  if args.record:
+    macro.SetResponseLog(args.record)
+  elif args.replay:
+    macro.SetResponseLog(args.replay, replay_only=True)
+
+  if early_stopping_enabled(args) and (args.shard or args.partial_output):
+    parser.error("Early stopping cannot be combined with sharding.")
+  args.word_macro_id = word_macro_of(args.sentence_macro_id, args.word_macro_id)
 
   # Decide mode based on arguments
-  if args.input and args.output:
+  if args.merge:
+    if not args.output:
+      parser.error("--merge requires --output.")
+    run_merge(args)
+  elif args.model_ids or args.sentence_macro_ids or args.word_macro_ids:
+    if not args.input or not args.output:
+      parser.error("Grid experiments require --input and --output.")
+    run_grid_experiment(args)
+  elif args.input and (args.output or args.partial_output):
     run_batch_simulation(args)
   elif not args.input and not args.output:
     run_interactive_mode(args)
   else:
-    parser.error("For batch mode, both --input and --output must be specified.")
+    parser.error(
+        "For batch mode, --input and --output (or --partial-output) must be specified."
+    )
 
 
 if __name__ == '__main__':
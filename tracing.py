@@ -0,0 +1,125 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-request phase tracing.
+
+A trace started for a request collects the durations of the spans recorded
+while it is active, even deep inside `macro`. The phases are returned to the
+browser as a `Server-Timing` header, and a sample of traces is appended to a
+JSONL file when TRACE_LOG_PATH is set.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import random
+import threading
+import time
+
+_TRACE_LOG_PATH = os.environ.get('TRACE_LOG_PATH')
+_TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0.01'))
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_span_prefix = contextvars.ContextVar('span_prefix', default='')
+_log_lock = threading.Lock()
+
+
+class Trace:
+  """Spans and attributes collected for a request."""
+
+  def __init__(self, attributes):
+    self.attributes = dict(attributes)
+    self.spans = []
+    self.start = time.perf_counter()
+    self.duration = None
+
+  def ServerTimingHeader(self):
+    """Returns the `Server-Timing` header value of the trace."""
+    entries = [
+        f'{name};dur={seconds * 1000:.2f}' for name, seconds in self.spans
+    ]
+    entries.extend(
+        f'{key};desc={value}' for key, value in self.attributes.items()
+        if key.rpartition('.')[2] == 'cache')
+    duration = self.duration
+    if duration is None:
+      duration = time.perf_counter() - self.start
+    entries.append(f'total;dur={duration * 1000:.2f}')
+    return ', '.join(entries)
+
+  def ToJson(self):
+    return json.dumps(
+        {
+            'timestamp': time.time(),
+            **self.attributes,
+            'spans_ms': {
+                name: round(seconds * 1000, 3) for name, seconds in self.spans
+            },
+            'total_ms': round(self.duration * 1000, 3),
+        },
+        ensure_ascii=False)
+
+
+@contextlib.contextmanager
+def Start(**attributes):
+  """Starts a trace for the current request and yields it."""
+  trace = Trace(attributes)
+  token = _current_trace.set(trace)
+  try:
+    yield trace
+  finally:
+    _current_trace.reset(token)
+    trace.duration = time.perf_counter() - trace.start
+    if _TRACE_LOG_PATH and random.random() < _TRACE_SAMPLE_RATE:
+      _Log(trace)
+
+
+@contextlib.contextmanager
+def Span(name):
+  """Records the duration of the body as a phase of the current trace."""
+  trace = _current_trace.get()
+  if trace is None:
+    yield
+    return
+  name = _span_prefix.get() + name
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    trace.spans.append((name, time.perf_counter() - start))
+
+
+def Annotate(**attributes):
+  """Adds attributes, e.g. the prompt size, to the current trace."""
+  trace = _current_trace.get()
+  if trace is not None:
+    prefix = _span_prefix.get()
+    trace.attributes.update(
+        (prefix + key, value) for key, value in attributes.items())
+
+
+def SetPrefix(prefix):
+  """Prefixes names of spans and attributes recorded in the current context.
+
+  Used to tell apart the phases of macros run concurrently for one request.
+  Call it in a copied context, e.g. a task or `contextvars.Context.run`.
+  """
+  _span_prefix.set(prefix)
+
+
+def _Log(trace):
+  line = trace.ToJson() + '\n'
+  with _log_lock:
+    with open(_TRACE_LOG_PATH, 'a', encoding='utf-8') as f:
+      f.write(line)